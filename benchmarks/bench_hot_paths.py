@@ -0,0 +1,332 @@
+"""
+Benchmarks the hot paths of the tool layer and of the prompt assembly:
+
+- snapshot: read_files_in_directory_as_string on synthetic projects of 10 to 10,000 files, cold (new snapshot),
+  warm (nothing changed) and after one file changed
+- file_tools: the create, read and update tools on files of 1 KB to 1 MB
+- venv: create_virtual_env, without the venv pool
+- install: install_requirements_in_env from a local wheelhouse of generated wheels, into a fresh venv and again
+  with nothing to install
+- pytest: run_pytest_in_directory on generated test suites of increasing size
+- prompts: the rendering of the prompt of every state, with the project files and an agent scratchpad
+
+No LLM call and no network access is made. The results are saved as JSON and compared with a baseline, the
+benchmarks whose median got slower than the threshold are reported as regressions.
+
+usage: python benchmarks/bench_hot_paths.py [--quick] [--only snapshot,prompts] [--output results.json]
+                                            [--baseline baseline.json] [--save-baseline] [--threshold 0.25]
+                                            [--fail-on-regression]
+"""
+import argparse
+import base64
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+WORKDIR = tempfile.mkdtemp(prefix="llm_coder_bench_")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+# The benchmarks measure the tools themselves: no pool, no cache, no telemetry, and a private wheelhouse
+os.environ["LLM_CODER_VENV_POOL_SIZE"] = "0"
+os.environ["LLM_CODER_WHEELHOUSE_DIR"] = os.path.join(WORKDIR, "wheelhouse")
+os.environ["LLM_CODER_WORKSPACE_ROOT"] = os.path.join(WORKDIR, "workspace")
+os.environ["LLM_CODER_LLM_CACHE"] = "0"
+os.environ["LLM_CODER_CHECKPOINTS"] = "0"
+os.environ["LLM_CODER_TELEMETRY"] = "0"
+
+import harness  # noqa: E402
+import snapshot  # noqa: E402
+from helpers import read_files_in_directory_as_string  # noqa: E402
+from langchain_core.agents import AgentActionMessageLog  # noqa: E402
+from langchain_core.messages import AIMessage  # noqa: E402
+from langchain_core.prompts import PromptTemplate  # noqa: E402
+from scratchpad import compact_scratchpad  # noqa: E402
+from states import create_project, generate_plan, handle_step, rework_code, test_step, validate_plan  # noqa: E402
+from tools.file_tools import create_file_with_content, read_file_content, update_file_content  # noqa: E402
+from tools.python_tools import run_pytest_in_directory  # noqa: E402
+from tools.venv_tools import create_virtual_env, install_requirements_in_env  # noqa: E402
+
+MODULE_TEMPLATE = '''"""Module {index} of the synthetic project."""
+
+
+def function_{index}(value):
+    """Returns the value shifted by {index}."""
+    return value + {index}
+
+
+class Class{index}:
+    """A class with a few methods."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def shifted(self):
+        return function_{index}(self.value)
+'''
+
+TEST_TEMPLATE = '''def test_{index}_{case}():
+    assert sum(range({case})) == {total}
+
+'''
+
+
+def _fresh_dir(name):
+    path = os.path.join(WORKDIR, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def make_project(root, file_count, per_folder=100):
+    """Writes file_count python modules, at most per_folder per package."""
+    for index in range(file_count):
+        folder = os.path.join(root, f"package_{index // per_folder}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"module_{index}.py"), 'w') as f:
+            f.write(MODULE_TEMPLATE.format(index=index))
+
+
+def make_test_suite(root, file_count, tests_per_file=10):
+    for index in range(file_count):
+        with open(os.path.join(root, f"test_generated_{index}.py"), 'w') as f:
+            f.write(''.join(TEST_TEMPLATE.format(index=index, case=case, total=sum(range(case)))
+                            for case in range(tests_per_file)))
+
+
+def make_wheel(wheelhouse, name, version="1.0"):
+    """Writes a minimal pure python wheel, so that pip installs it without building anything."""
+    dist_info = f"{name}-{version}.dist-info"
+    files = {
+        f"{name}/__init__.py": f"VERSION = '{version}'\n",
+        f"{dist_info}/METADATA": f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n",
+        f"{dist_info}/WHEEL": "Wheel-Version: 1.0\nGenerator: bench\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+    }
+    record = []
+    for path, content in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(content.encode()).digest()).rstrip(b'=').decode()
+        record.append(f"{path},sha256={digest},{len(content.encode())}")
+    record.append(f"{dist_info}/RECORD,,")
+    files[f"{dist_info}/RECORD"] = '\n'.join(record) + '\n'
+
+    os.makedirs(wheelhouse, exist_ok=True)
+    with zipfile.ZipFile(os.path.join(wheelhouse, f"{name}-{version}-py3-none-any.whl"), 'w') as wheel:
+        for path, content in files.items():
+            wheel.writestr(path, content)
+
+
+def bench_snapshot(quick):
+    results = {}
+    for file_count in (10, 100, 1000) if quick else (10, 100, 1000, 10000):
+        root = _fresh_dir(f"snapshot_{file_count}")
+        make_project(root, file_count)
+        repeat = 3 if file_count >= 10000 else 5
+
+        def cold_setup(root=root):
+            snapshot._snapshots.pop(os.path.abspath(root), None)
+
+        results[f"snapshot.cold.{file_count}"] = harness.measure(
+            lambda _, root=root: read_files_in_directory_as_string(root), repeat, setup=cold_setup)
+        read_files_in_directory_as_string(root)
+        results[f"snapshot.warm.{file_count}"] = harness.measure(
+            lambda root=root: read_files_in_directory_as_string(root), repeat * 4)
+
+        changed = os.path.join(root, "package_0", "module_0.py")
+
+        def change_setup(changed=changed, counter=[0]):
+            counter[0] += 1
+            with open(changed, 'a') as f:
+                f.write(f"# change {counter[0]}\n")
+
+        results[f"snapshot.one_changed.{file_count}"] = harness.measure(
+            lambda _, root=root: read_files_in_directory_as_string(root), repeat * 4, setup=change_setup)
+    return results
+
+
+def bench_file_tools(quick):
+    results = {}
+    root = _fresh_dir("file_tools")
+    for size in (1_000, 100_000, 1_000_000):
+        content = (MODULE_TEMPLATE.format(index=0) * (size // len(MODULE_TEMPLATE) + 1))[:size]
+        path = os.path.join(root, f"file_{size}.py")
+        repeat = 10 if quick else 50
+        results[f"file_tools.create.{size}"] = harness.measure(
+            lambda path=path, content=content: create_file_with_content(path, content), repeat)
+        results[f"file_tools.read.{size}"] = harness.measure(lambda path=path: read_file_content(path), repeat)
+        results[f"file_tools.update.{size}"] = harness.measure(
+            lambda path=path, content=content: update_file_content(path, content), repeat)
+    return results
+
+
+def bench_venv(quick):
+    root = _fresh_dir("venvs")
+    counter = [0]
+
+    def setup():
+        counter[0] += 1
+        return os.path.join(root, f"venv_{counter[0]}")
+
+    result = harness.measure(create_virtual_env, 1 if quick else 3, setup=setup)
+    shutil.rmtree(root, ignore_errors=True)
+    return {"venv.create": result}
+
+
+def bench_install(quick):
+    package_count = 5
+    requirements = [f"bench_package_{index}" for index in range(package_count)]
+    for name in requirements:
+        make_wheel(os.environ["LLM_CODER_WHEELHOUSE_DIR"], name)
+    root = _fresh_dir("install")
+    requirements_file = os.path.join(root, "requirements.txt")
+    with open(requirements_file, 'w') as f:
+        f.write('\n'.join(requirements) + '\n')
+    counter = [0]
+
+    def setup():
+        counter[0] += 1
+        venv = os.path.join(root, f"venv_{counter[0]}")
+        subprocess.run([sys.executable, "-m", "venv", venv], check=True)
+        return os.path.join(venv, "bin", "python")
+
+    results = {
+        f"install.fresh.{package_count}": harness.measure(
+            lambda python_path: install_requirements_in_env(python_path, requirements_file), 1 if quick else 3,
+            setup=setup),
+    }
+    python_path = os.path.join(root, f"venv_{counter[0]}", "bin", "python")
+    results[f"install.unchanged.{package_count}"] = harness.measure(
+        lambda: install_requirements_in_env(python_path, requirements_file), 10)
+    shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def bench_pytest(quick):
+    results = {}
+    for file_count in (5, 20) if quick else (5, 20, 80):
+        project = _fresh_dir(f"pytest_{file_count}")
+        test_dir = os.path.join(project, "tests")
+        os.makedirs(test_dir)
+        make_test_suite(test_dir, file_count)
+        results[f"pytest.run.{file_count * 10}_tests"] = harness.measure(
+            lambda test_dir=test_dir: run_pytest_in_directory(test_dir, sys.executable), 1 if quick else 3)
+    return results
+
+
+def _scratchpad(step_count):
+    steps = []
+    for index in range(step_count):
+        tool_input = {"path": f"src/module_{index}.py", "content": MODULE_TEMPLATE.format(index=index)}
+        message = AIMessage(content="", additional_kwargs={
+            "function_call": {"name": "CreateFile", "arguments": str(tool_input)}
+        })
+        action = AgentActionMessageLog(tool="CreateFile", tool_input=tool_input, log="", message_log=[message])
+        steps.append((action, f"File created at: src/module_{index}.py"))
+    return steps
+
+
+def bench_prompts(quick):
+    project = _fresh_dir("prompts")
+    source, tests = os.path.join(project, "src"), os.path.join(project, "tests")
+    os.makedirs(source)
+    os.makedirs(tests)
+    make_project(source, 20)
+    make_test_suite(tests, 20)
+    plan_steps = [f"Step {index}: implement module {index} and its tests" for index in range(10)]
+    state = {
+        "software_description": "A command line tool managing a todo list stored in a JSON file. " * 5,
+        "plan_steps": plan_steps,
+        "steps_done": plan_steps[:5],
+        "steps_todo": plan_steps[5:],
+        "project_folder": project,
+        "source_folder": source,
+        "test_folder": tests,
+        "requirements": {"pytest", "click"},
+        "test_feedback": "E   AssertionError: expected 3, got 2\n" * 40,
+    }
+    scratchpad = _scratchpad(10)
+    generate = PromptTemplate(template=generate_plan.GENERATE_TEMPLATE, input_variables=["software_description"])
+    regenerate = PromptTemplate(template=generate_plan.REGENERATE_TEMPLATE,
+                                input_variables=["software_description", "feedback", "plan_steps"])
+    validate = PromptTemplate(template=validate_plan.VALIDATE_TEMPLATE,
+                              input_variables=["software_description", "plan_steps"])
+
+    renders = {
+        "generate_plan": lambda: generate.format(software_description=state["software_description"]),
+        "regenerate_plan": lambda: regenerate.format(software_description=state["software_description"],
+                                                     feedback="The plan misses the tests", plan_steps=plan_steps),
+        "validate_plan": lambda: validate.format(**validate_plan.validation_inputs(state["software_description"],
+                                                                                   plan_steps)),
+        "create_project": lambda: create_project.prompt.format_messages(
+            input=create_project._agent_input("todo_cli", project), agent_scratchpad=compact_scratchpad(scratchpad)),
+        "handle_step": lambda: handle_step.prompt.format_messages(
+            input=handle_step._user_input(state), agent_scratchpad=compact_scratchpad(scratchpad)),
+        "test_step": lambda: test_step.prompt.format_messages(
+            input=test_step._agent_input(state), agent_scratchpad=compact_scratchpad(scratchpad)),
+        "rework_code": lambda: rework_code.prompt.format_messages(
+            input=rework_code._user_input(state), agent_scratchpad=compact_scratchpad(scratchpad)),
+    }
+    return {f"prompts.{name}": harness.measure(render, 20 if quick else 100) for name, render in renders.items()}
+
+
+GROUPS = {
+    "snapshot": bench_snapshot,
+    "file_tools": bench_file_tools,
+    "venv": bench_venv,
+    "install": bench_install,
+    "pytest": bench_pytest,
+    "prompts": bench_prompts,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the tool layer and of the prompt assembly")
+    parser.add_argument("--quick", action="store_true", help="smaller inputs and fewer repetitions")
+    parser.add_argument("--only", help=f"comma separated groups among {', '.join(GROUPS)}")
+    parser.add_argument("--output", default=os.path.join(harness.RESULTS_DIR, "latest.json"))
+    parser.add_argument("--baseline", default=os.path.join(harness.RESULTS_DIR, "baseline.json"),
+                        help="results to compare with, ignored if the file doesn't exist")
+    parser.add_argument("--save-baseline", action="store_true", help="also save the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="relative slowdown of the median reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on a regression")
+    args = parser.parse_args()
+
+    groups = args.only.split(",") if args.only else list(GROUPS)
+    unknown = [group for group in groups if group not in GROUPS]
+    if unknown:
+        parser.error(f"unknown groups: {', '.join(unknown)}")
+
+    results = {}
+    try:
+        for group in groups:
+            print(f"---BENCHMARK {group}---", flush=True)
+            results.update(GROUPS[group](args.quick))
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        baseline = harness.load(args.baseline)["results"]
+    harness.print_table(results, baseline)
+
+    meta = harness.metadata(quick=args.quick, groups=groups)
+    harness.save(args.output, meta, results)
+    print(f"Results saved to {args.output}")
+    if args.save_baseline:
+        harness.save(args.baseline, meta, results)
+        print(f"Baseline saved to {args.baseline}")
+
+    if baseline:
+        regressions = harness.compare(results, baseline, args.threshold)
+        for name, before, after, ratio in regressions:
+            print(f"REGRESSION {name}: {before * 1000:.3f} ms -> {after * 1000:.3f} ms ({ratio:.2f}x)")
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
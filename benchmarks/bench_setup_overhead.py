@@ -0,0 +1,48 @@
+"""
+Measures the setup overhead paid per chat message / per node visit.
+
+"before": the graph, the chains and the agent executors are rebuilt on every invocation.
+"after": they are fetched from the process wide registry.
+
+No LLM call is made, only the construction of the objects is measured.
+
+usage: python benchmarks/bench_setup_overhead.py [repetitions]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import registry  # noqa: E402
+from agent import build_app  # noqa: E402
+from states import create_project, generate_plan, handle_step, rework_code, test_step, validate_plan  # noqa: E402
+
+BUILDERS = {
+    "agent.app": build_app,
+    "generate_plan.generate_chain": generate_plan.build_generate_chain,
+    "generate_plan.regenerate_chain": generate_plan.build_regenerate_chain,
+    "validate_plan.chain": validate_plan.build_chain,
+    "create_project.agent_executor": create_project.build_agent_executor,
+    "handle_step.agent_executor": handle_step.build_agent_executor,
+    "test_step.agent_executor": test_step.build_agent_executor,
+    "rework_code.agent_executor": rework_code.build_agent_executor,
+}
+
+
+def main(repetitions):
+    print(f"{'object':<34}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    total_before = total_after = 0.0
+    for key, builder in BUILDERS.items():
+        before = timeit.timeit(builder, number=repetitions) / repetitions
+        registry.get_or_build(key, builder)
+        after = timeit.timeit(lambda: registry.get_or_build(key, builder), number=repetitions) / repetitions
+        total_before += before
+        total_after += after
+        print(f"{key:<34}{before * 1000:>14.3f}{after * 1000:>14.4f}{before / after:>9.0f}x")
+    print(f"{'total':<34}{total_before * 1000:>14.3f}{total_after * 1000:>14.4f}{total_before / total_after:>9.0f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,110 @@
+"""
+Timing, JSON results and baseline comparison shared by the benchmark scripts.
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def measure(func, repeat, setup=None):
+    """
+    Times a function.
+
+    Args:
+        func: The measured function, called with the value returned by setup
+        repeat (int): The number of timed calls
+        setup: Called before every timed call, untimed, e.g. to create a fresh venv
+
+    Returns:
+        dict: The min, median, mean and max durations in seconds and the number of calls
+    """
+    durations = []
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(argument) if setup is not None else func()
+        durations.append(time.perf_counter() - start)
+    return {
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.fmean(durations),
+        "max": max(durations),
+        "repeat": repeat,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def metadata(**extra):
+    """
+    Returns:
+        dict: Where the results come from: commit, python, platform, cpu count and time
+    """
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        **extra,
+    }
+
+
+def save(path, meta, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the median of every benchmark with the baseline.
+
+    Args:
+        results (dict): name -> measure() of the current run
+        baseline (dict): name -> measure() of the baseline run
+        threshold (float): The relative slowdown reported as a regression, e.g. 0.25 for 25%
+
+    Returns:
+        list[tuple[str, float, float, float]]: The regressions: name, baseline median, current median and ratio
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline or not baseline[name]["median"]:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        if ratio > 1 + threshold:
+            regressions.append((name, baseline[name]["median"], result["median"], ratio))
+    return regressions
+
+
+def print_table(results, baseline=None):
+    width = max([len(name) for name in results] + [9])
+    header = f"{'benchmark':<{width}}{'median (ms)':>14}{'min (ms)':>12}"
+    if baseline:
+        header += f"{'baseline (ms)':>16}{'change':>10}"
+    print(header)
+    for name, result in results.items():
+        line = f"{name:<{width}}{result['median'] * 1000:>14.3f}{result['min'] * 1000:>12.3f}"
+        if baseline and name in baseline and baseline[name]["median"]:
+            before = baseline[name]["median"]
+            line += f"{before * 1000:>16.3f}{(result['median'] / before - 1) * 100:>+9.1f}%"
+        print(line)
+    sys.stdout.flush()
@@ -1,17 +1,25 @@
-import os
+import asyncio
+import uuid
 
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import END, StateGraph
 from typing import Dict, TypedDict
 
 from states.prepare_next import prepare_next_step, decide_finished
-from states.rework_code import rework_code
-from states.test_step import test_step, decide_rework_code
-from states.create_project import create_project
-from states.handle_step import handle_step
-from states.generate_plan import generate_plan
-from states.validate_plan import validate_plan, decide_to_recreate_plan
+from states.rework_code import rework_code, arework_code
+from states.test_step import test_step, atest_step, decide_rework_code
+from states.create_project import create_project, acreate_project, discard_prefetched
+from states.handle_step import handle_step, ahandle_step
+from states.generate_plan import generate_plan, agenerate_plan
+from states.validate_plan import validate_plan, avalidate_plan, decide_to_recreate_plan
+from states.parallel_steps import parallel_steps, aparallel_steps, decide_step_mode, decide_after_parallel_steps
+from states.recover_step import recover_step, arecover_step, decide_after_recovery
+from registry import get_or_build
+from events import chunk_to_events, command_event, queued_event, run_event, RollingTranscript
+from checkpoints import fork_run, get_checkpointer, list_checkpoints, list_runs, restore_run_files, run_config
+from scheduler import SCHEDULER, session_workspace
+from telemetry import instrument_node
 
-os.environ['LANGCHAIN_TRACING_V2'] = 'true'
 
 class GraphState(TypedDict):
     """
@@ -50,16 +58,35 @@ def decide_done(state):
         return "generate_plan"
 
 
-async def coder_agent_model(input_str, history):
+def _node(name, func, afunc=None):
+    """
+    Returns:
+        RunnableLambda: The node, with its sync and async variants instrumented by the telemetry
+    """
+    return RunnableLambda(instrument_node(name, func), afunc=instrument_node(name, afunc))
+
+
+def build_app():
+    """
+    Builds and compiles the graph. The compiled graph is stateless, every run only receives its own inputs,
+    so it is built once per process and shared by all sessions. The nodes have an async variant, used by astream,
+    so that the LLM calls and the subprocesses of a session never block the event loop. The nodes are timed by the
+    telemetry when it is enabled.
+
+    Returns:
+        The compiled graph
+    """
     workflow = StateGraph(GraphState)
 
-    workflow.add_node("generate_plan", generate_plan)  # generation plan
-    workflow.add_node("validate_plan", validate_plan)  # validate plan
-    workflow.add_node("create_project", create_project)  # create the project folder and venv
-    workflow.add_node("handle_step", handle_step)  # handle a step in the plan
-    workflow.add_node("test_step", test_step)  # test the code
-    workflow.add_node("rework_code", rework_code)  # test the code
-    workflow.add_node("prepare_next_step", prepare_next_step)  # prepare for next step
+    workflow.add_node("generate_plan", _node("generate_plan", generate_plan, agenerate_plan))  # generation plan
+    workflow.add_node("validate_plan", _node("validate_plan", validate_plan, avalidate_plan))  # validate plan
+    workflow.add_node("create_project", _node("create_project", create_project, acreate_project))  # create the project folder and venv
+    workflow.add_node("handle_step", _node("handle_step", handle_step, ahandle_step))  # handle a step in the plan
+    workflow.add_node("test_step", _node("test_step", test_step, atest_step))  # test the code
+    workflow.add_node("rework_code", _node("rework_code", rework_code, arework_code))  # test the code
+    workflow.add_node("parallel_steps", _node("parallel_steps", parallel_steps, aparallel_steps))  # independent steps
+    workflow.add_node("recover_step", _node("recover_step", recover_step, arecover_step))  # non converging rework
+    workflow.add_node("prepare_next_step", _node("prepare_next_step", prepare_next_step))  # prepare for next step
 
 
     workflow.add_edge("generate_plan", "validate_plan")
@@ -71,16 +98,41 @@ async def coder_agent_model(input_str, history):
             "create_project": "create_project",
         },
     )
-    workflow.add_edge("create_project", "handle_step")
+    workflow.add_conditional_edges(
+        "create_project",
+        decide_step_mode,
+        {
+            "handle_step": "handle_step",
+            "parallel_steps": "parallel_steps",
+        },
+    )
+    workflow.add_conditional_edges(
+        "parallel_steps",
+        decide_after_parallel_steps,
+        {
+            "test_step": "test_step",
+            "prepare_next_step": "prepare_next_step",
+        },
+    )
     workflow.add_edge("handle_step", "test_step")
     workflow.add_conditional_edges(
         "test_step",
         decide_rework_code,
         {
             "rework_code": "rework_code",
+            "recover_step": "recover_step",
             "prepare_next_step": "prepare_next_step",
         },
     )
+    workflow.add_conditional_edges(
+        "recover_step",
+        decide_after_recovery,
+        {
+            "handle_step": "handle_step",
+            "parallel_steps": "parallel_steps",
+            "FINISH": END,
+        },
+    )
 
     workflow.add_edge("rework_code", "test_step")
 
@@ -89,78 +141,136 @@ async def coder_agent_model(input_str, history):
         decide_finished,
         {
             "handle_step": "handle_step",
+            "parallel_steps": "parallel_steps",
             "FINISH": END,
         },
     )
 
     workflow.set_entry_point("generate_plan")
 
-    # Compile
-    config = {"recursion_limit": 100}
-    app = workflow.compile()
+    return workflow.compile(checkpointer=get_checkpointer())
+
+
+async def _stream_run(inputs, run_id, session_id, checkpoint_id=None):
+    """
+    Runs the graph as a job of the session and converts its updates into events. With inputs = None the run
+    resumes from its checkpoint. A project still being prefetched when the run stops is discarded.
+    """
+    config = {"recursion_limit": 100, **run_config(run_id, checkpoint_id)}
+    app = get_or_build("agent.app", build_app)
+
+    yield run_event(run_id, resumed=inputs is None)
+    if SCHEDULER.jobs.would_wait():
+        yield queued_event(SCHEDULER.jobs.queue_depth)
+    async with SCHEDULER.job(session_id):
+        try:
+            async for chunk in app.astream(inputs, config=config):
+                for event in chunk_to_events(chunk):
+                    yield event
+        finally:
+            # The project prefetched during the planning is only left when the run stopped before create_project
+            await discard_prefetched(run_id)
+
+
+async def coder_agent_events(input_str, session_id="default"):
+    """
+    Runs the graph for a software description and streams one typed event per node update. The run is a job of
+    the scheduler: it waits for a session slot and creates its project in the workspace of the session. The state
+    is checkpointed after every node, see resume_agent_events.
+
+    Args:
+        input_str (str): The description of the software
+        session_id (str): The session the run belongs to
+
+    Yields:
+        Event: The events, as deltas
+    """
+    run_id = uuid.uuid4().hex
 
     # Construct the correct input structure
     inputs = {
         "keys": {
             "software_description": input_str,
+            "run_id": run_id,
+            "workspace_root": session_workspace(session_id),
             "iterations": 0
         }
     }
+    async for event in _stream_run(inputs, run_id, session_id):
+        yield event
+
+
+async def resume_agent_events(run_id, session_id="default", checkpoint_id=None):
+    """
+    Resumes a run from its last checkpoint, or from an earlier one, e.g. after a crash or a restart. The node that
+    was running when the run stopped runs again, the nodes before it are not. The files of the project are restored
+    to the given checkpoint.
+
+    Args:
+        run_id (str): The run
+        session_id (str): The session the run belongs to
+        checkpoint_id (str): The checkpoint to resume from, the last one by default
+
+    Yields:
+        Event: The events, as deltas
+    """
+    if checkpoint_id:
+        try:
+            await asyncio.to_thread(restore_run_files, run_id, checkpoint_id)
+        except ValueError as e:
+            yield command_event("Error", [str(e)])
+            return
+    async for event in _stream_run(None, run_id, session_id, checkpoint_id):
+        yield event
+
+
+def _command_events(input_str):
+    """
+    Handles the chat commands managing the checkpointed runs:
+    /runs, /checkpoints <run_id>, /resume <run_id> [checkpoint_id] and /fork <run_id> [checkpoint_id].
+
+    Returns:
+        tuple[str, str, list[Event]]: The run to resume and its checkpoint (or None), and the events to show
+    """
+    command, *arguments = input_str.split()
+    if command == "/runs":
+        lines = [f"{run['run_id']}  {run['last_checkpoint']}  {run['checkpoints']} checkpoints  {run['progress']}"
+                 for run in list_runs()]
+        return None, None, [command_event("Runs", lines or ["No checkpointed run"])]
+    if command == "/checkpoints" and arguments:
+        lines = [f"{checkpoint['checkpoint_id']}  {checkpoint['progress']}"
+                 for checkpoint in list_checkpoints(arguments[0])]
+        return None, None, [command_event(f"Checkpoints of {arguments[0]}", lines or ["No checkpoint"])]
+    if command == "/resume" and arguments:
+        return arguments[0], (arguments[1] if len(arguments) > 1 else None), []
+    if command == "/fork" and arguments:
+        run_id = fork_run(arguments[0], arguments[1] if len(arguments) > 1 else None)
+        return run_id, None, [command_event("Fork", [f"Forked {arguments[0]} into {run_id}"])]
+    return None, None, [command_event("Unknown command", [
+        "/runs, /checkpoints <run_id>, /resume <run_id> [checkpoint_id], /fork <run_id> [checkpoint_id]"
+    ])]
+
+
+async def coder_agent_model(input_str, history, session_id="default"):
+    """
+    Gradio entry point. Streams a bounded, rolling view of the events so that every update has the same size
+    however long the run gets. Messages starting with "/" are commands managing the checkpointed runs.
+    """
+    transcript = RollingTranscript()
+    if input_str.startswith("/"):
+        try:
+            run_id, checkpoint_id, events = _command_events(input_str)
+        except ValueError as e:
+            run_id, checkpoint_id, events = None, None, [command_event("Error", [str(e)])]
+        for event in events:
+            transcript.append(event)
+            yield transcript.render()
+        if run_id is None:
+            return
+        stream = resume_agent_events(run_id, session_id, checkpoint_id)
+    else:
+        stream = coder_agent_events(input_str, session_id)
 
-    output_lines = []
-    async for chunk in app.astream(inputs, config=config):
-        output_lines.append('\n')
-        if 'generate_plan' in chunk:
-            output_lines.extend(["___Generated Plan:___"])
-            output_lines.extend(["Project name: " + chunk['generate_plan']['keys']['project_name']])
-            output_lines.extend(chunk['generate_plan']['keys']['plan_steps'])
-
-        if 'validate_plan' in chunk:
-            output_lines.extend(["___Validate Plan:___"])
-            value = "OK" if chunk['validate_plan']['keys']['plan_ok'] else "not OK"
-            output_lines.extend([f"Plan is {value}"])
-            if chunk['validate_plan']['keys']['plan_feedback']:
-                output_lines.extend(["Feedback:"])
-                output_lines.extend([chunk['validate_plan']['keys']['plan_feedback']])
-
-        if 'create_project' in chunk:
-            output_lines.extend(["___Creating project:___"])
-            output_lines.extend(["Project folder: " + chunk['create_project']['keys']['project_folder']])
-            output_lines.extend(["Test folder: " + chunk['create_project']['keys']['test_folder']])
-            output_lines.extend(["Source folder: " + chunk['create_project']['keys']['source_folder']])
-            output_lines.extend(["Python path in venv: " + chunk['create_project']['keys']['python_path']])
-
-        if 'handle_step' in chunk:
-            output_lines.extend(["___Handel step:___"])
-            output_lines.extend([chunk['handle_step']['keys']['current_step']])
-            output_lines.extend(["Step description: "])
-            output_lines.extend([str(chunk['handle_step']['keys']['current_step_description'])])
-            output_lines.extend(["current requirements: " + str(chunk['handle_step']['keys']['requirements'])])
-
-        if 'test_step' in chunk:
-            output_lines.extend(["___Test step:___"])
-            output_lines.extend([chunk['test_step']['keys']['current_step']])
-            value = "OK" if chunk['test_step']['keys']['test_result'] else "not OK"
-            output_lines.extend([f"Test result: {value}"])
-            if chunk['test_step']['keys']['test_feedback']:
-                output_lines.extend(["Feedback:"])
-                output_lines.extend([chunk['test_step']['keys']['test_feedback']])
-
-        if 'rework_code' in chunk:
-            output_lines.extend(["___Rework code step:___"])
-            output_lines.extend([chunk['rework_code']['keys']['current_step']])
-            output_lines.extend(["Step description: "])
-            output_lines.extend([str(chunk['rework_code']['keys']['current_rework_description'])])
-            output_lines.extend(["current requirements: " + str(chunk['rework_code']['keys']['requirements'])])
-
-        if 'prepare_next_step' in chunk:
-            if len(chunk['prepare_next_step']['keys']['steps_todo']):
-                output_lines.extend(["___Preparing next step:___"])
-                output_lines.extend(["To do: "])
-                output_lines.extend([str(chunk['prepare_next_step']['keys']['steps_todo'])])
-                output_lines.extend(["Done: "])
-                output_lines.extend([str(chunk['prepare_next_step']['keys']['steps_done'])])
-            else:
-                output_lines.extend(["___Done___"])
-                output_lines.extend(["The program should now be ready :)"])
-        yield '\n'.join(output_lines)
+    async for event in stream:
+        transcript.append(event)
+        yield transcript.render()
@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import warnings
+
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+from langchain_core.load import dumps, loads
+from langchain_core.messages import AIMessageChunk, message_to_dict
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_openai import ChatOpenAI
+
+from config import CASSETTE_LATENCY, CASSETTE_MODE, CASSETTE_PATH, WORKSPACE_ROOT
+from registry import get_or_build
+
+CASSETTE_MODES = ("off", "record", "replay")
+# The folders of the sessions change from a run to another, they are replaced in the requests before hashing them
+_WORKSPACE_PATTERN = re.compile(re.escape(os.path.abspath(WORKSPACE_ROOT)) + r"/[^/\s'\"]+")
+
+
+class CassetteMissError(Exception):
+    """A request replayed from a cassette that doesn't contain it."""
+
+
+class Cassette:
+    """
+    The LLM requests of recorded runs and their responses, in a JSONL file. A request is identified by the hash of
+    its invocation parameters (model, temperature, bound functions or tools, stop words) and of its messages, so the
+    function call payloads are recorded and matched like the texts. When the same request was recorded several
+    times, the replays serve its responses in the recorded order, then the last one again.
+    """
+
+    def __init__(self, path, latency="0"):
+        self.path = path
+        self.latency = latency
+        self.recorded = 0
+        self.replayed = 0
+        self._interactions = {}
+        self._served = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        self._interactions.setdefault(interaction["fingerprint"], []).append(interaction)
+
+    def __len__(self):
+        return sum(len(interactions) for interactions in self._interactions.values())
+
+    @staticmethod
+    def request(llm, messages, stop, kwargs):
+        """
+        Returns:
+            dict: The request of a call as sent to the provider, with the folders of the sessions normalised
+        """
+        request = {
+            "params": llm._get_invocation_params(stop=stop, **kwargs),
+            "messages": [message_to_dict(message) for message in messages],
+        }
+        return json.loads(_WORKSPACE_PATTERN.sub("<workspace>", json.dumps(request, sort_keys=True, default=str)))
+
+    @staticmethod
+    def fingerprint(request):
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def record(self, request, result, duration):
+        """
+        Appends a call to the cassette.
+
+        Args:
+            request (dict): The request, see Cassette.request
+            result (ChatResult): The response
+            duration (float): The duration of the call in seconds
+        """
+        interaction = {
+            "fingerprint": self.fingerprint(request),
+            "request": request,
+            "generations": [dumps(generation) for generation in result.generations],
+            "llm_output": result.llm_output,
+            "duration": duration,
+        }
+        line = json.dumps(interaction, default=str)
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+            self._interactions.setdefault(interaction["fingerprint"], []).append(interaction)
+            self.recorded += 1
+
+    def replay(self, request):
+        """
+        Args:
+            request (dict): The request, see Cassette.request
+
+        Returns:
+            tuple[ChatResult, float]: The recorded response and the simulated latency in seconds
+        """
+        fingerprint = self.fingerprint(request)
+        with self._lock:
+            interactions = self._interactions.get(fingerprint)
+            if not interactions:
+                raise CassetteMissError(
+                    f"Request {fingerprint[:12]} ({len(request['messages'])} messages) is not in the cassette "
+                    f"{self.path}, record it again with LLM_CODER_CASSETTE=record"
+                )
+            index = self._served.get(fingerprint, 0)
+            self._served[fingerprint] = index + 1
+            self.replayed += 1
+        interaction = interactions[min(index, len(interactions) - 1)]
+        with warnings.catch_warnings():
+            # langchain_core.load.loads is flagged as beta
+            warnings.simplefilter("ignore")
+            generations = [loads(generation) for generation in interaction["generations"]]
+        return ChatResult(generations=generations, llm_output=interaction["llm_output"]), self._delay(interaction)
+
+    def _delay(self, interaction):
+        if self.latency == "recorded":
+            return interaction["duration"]
+        return float(self.latency)
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of recorded interactions, and of the calls recorded and replayed by the process
+        """
+        return {"interactions": len(self), "recorded": self.recorded, "replayed": self.replayed}
+
+
+def build_cassette():
+    if CASSETTE_MODE not in CASSETTE_MODES:
+        raise ValueError(f"LLM_CODER_CASSETTE must be one of {', '.join(CASSETTE_MODES)}, not {CASSETTE_MODE!r}")
+    if CASSETTE_MODE == "off":
+        return None
+    print(f"---LLM CASSETTE: {CASSETTE_MODE.upper()} {CASSETTE_PATH}---")
+    return Cassette(CASSETTE_PATH, CASSETTE_LATENCY)
+
+
+def get_cassette():
+    """
+    Returns:
+        Cassette: The cassette of the process, None when the calls are neither recorded nor replayed
+    """
+    return get_or_build("llm.cassette", build_cassette)
+
+
+def replaying():
+    return CASSETTE_MODE == "replay"
+
+
+def _replayed_chunk(result):
+    """
+    Returns:
+        ChatGenerationChunk: The recorded response as the single chunk of a streamed call
+    """
+    generation = result.generations[0]
+    message = AIMessageChunk(content=generation.message.content,
+                             additional_kwargs=generation.message.additional_kwargs)
+    return ChatGenerationChunk(message=message, generation_info=generation.generation_info)
+
+
+class CassetteChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI whose calls are recorded to the cassette, or replayed from it without calling the provider,
+    depending on LLM_CODER_CASSETTE. The streamed calls (e.g. of the agent executors) are recorded once complete
+    and replayed as a single chunk, with streaming=True _generate/_agenerate go through them.
+    """
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.streaming:
+            return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+        cassette = get_cassette()
+        if cassette is None:
+            return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        request = cassette.request(self, messages, stop, kwargs)
+        if replaying():
+            result, delay = cassette.replay(request)
+            time.sleep(delay)
+            return result
+        start = time.perf_counter()
+        result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        cassette.record(request, result, time.perf_counter() - start)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.streaming:
+            return await agenerate_from_stream(self._astream(messages, stop=stop, run_manager=run_manager, **kwargs))
+        cassette = get_cassette()
+        if cassette is None:
+            return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        request = cassette.request(self, messages, stop, kwargs)
+        if replaying():
+            result, delay = cassette.replay(request)
+            await asyncio.sleep(delay)
+            return result
+        start = time.perf_counter()
+        result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        await asyncio.to_thread(cassette.record, request, result, time.perf_counter() - start)
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        cassette = get_cassette()
+        if cassette is None:
+            yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return
+        request = cassette.request(self, messages, stop, kwargs)
+        if replaying():
+            result, delay = cassette.replay(request)
+            time.sleep(delay)
+            chunk = _replayed_chunk(result)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            return
+        start = time.perf_counter()
+        chunks = []
+        for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        cassette.record(request, generate_from_stream(iter(chunks)), time.perf_counter() - start)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        cassette = get_cassette()
+        if cassette is None:
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+            return
+        request = cassette.request(self, messages, stop, kwargs)
+        if replaying():
+            result, delay = cassette.replay(request)
+            await asyncio.sleep(delay)
+            chunk = _replayed_chunk(result)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            return
+        start = time.perf_counter()
+        chunks = []
+        async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        await asyncio.to_thread(cassette.record, request, generate_from_stream(iter(chunks)),
+                                time.perf_counter() - start)
@@ -0,0 +1,316 @@
+import asyncio
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import uuid
+
+from langgraph.checkpoint.base import CheckpointAt
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from config import CHECKPOINTS_ENABLED, CHECKPOINTS_PATH
+from registry import get_or_build
+from snapshot import is_ignored_dir
+from tools import venv_pool
+
+# The connection is shared by the sessions' threads and the event loop
+_lock = threading.RLock()
+# The files of the project at every checkpoint: the contents by hash in objects/, and one manifest per checkpoint
+FILES_DIR = os.path.join(".llm_coder", "checkpoints")
+
+
+def _manifest_path(project_folder, checkpoint_id):
+    return os.path.join(project_folder, FILES_DIR, "manifests", checkpoint_id.replace(":", "-") + ".json")
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(value, f)
+    os.replace(path + ".tmp", path)
+
+
+def save_files(project_folder, checkpoint_id):
+    """
+    Saves the files of the project (without its venv and the .llm_coder folder) for a checkpoint. Only the contents
+    that no checkpoint saved yet are stored, and only the files whose mtime or size changed are hashed again.
+
+    Args:
+        project_folder (str): The project folder
+        checkpoint_id (str): The checkpoint
+    """
+    store = os.path.join(project_folder, FILES_DIR)
+    objects = os.path.join(store, "objects")
+    os.makedirs(objects, exist_ok=True)
+    previous = _read_manifest(os.path.join(store, "latest.json")) or {}
+    manifest = {}
+    for root, dirs, names in os.walk(project_folder):
+        dirs[:] = sorted(d for d in dirs if not is_ignored_dir(d))
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            relative = os.path.relpath(path, project_folder)
+            stat = os.stat(path)
+            key = [stat.st_mtime_ns, stat.st_size]
+            entry = previous.get(relative)
+            if entry and entry[1:] == key:
+                digest = entry[0]
+            else:
+                with open(path, 'rb') as f:
+                    content = f.read()
+                digest = hashlib.sha256(content).hexdigest()
+                blob = os.path.join(objects, digest)
+                if not os.path.exists(blob):
+                    with open(blob + ".tmp", 'wb') as f:
+                        f.write(content)
+                    os.replace(blob + ".tmp", blob)
+            manifest[relative] = [digest, *key]
+    _write_json(_manifest_path(project_folder, checkpoint_id), manifest)
+    _write_json(os.path.join(store, "latest.json"), manifest)
+
+
+def restore_files(project_folder, checkpoint_id, destination=None):
+    """
+    Restores the files of the project saved for a checkpoint: the files that are not in the checkpoint are removed,
+    the venv and the .llm_coder folder are kept.
+
+    Args:
+        project_folder (str): The project folder holding the saved files
+        checkpoint_id (str): The checkpoint
+        destination (str): Where to restore the files, the project folder by default
+
+    Returns:
+        bool: Whether the files of the checkpoint were saved
+    """
+    manifest = _read_manifest(_manifest_path(project_folder, checkpoint_id))
+    if manifest is None:
+        return False
+    destination = destination or project_folder
+    for entry in os.scandir(destination):
+        if entry.is_dir(follow_symlinks=False):
+            if not is_ignored_dir(entry.name):
+                shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+    objects = os.path.join(project_folder, FILES_DIR, "objects")
+    for relative, (digest, *_) in manifest.items():
+        path = os.path.join(destination, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(os.path.join(objects, digest), path)
+    return True
+
+
+class SQLiteCheckpointer(SqliteSaver):
+    """
+    Saves the state of a graph run after every node in a local SQLite database. The runs are the threads of the
+    checkpointer and the checkpoints are identified by their timestamp (thread_ts).
+
+    The files of the project are saved with every checkpoint, see save_files, so that resuming or forking an
+    earlier checkpoint also gets the files as they were. The async methods, used by astream, run the SQLite calls
+    and the file copies in a worker thread.
+    """
+
+    at: CheckpointAt = CheckpointAt.END_OF_STEP
+
+    def get_tuple(self, config):
+        with _lock:
+            return super().get_tuple(config)
+
+    def list(self, config):
+        with _lock:
+            return iter(list(super().list(config)))
+
+    def put(self, config, checkpoint):
+        project_folder = _keys(checkpoint).get("project_folder")
+        if project_folder and os.path.isdir(project_folder):
+            # Before the checkpoint, every checkpoint in the database has its files
+            save_files(project_folder, checkpoint["ts"])
+        with _lock:
+            return super().put(config, checkpoint)
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config):
+        for checkpoint_tuple in await asyncio.to_thread(lambda: list(self.list(config))):
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint):
+        return await asyncio.to_thread(self.put, config, checkpoint)
+
+
+def build_checkpointer(path=CHECKPOINTS_PATH):
+    if path != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return SQLiteCheckpointer(conn=sqlite3.connect(path, check_same_thread=False))
+
+
+def get_checkpointer():
+    """
+    Returns:
+        SQLiteCheckpointer: The checkpointer of the process, None if the checkpoints are disabled
+    """
+    if not CHECKPOINTS_ENABLED:
+        return None
+    return get_or_build("checkpoints.saver", build_checkpointer)
+
+
+def run_config(run_id, checkpoint_id=None):
+    """
+    Returns:
+        dict: The configurable of a run, resuming from the given checkpoint or from the last one
+    """
+    configurable = {"thread_id": run_id}
+    if checkpoint_id:
+        configurable["thread_ts"] = checkpoint_id
+    return {"configurable": configurable}
+
+
+def _keys(checkpoint):
+    return checkpoint["channel_values"].get("keys") or {}
+
+
+def summarise_state(keys):
+    """
+    Returns:
+        str: A one line description of the progress of a run
+    """
+    if not keys:
+        return "not started"
+    parts = [keys.get("project_name") or keys.get("software_description", "")[:60]]
+    if "steps_done" in keys:
+        parts.append(f"{len(keys['steps_done'])}/{len(keys['plan_steps'])} steps done")
+    elif "plan_steps" in keys:
+        parts.append(f"plan of {len(keys['plan_steps'])} steps")
+    if "test_result" in keys:
+        parts.append("tests " + ("passed" if keys["test_result"] else "failed"))
+    return ", ".join(part for part in parts if part)
+
+
+def list_runs(limit=20):
+    """
+    Returns:
+        list[dict]: The most recent runs: run_id, number of checkpoints, last checkpoint and progress
+    """
+    checkpointer = get_checkpointer()
+    if checkpointer is None:
+        return []
+    with _lock, checkpointer.cursor(transaction=False) as cursor:
+        cursor.execute(
+            "SELECT thread_id, COUNT(*), MAX(thread_ts) FROM checkpoints GROUP BY thread_id "
+            "ORDER BY MAX(thread_ts) DESC LIMIT ?", (limit,)
+        )
+        rows = cursor.fetchall()
+    runs = []
+    for run_id, count, last in rows:
+        checkpoint = checkpointer.get(run_config(run_id, last))
+        runs.append({"run_id": run_id, "checkpoints": count, "last_checkpoint": last,
+                     "progress": summarise_state(_keys(checkpoint))})
+    return runs
+
+
+def list_checkpoints(run_id):
+    """
+    Returns:
+        list[dict]: The checkpoints of a run, the most recent first: checkpoint_id, parent and progress
+    """
+    checkpointer = get_checkpointer()
+    if checkpointer is None:
+        return []
+    return [
+        {
+            "checkpoint_id": checkpoint_tuple.config["configurable"]["thread_ts"],
+            "parent": checkpoint_tuple.parent_config["configurable"]["thread_ts"]
+            if checkpoint_tuple.parent_config else None,
+            "progress": summarise_state(_keys(checkpoint_tuple.checkpoint)),
+        }
+        for checkpoint_tuple in checkpointer.list(run_config(run_id))
+    ]
+
+
+def restore_run_files(run_id, checkpoint_id):
+    """
+    Restores the files of the project of a run to a checkpoint, before resuming the run from it.
+
+    Args:
+        run_id (str): The run
+        checkpoint_id (str): The checkpoint
+
+    Raises:
+        ValueError: If the checkpoint doesn't exist or its files were not saved
+    """
+    checkpointer = get_checkpointer()
+    if checkpointer is None:
+        raise ValueError("The checkpoints are disabled")
+    checkpoint_tuple = checkpointer.get_tuple(run_config(run_id, checkpoint_id))
+    if checkpoint_tuple is None:
+        raise ValueError(f"No checkpoint {checkpoint_id} for run {run_id}")
+    project_folder = _keys(checkpoint_tuple.checkpoint).get("project_folder")
+    if project_folder and not restore_files(project_folder, checkpoint_id):
+        raise ValueError(f"The files of checkpoint {checkpoint_id} of run {run_id} were not saved, it can't be "
+                         f"resumed")
+
+
+def _fork_project(project_folder, new_folder, checkpoint_id):
+    """
+    Copies the project, with its venv, into a new folder and restores the files of the checkpoint there.
+    """
+    if not os.path.isfile(_manifest_path(project_folder, checkpoint_id)):
+        raise ValueError(f"The files of checkpoint {checkpoint_id} were not saved, it can't be forked")
+    store = os.path.abspath(os.path.join(project_folder, FILES_DIR))
+    shutil.copytree(project_folder, new_folder, symlinks=True,
+                    ignore=lambda directory, names: [name for name in names
+                                                     if os.path.abspath(os.path.join(directory, name)) == store])
+    restore_files(project_folder, checkpoint_id, new_folder)
+    venv = os.path.join(new_folder, "venv")
+    if os.path.isdir(venv):
+        venv_pool.relocate(venv, os.path.abspath(os.path.join(project_folder, "venv")))
+
+
+def fork_run(run_id, checkpoint_id=None):
+    """
+    Starts a new run from a checkpoint of a run (its last one by default). The project is copied into a new folder
+    with its files as they were at the checkpoint, so the original run and its project are left unchanged.
+
+    Args:
+        run_id (str): The run to fork
+        checkpoint_id (str): The checkpoint to fork from
+
+    Returns:
+        str: The id of the new run, resume it to continue from the checkpoint
+    """
+    checkpointer = get_checkpointer()
+    if checkpointer is None:
+        raise ValueError("The checkpoints are disabled")
+    checkpoint_tuple = checkpointer.get_tuple(run_config(run_id, checkpoint_id))
+    if checkpoint_tuple is None:
+        raise ValueError(f"No checkpoint {checkpoint_id or ''} for run {run_id}")
+    new_run_id = uuid.uuid4().hex
+    # A deep copy, the new run must not share the state of the original
+    checkpoint = pickle.loads(pickle.dumps(checkpoint_tuple.checkpoint))
+    keys = checkpoint["channel_values"].get("keys")
+    if keys is not None:
+        keys["run_id"] = new_run_id
+        project_folder = keys.get("project_folder")
+        if project_folder:
+            new_folder = f"{project_folder}_fork_{new_run_id[:8]}"
+            _fork_project(project_folder, new_folder, checkpoint_tuple.config["configurable"]["thread_ts"])
+            # The folders and the python of the venv
+            for key, value in keys.items():
+                if isinstance(value, str) and (value == project_folder or value.startswith(project_folder + os.sep)):
+                    keys[key] = new_folder + value[len(project_folder):]
+            print(f"---FORKED PROJECT {project_folder} TO {new_folder}---")
+    checkpointer.put(run_config(new_run_id), checkpoint)
+    return new_run_id
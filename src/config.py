@@ -0,0 +1,147 @@
+import os
+
+
+def env_int(name, default):
+    """
+    Reads an integer setting from the environment.
+
+    Args:
+        name (str): The name of the environment variable
+        default (int): The value used when the variable is not set
+
+    Returns:
+        int: The setting
+    """
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+# Maximum number of lines and characters of the transcript sent to the UI on every update
+TRANSCRIPT_MAX_LINES = env_int("LLM_CODER_TRANSCRIPT_MAX_LINES", 200)
+TRANSCRIPT_MAX_CHARS = env_int("LLM_CODER_TRANSCRIPT_MAX_CHARS", 20000)
+
+# Files larger than this are not pasted into the prompts, and the whole snapshot of a folder is capped (in UTF-8
+# bytes). The snapshots of the SNAPSHOT_MAX_DIRECTORIES most recently rendered folders are kept in memory
+SNAPSHOT_MAX_FILE_BYTES = env_int("LLM_CODER_SNAPSHOT_MAX_FILE_BYTES", 100_000)
+SNAPSHOT_MAX_TOTAL_BYTES = env_int("LLM_CODER_SNAPSHOT_MAX_TOTAL_BYTES", 1_000_000)
+SNAPSHOT_MAX_DIRECTORIES = env_int("LLM_CODER_SNAPSHOT_MAX_DIRECTORIES", 32)
+
+# Python interpreter used to create the project venvs
+VENV_PYTHON = os.environ.get("LLM_CODER_VENV_PYTHON", "python")
+# Pool of pre-built venvs (with pip and pytest installed) cloned for the new projects, 0 disables it
+VENV_POOL_SIZE = env_int("LLM_CODER_VENV_POOL_SIZE", 2)
+VENV_POOL_DIR = os.environ.get("LLM_CODER_VENV_POOL_DIR", os.path.expanduser("~/.cache/llm_coder/venv_pool"))
+VENV_POOL_PACKAGES = os.environ.get("LLM_CODER_VENV_POOL_PACKAGES", "pip pytest").split()
+
+# Local wheel cache shared by all the projects, requirements are installed offline from it when possible
+WHEELHOUSE_DIR = os.environ.get("LLM_CODER_WHEELHOUSE_DIR", os.path.expanduser("~/.cache/llm_coder/wheelhouse"))
+
+# "direct" runs the test toolchain in code, "agent" lets an LLM agent call the tools
+TEST_STEP_MODE = os.environ.get("LLM_CODER_TEST_STEP_MODE", "direct")
+
+# "affected" only runs the tests affected by the changes since the last green run, "all" always runs everything
+TEST_SELECTION = os.environ.get("LLM_CODER_TEST_SELECTION", "all")
+# Number of selective runs after which the full suite runs again
+TEST_FULL_RUN_EVERY = env_int("LLM_CODER_TEST_FULL_RUN_EVERY", 5)
+
+# Number of pytest processes the test files are sharded across, 1 runs a single serial pytest process
+PYTEST_WORKERS = env_int("LLM_CODER_PYTEST_WORKERS", 1)
+# Suites with fewer test files than this always run in a single process
+PYTEST_SHARD_MIN_FILES = env_int("LLM_CODER_PYTEST_SHARD_MIN_FILES", 8)
+
+# Approximate maximum size in tokens of the failure digest given to rework_code
+DIGEST_TOKEN_BUDGET = env_int("LLM_CODER_DIGEST_TOKEN_BUDGET", 1500)
+
+# Folder in which the projects are created
+WORKSPACE_ROOT = os.environ.get("LLM_CODER_WORKSPACE_ROOT", os.path.expanduser("~/llm_coder_projects"))
+# "scaffold" creates the project layout in code, "agent" lets an LLM agent create it
+CREATE_PROJECT_MODE = os.environ.get("LLM_CODER_CREATE_PROJECT_MODE", "scaffold")
+
+# Persistent cache of the LLM responses, keyed on the model configuration, the bound tools and the prompt
+LLM_CACHE_ENABLED = os.environ.get("LLM_CODER_LLM_CACHE", "1") == "1"
+LLM_CACHE_PATH = os.environ.get("LLM_CODER_LLM_CACHE_PATH", os.path.expanduser("~/.cache/llm_coder/llm_cache.sqlite"))
+LLM_CACHE_TTL_SECONDS = env_int("LLM_CODER_LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600)
+LLM_CACHE_MAX_ENTRIES = env_int("LLM_CODER_LLM_CACHE_MAX_ENTRIES", 10000)
+# Skip the cache lookups (fresh responses are still stored)
+LLM_CACHE_BYPASS = os.environ.get("LLM_CODER_LLM_CACHE_BYPASS", "0") == "1"
+
+# Number of sessions whose graph runs at the same time, the other sessions wait in the job queue
+MAX_CONCURRENT_SESSIONS = env_int("LLM_CODER_MAX_CONCURRENT_SESSIONS", 4)
+# Number of LLM calls in flight at the same time, across all the sessions
+LLM_CONCURRENCY = env_int("LLM_CODER_LLM_CONCURRENCY", 4)
+# Number of CPU heavy subprocesses (venv creation, pip, pytest shards) running at the same time
+SUBPROCESS_CONCURRENCY = env_int("LLM_CODER_SUBPROCESS_CONCURRENCY", os.cpu_count() or 1)
+
+# Provider quota shared by all the sessions, 0 disables the corresponding limit
+LLM_REQUESTS_PER_MINUTE = env_int("LLM_CODER_LLM_REQUESTS_PER_MINUTE", 500)
+LLM_TOKENS_PER_MINUTE = env_int("LLM_CODER_LLM_TOKENS_PER_MINUTE", 150_000)
+# Completion tokens counted against the token quota for every call, on top of the prompt
+LLM_EXPECTED_COMPLETION_TOKENS = env_int("LLM_CODER_LLM_EXPECTED_COMPLETION_TOKENS", 1000)
+
+# Number of candidate plans generated and validated in parallel, the first accepted one is used. 1 generates and
+# validates a single plan at a time
+PLAN_CANDIDATES = env_int("LLM_CODER_PLAN_CANDIDATES", 1)
+# Sampling temperature of the extra candidates, the first candidate is always generated with temperature 0
+PLAN_CANDIDATE_TEMPERATURE = float(os.environ.get("LLM_CODER_PLAN_CANDIDATE_TEMPERATURE", "0.7"))
+
+# Start creating the project and its venv as soon as the first plan has a name, while the plan is validated
+PIPELINE_CREATE_PROJECT = os.environ.get("LLM_CODER_PIPELINE_CREATE_PROJECT", "1") == "1"
+
+# Maximum number of independent plan steps implemented at the same time, each in its own copy of the project.
+# 1 implements the steps one at a time
+PARALLEL_STEPS = env_int("LLM_CODER_PARALLEL_STEPS", 1)
+# Number of rework attempts of a step implemented in parallel before it falls back to the serial loop
+PARALLEL_STEP_MAX_REWORKS = env_int("LLM_CODER_PARALLEL_STEP_MAX_REWORKS", 2)
+
+# Number of most recent agent steps replayed verbatim to the model, the older ones are summarised in one message
+SCRATCHPAD_KEEP_STEPS = env_int("LLM_CODER_SCRATCHPAD_KEEP_STEPS", 4)
+# Maximum number of characters of a tool argument or result in the summary of the older steps
+SCRATCHPAD_SUMMARY_CHARS = env_int("LLM_CODER_SCRATCHPAD_SUMMARY_CHARS", 120)
+
+# Durable checkpoints of the graph runs, saved after every node, to resume or fork a run
+CHECKPOINTS_ENABLED = os.environ.get("LLM_CODER_CHECKPOINTS", "1") == "1"
+CHECKPOINTS_PATH = os.environ.get("LLM_CODER_CHECKPOINTS_PATH",
+                                  os.path.expanduser("~/.cache/llm_coder/checkpoints.sqlite"))
+
+# Local telemetry of the nodes, LLM calls, tool calls and subprocesses, disabled by default. The records are appended
+# to a JSONL file and the counters served in the Prometheus text format, on the loopback interface unless another
+# host is given, port 0 disables the metrics endpoint. The LangSmith tracing of LangChain is enabled separately with
+# LANGCHAIN_TRACING_V2=true
+TELEMETRY_ENABLED = os.environ.get("LLM_CODER_TELEMETRY", "0") == "1"
+TELEMETRY_JSONL_PATH = os.environ.get("LLM_CODER_TELEMETRY_JSONL",
+                                      os.path.expanduser("~/.cache/llm_coder/telemetry.jsonl"))
+TELEMETRY_METRICS_HOST = os.environ.get("LLM_CODER_METRICS_HOST", "127.0.0.1")
+TELEMETRY_METRICS_PORT = env_int("LLM_CODER_METRICS_PORT", 9464)
+# Prices in USD per 1000 prompt and completion tokens, to estimate the cost of the LLM calls
+LLM_PROMPT_PRICE_PER_1K = float(os.environ.get("LLM_CODER_LLM_PROMPT_PRICE_PER_1K", "0.01"))
+LLM_COMPLETION_PRICE_PER_1K = float(os.environ.get("LLM_CODER_LLM_COMPLETION_PRICE_PER_1K", "0.03"))
+
+# Record/replay of the LLM calls: "record" saves every request and its response to the cassette, "replay" serves
+# them back from it without calling the provider, "off" calls the provider. The response cache is not used when
+# recording or replaying, so that every call reaches the cassette
+CASSETTE_MODE = os.environ.get("LLM_CODER_CASSETTE", "off")
+CASSETTE_PATH = os.environ.get("LLM_CODER_CASSETTE_PATH", os.path.expanduser("~/.cache/llm_coder/cassette.jsonl"))
+# Simulated latency of a replayed call: a number of seconds, or "recorded" to wait as long as the recorded call took
+CASSETTE_LATENCY = os.environ.get("LLM_CODER_CASSETTE_LATENCY", "0")
+
+# What happens when the test/rework loop of a step doesn't converge. A failure (identified by the fingerprint of the
+# failing tests) seen REWORK_REPEAT_LIMIT times moves the step to the next action of REWORK_ESCALATION:
+#   escalate: the next reworks use a stronger prompt, and ESCALATION_MODEL if set
+#   rollback: the project is restored to its last green snapshot and the step is implemented again
+#   replan: the project is restored and the step is rewritten into smaller steps
+#   skip: the project is restored and the step is left out
+# The step is skipped once all the actions were used, or after REWORK_MAX_ATTEMPTS failed test runs
+REWORK_MAX_ATTEMPTS = env_int("LLM_CODER_REWORK_MAX_ATTEMPTS", 8)
+REWORK_REPEAT_LIMIT = env_int("LLM_CODER_REWORK_REPEAT_LIMIT", 2)
+REWORK_ESCALATION = [action.strip() for action in
+                     os.environ.get("LLM_CODER_REWORK_ESCALATION", "escalate,rollback,skip").split(",")
+                     if action.strip()]
+# Model of the escalated reworks, empty for the same model as the other calls
+ESCALATION_MODEL = os.environ.get("LLM_CODER_ESCALATION_MODEL", "")
+
+# Prompt prefix reuse: every prompt is compared with the last PROMPT_PREFIX_HISTORY prompts of its session, the
+# provider only caches the prefixes of at least PROMPT_PREFIX_MIN_TOKENS tokens. The reuse is measured when the
+# telemetry is enabled, and also printed for every call with PROMPT_PREFIX_DEBUG
+PROMPT_PREFIX_HISTORY = env_int("LLM_CODER_PROMPT_PREFIX_HISTORY", 8)
+PROMPT_PREFIX_MIN_TOKENS = env_int("LLM_CODER_PROMPT_PREFIX_MIN_TOKENS", 1024)
+PROMPT_PREFIX_DEBUG = os.environ.get("LLM_CODER_PROMPT_PREFIX_DEBUG", "0") == "1"
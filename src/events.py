@@ -0,0 +1,220 @@
+from collections import deque
+from typing import List, TypedDict
+
+from config import TRANSCRIPT_MAX_CHARS, TRANSCRIPT_MAX_LINES
+
+
+class Event(TypedDict):
+    """
+    A typed update emitted when a node of the graph finished.
+
+    Attributes:
+        type: The kind of update (run, command, queued, plan, validation,
+            project, step, test_result, rework, recovery, progress or done)
+        node: The node that produced the update
+        title: The title of the update
+        lines: The lines describing the update
+    """
+
+    type: str
+    node: str
+    title: str
+    lines: List[str]
+
+
+def _event(event_type, node, title, lines):
+    return Event(type=event_type, node=node, title=title, lines=lines)
+
+
+def node_to_event(node, keys):
+    """
+    Converts the state returned by a node into an event. Only the fields relevant to the node are read.
+
+    Args:
+        node (str): The name of the node
+        keys (dict): The state dict returned by the node
+
+    Returns:
+        Event: The event, or None if the node doesn't produce any
+    """
+    if node == "generate_plan":
+        return _event("plan", node, "Generated Plan", ["Project name: " + keys['project_name']] + keys['plan_steps'])
+
+    if node == "validate_plan":
+        value = "OK" if keys['plan_ok'] else "not OK"
+        lines = [f"Plan is {value}"]
+        if keys['plan_feedback']:
+            lines.extend(["Feedback:", keys['plan_feedback']])
+        return _event("validation", node, "Validate Plan", lines)
+
+    if node == "create_project":
+        return _event("project", node, "Creating project", [
+            "Project folder: " + keys['project_folder'],
+            "Test folder: " + keys['test_folder'],
+            "Source folder: " + keys['source_folder'],
+            "Python path in venv: " + keys['python_path'],
+        ])
+
+    if node == "handle_step":
+        return _event("step", node, "Handel step", [
+            keys['current_step'],
+            "Step description: ",
+            str(keys['current_step_description']),
+            "current requirements: " + str(keys['requirements']),
+        ])
+
+    if node == "parallel_steps":
+        lines = ["Implemented in parallel:"] + keys['current_steps'] + [
+            "Steps description: ",
+            str(keys['current_step_description']),
+        ]
+        if keys['deferred_steps']:
+            lines.extend(["Failed or conflicting, implemented one at a time:"] + keys['deferred_steps'])
+        return _event("step", node, "Parallel steps", lines)
+
+    if node == "test_step":
+        value = "OK" if keys['test_result'] else "not OK"
+        lines = [keys['current_step'], f"Test result: {value}"]
+        if keys['test_feedback']:
+            lines.extend(["Feedback:", keys['test_feedback']])
+        return _event("test_result", node, "Test step", lines)
+
+    if node == "rework_code":
+        return _event("rework", node, "Rework code step", [
+            keys['current_step'],
+            "Step description: ",
+            str(keys['current_rework_description']),
+            "current requirements: " + str(keys['requirements']),
+        ])
+
+    if node == "recover_step":
+        recovery = keys['recovery']
+        titles = {"rollback": "Step rolled back", "replan": "Step replanned", "skip": "Step skipped"}
+        lines = ["The tests kept failing the same way, the project was restored to its last green state."]
+        lines.extend(recovery['steps'])
+        if recovery['new_steps']:
+            lines.extend(["Replaced by:"] + recovery['new_steps'])
+        if recovery['action'] == "rollback":
+            lines.append("The step is implemented again.")
+        elif recovery['action'] == "skip" and not keys['steps_todo']:
+            lines.append("No step left to do, the run is over.")
+        return _event("recovery", node, titles[recovery['action']], lines)
+
+    if node == "prepare_next_step":
+        if len(keys['steps_todo']):
+            return _event("progress", node, "Preparing next step", [
+                "To do: ",
+                str(keys['steps_todo']),
+                "Done: ",
+                str(keys['steps_done']),
+            ])
+        lines = ["The program should now be ready :)"]
+        if keys.get('steps_skipped'):
+            lines.extend(["These steps were skipped, their tests kept failing:"] + keys['steps_skipped'])
+        return _event("done", node, "Done", lines)
+
+    return None
+
+
+def run_event(run_id, resumed=False):
+    """
+    Returns:
+        Event: The event emitted when a run starts, with the id needed to resume it
+    """
+    title = "Resuming run" if resumed else "Run"
+    return _event("run", "agent", title, [f"Run id: {run_id} (resume it with /resume {run_id})"])
+
+
+def command_event(title, lines):
+    """
+    Returns:
+        Event: The result of a chat command
+    """
+    return _event("command", "agent", title, lines)
+
+
+def queued_event(queue_depth):
+    """
+    Returns:
+        Event: The event emitted when a run has to wait for a session slot
+    """
+    return _event("queued", "scheduler", "Queued", [
+        f"All the session slots are busy, {queue_depth} run(s) ahead of this one. The run starts as soon as a slot "
+        f"is free."
+    ])
+
+
+def chunk_to_events(chunk):
+    """
+    Converts a chunk streamed by the graph into events.
+
+    Args:
+        chunk (dict): The chunk, mapping node names to the state they returned
+
+    Returns:
+        list[Event]: The events of the chunk
+    """
+    events = []
+    for node, value in chunk.items():
+        if not isinstance(value, dict) or "keys" not in value:
+            continue
+        event = node_to_event(node, value["keys"])
+        if event is not None:
+            events.append(event)
+    return events
+
+
+def render_event(event):
+    """
+    Renders an event as text.
+
+    Args:
+        event (Event): The event
+
+    Returns:
+        str: The rendered event
+    """
+    return '\n'.join(["", f"___{event['title']}:___"] + [str(line) for line in event['lines']])
+
+
+class RollingTranscript:
+    """
+    A bounded view of the last rendered events. Only the last lines are kept, so the memory used and the size of
+    the text sent to the UI on every update stay constant however long the run gets.
+    """
+
+    def __init__(self, max_lines=TRANSCRIPT_MAX_LINES, max_chars=TRANSCRIPT_MAX_CHARS):
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self.lines = deque(maxlen=max_lines)
+        self.chars = 0
+        self.dropped = 0
+
+    def append(self, event):
+        """
+        Adds an event to the view, dropping the oldest lines if needed.
+
+        Args:
+            event (Event): The event
+        """
+        for line in render_event(event).split('\n'):
+            line = line[-(self.max_chars - 1):]
+            if len(self.lines) == self.max_lines:
+                self._drop_oldest()
+            self.lines.append(line)
+            self.chars += len(line) + 1
+            while self.chars > self.max_chars:
+                self._drop_oldest()
+
+    def _drop_oldest(self):
+        self.chars -= len(self.lines.popleft()) + 1
+        self.dropped += 1
+
+    def render(self):
+        """
+        Returns:
+            str: The text of the view
+        """
+        if self.dropped:
+            return f"[... {self.dropped} earlier lines hidden ...]\n" + '\n'.join(self.lines)
+        return '\n'.join(self.lines)
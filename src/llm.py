@@ -1,2 +1,488 @@
-from langchain_openai import ChatOpenAI
-LLM = ChatOpenAI(temperature=0, model_name="gpt-4-turbo-preview", streaming=True)
\ No newline at end of file
+import asyncio
+import contextlib
+import contextvars
+import random
+import threading
+import time
+from typing import NamedTuple
+
+import openai
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+
+import telemetry
+from cassette import CassetteChatOpenAI, get_cassette, replaying
+from config import (CASSETTE_MODE, LLM_CACHE_ENABLED, LLM_EXPECTED_COMPLETION_TOKENS, LLM_REQUESTS_PER_MINUTE,
+                    LLM_TOKENS_PER_MINUTE, PROMPT_PREFIX_DEBUG, TELEMETRY_ENABLED)
+from llm_cache import SQLiteResponseCache
+from prompt_layout import PREFIX_TRACKER, serialise_request
+from scheduler import SCHEDULER, current_session
+
+# Rough number of characters per token, to estimate the size of a prompt without a tokenizer
+CHARS_PER_TOKEN = 4
+
+# The errors worth retrying: the provider is busy or unreachable, the request itself is fine
+TRANSIENT_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError)
+
+
+class RetryPolicy(NamedTuple):
+    """
+    How a node retries its LLM calls.
+
+    Attributes:
+        max_attempts: The maximum number of attempts of a call
+        base_delay: The delay before the first retry in seconds, doubled on every retry
+        max_delay: The maximum delay between two attempts in seconds
+        retry_output_errors: Also retry the whole chain when its output can't be used (e.g. it doesn't match the
+            expected pydantic model), not only the transient API errors
+    """
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    retry_output_errors: bool = False
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+RETRY_POLICIES = {
+    "generate_plan": RetryPolicy(max_attempts=3, retry_output_errors=True),
+    # The feedback loop with validate_plan already retries a bad plan
+    "regenerate_plan": RetryPolicy(max_attempts=3),
+    "validate_plan": RetryPolicy(max_attempts=3, retry_output_errors=True),
+    # The agents' calls are long, a late retry is cheaper than a restart of the node
+    "create_project": RetryPolicy(max_attempts=6, max_delay=120.0),
+    "handle_step": RetryPolicy(max_attempts=6, max_delay=120.0),
+    "test_step": RetryPolicy(max_attempts=6, max_delay=120.0),
+    "rework_code": RetryPolicy(max_attempts=6, max_delay=120.0),
+    "replan_step": RetryPolicy(max_attempts=3, retry_output_errors=True),
+}
+
+_current_policy = contextvars.ContextVar("llm_retry_policy", default=DEFAULT_POLICY)
+
+
+@contextlib.contextmanager
+def retry_policy(node):
+    """
+    Within this context the LLM calls retry with the policy of the given node.
+
+    Args:
+        node (str): The name of the node, see RETRY_POLICIES
+    """
+    token = _current_policy.set(RETRY_POLICIES.get(node, DEFAULT_POLICY))
+    try:
+        yield
+    finally:
+        _current_policy.reset(token)
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously up to a per minute capacity. A reservation takes its tokens immediately,
+    possibly going into debt, and tells the caller how long to wait before using them, so that the callers are
+    served in order.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Args:
+            amount (int): The number of tokens
+
+        Returns:
+            float: The number of seconds to wait before using the tokens
+        """
+        if self.capacity <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    Keeps the LLM calls of all the sessions within the requests and tokens per minute of the provider. A rate limit
+    error pauses every caller for the retry-after delay, not only the one that hit it.
+    """
+
+    def __init__(self, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.total_delay = 0.0
+
+    def reserve(self, tokens):
+        """
+        Returns:
+            float: The number of seconds to wait before sending a request of the given size
+        """
+        delay = max(self.requests.reserve(1), self.tokens.reserve(tokens), self.paused_until - time.monotonic())
+        if delay > 0:
+            self.throttled += 1
+            self.total_delay += delay
+        return delay
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, tokens):
+        """
+        Returns:
+            float: The number of seconds waited
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    async def aacquire(self, tokens):
+        """Async version of acquire."""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of throttled calls and the total time they waited in seconds
+        """
+        return {"throttled": self.throttled, "total_delay": self.total_delay}
+
+
+RATE_LIMITER = RateLimiter()
+
+
+def estimate_tokens(messages):
+    """
+    Returns:
+        int: The approximate number of tokens a call uses: its prompt and the expected completion
+    """
+    chars = sum(len(str(message.content)) + len(str(message.additional_kwargs)) for message in messages)
+    return chars // CHARS_PER_TOKEN + LLM_EXPECTED_COMPLETION_TOKENS
+
+
+def retry_after(error):
+    """
+    Returns:
+        float: The delay in seconds requested by the provider in the retry-after headers of the error, or None
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def backoff_delay(policy, attempt, error=None):
+    """
+    Returns:
+        float: The delay before the next attempt: the retry-after hint if any, otherwise an exponential backoff with
+        full jitter
+    """
+    hint = retry_after(error) if error is not None else None
+    if hint is not None:
+        return min(hint, policy.max_delay)
+    return random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1)))
+
+
+def _on_failure(policy, attempt, error):
+    """
+    Returns:
+        float: The delay before the next attempt, raises the error if it must not be retried
+    """
+    if not isinstance(error, TRANSIENT_ERRORS) or attempt >= policy.max_attempts:
+        raise error
+    delay = backoff_delay(policy, attempt, error)
+    if isinstance(error, openai.RateLimitError):
+        RATE_LIMITER.pause(delay)
+    print(f"---LLM CALL FAILED ({type(error).__name__}), RETRY {attempt}/{policy.max_attempts - 1} IN {delay:.1f}s---")
+    return delay
+
+
+class ScheduledChatOpenAI(CassetteChatOpenAI):
+    """
+    ChatOpenAI whose API calls go through the shared rate limiter and retry the transient errors with the policy of
+    the current node. The async calls also wait for a slot of the scheduler's LLM limiter. The cache hits don't
+    reach _generate/_agenerate, so they are never limited. The streamed calls (the agent executors stream their
+    LLM) are scheduled the same way in _stream/_astream, and with streaming=True _generate/_agenerate go through
+    them, a streamed call is only retried if it failed before its first chunk. Every call, streamed or not, is
+    recorded by the telemetry with its tokens, retries and prompt size. The calls replayed from a cassette are
+    neither limited nor retried.
+    """
+
+    def _generate(self, messages, *args, **kwargs):
+        if self.streaming:
+            # Scheduled by _stream
+            return generate_from_stream(self._stream(messages, *args, **kwargs))
+        prefix = observe_prefix(messages, kwargs)
+        if replaying():
+            with telemetry.span("llm", self.model_name, replayed=True, **prefix) as fields:
+                result = super()._generate(messages, *args, **kwargs)
+                if TELEMETRY_ENABLED:
+                    fields.update(call_usage(messages, result))
+            return result
+        policy = _current_policy.get()
+        tokens = estimate_tokens(messages)
+        attempt = 0
+        waited = 0.0
+        with telemetry.span("llm", self.model_name, **prefix) as fields:
+            while True:
+                waited += RATE_LIMITER.acquire(tokens)
+                try:
+                    result = super()._generate(messages, *args, **kwargs)
+                    break
+                except Exception as e:
+                    attempt += 1
+                    fields["retries"] = attempt
+                    delay = _on_failure(policy, attempt, e)
+                    waited += delay
+                    time.sleep(delay)
+            if TELEMETRY_ENABLED:
+                fields.update(call_usage(messages, result), retries=attempt, wait_seconds=waited)
+        return result
+
+    async def _agenerate(self, messages, *args, **kwargs):
+        if self.streaming:
+            # Scheduled by _astream
+            return await agenerate_from_stream(self._astream(messages, *args, **kwargs))
+        prefix = observe_prefix(messages, kwargs)
+        if replaying():
+            with telemetry.span("llm", self.model_name, replayed=True, **prefix) as fields:
+                result = await super()._agenerate(messages, *args, **kwargs)
+                if TELEMETRY_ENABLED:
+                    fields.update(call_usage(messages, result))
+            return result
+        policy = _current_policy.get()
+        tokens = estimate_tokens(messages)
+        attempt = 0
+        waited = 0.0
+        with telemetry.span("llm", self.model_name, **prefix) as fields:
+            while True:
+                waited += await RATE_LIMITER.aacquire(tokens)
+                try:
+                    async with SCHEDULER.llm.slot():
+                        result = await super()._agenerate(messages, *args, **kwargs)
+                    break
+                except Exception as e:
+                    attempt += 1
+                    fields["retries"] = attempt
+                    delay = _on_failure(policy, attempt, e)
+                    waited += delay
+                    await asyncio.sleep(delay)
+            if TELEMETRY_ENABLED:
+                fields.update(call_usage(messages, result), retries=attempt, wait_seconds=waited)
+        return result
+
+    def _stream(self, messages, *args, **kwargs):
+        prefix = observe_prefix(messages, kwargs)
+        if replaying():
+            with telemetry.span("llm", self.model_name, replayed=True, **prefix) as fields:
+                chunks = []
+                for chunk in super()._stream(messages, *args, **kwargs):
+                    chunks.append(chunk)
+                    yield chunk
+                if TELEMETRY_ENABLED:
+                    fields.update(call_usage(messages, generate_from_stream(iter(chunks))))
+            return
+        policy = _current_policy.get()
+        tokens = estimate_tokens(messages)
+        attempt = 0
+        waited = 0.0
+        with telemetry.span("llm", self.model_name, **prefix) as fields:
+            while True:
+                waited += RATE_LIMITER.acquire(tokens)
+                chunks = []
+                try:
+                    for chunk in super()._stream(messages, *args, **kwargs):
+                        chunks.append(chunk)
+                        yield chunk
+                    break
+                except Exception as e:
+                    # The chunks already streamed can't be taken back
+                    if chunks:
+                        raise
+                    attempt += 1
+                    fields["retries"] = attempt
+                    delay = _on_failure(policy, attempt, e)
+                    waited += delay
+                    time.sleep(delay)
+            if TELEMETRY_ENABLED:
+                fields.update(call_usage(messages, generate_from_stream(iter(chunks))), retries=attempt,
+                              wait_seconds=waited)
+
+    async def _astream(self, messages, *args, **kwargs):
+        prefix = observe_prefix(messages, kwargs)
+        if replaying():
+            with telemetry.span("llm", self.model_name, replayed=True, **prefix) as fields:
+                chunks = []
+                async for chunk in super()._astream(messages, *args, **kwargs):
+                    chunks.append(chunk)
+                    yield chunk
+                if TELEMETRY_ENABLED:
+                    fields.update(call_usage(messages, generate_from_stream(iter(chunks))))
+            return
+        policy = _current_policy.get()
+        tokens = estimate_tokens(messages)
+        attempt = 0
+        waited = 0.0
+        with telemetry.span("llm", self.model_name, **prefix) as fields:
+            while True:
+                waited += await RATE_LIMITER.aacquire(tokens)
+                chunks = []
+                try:
+                    async with SCHEDULER.llm.slot():
+                        async for chunk in super()._astream(messages, *args, **kwargs):
+                            chunks.append(chunk)
+                            yield chunk
+                    break
+                except Exception as e:
+                    # The chunks already streamed can't be taken back
+                    if chunks:
+                        raise
+                    attempt += 1
+                    fields["retries"] = attempt
+                    delay = _on_failure(policy, attempt, e)
+                    waited += delay
+                    await asyncio.sleep(delay)
+            if TELEMETRY_ENABLED:
+                fields.update(call_usage(messages, generate_from_stream(iter(chunks))), retries=attempt,
+                              wait_seconds=waited)
+
+
+def observe_prefix(messages, kwargs):
+    """
+    Measures the prefix the request shares with the recent requests of the session, see PrefixReuseTracker. Only
+    when the telemetry or PROMPT_PREFIX_DEBUG is enabled, the request isn't serialised otherwise.
+
+    Returns:
+        dict: prompt_chars, prefix_chars and prefix_cacheable, empty when the reuse isn't measured
+    """
+    if not TELEMETRY_ENABLED and not PROMPT_PREFIX_DEBUG:
+        return {}
+    prefix = PREFIX_TRACKER.observe(current_session.get(), serialise_request(messages, kwargs))
+    if PROMPT_PREFIX_DEBUG:
+        print(f"---PROMPT PREFIX: {prefix['prefix_chars']}/{prefix['prompt_chars']} chars shared with a recent "
+              f"prompt{'' if prefix['prefix_cacheable'] else ' (too short to be cached)'}---")
+    return prefix
+
+
+def call_usage(messages, result):
+    """
+    Measures an LLM call. The token counts reported by the provider are used when the response has them, the
+    streamed responses don't, then they are estimated from the length of the texts.
+
+    Args:
+        messages (list[BaseMessage]): The prompt
+        result (ChatResult): The response
+
+    Returns:
+        dict: prompt_bytes, prompt_tokens, completion_tokens, estimated_tokens and cost_usd
+    """
+    prompt_bytes = sum(len(str(message.content).encode()) + len(str(message.additional_kwargs).encode())
+                       for message in messages)
+    usage = (result.llm_output or {}).get("token_usage") or {}
+    prompt_tokens = usage.get("prompt_tokens")
+    completion_tokens = usage.get("completion_tokens")
+    estimated = prompt_tokens is None or completion_tokens is None
+    if prompt_tokens is None:
+        prompt_tokens = prompt_bytes // CHARS_PER_TOKEN
+    if completion_tokens is None:
+        completion_tokens = sum(
+            len(str(generation.message.content)) + len(str(generation.message.additional_kwargs))
+            for generation in result.generations
+        ) // CHARS_PER_TOKEN
+    return {
+        "prompt_bytes": prompt_bytes,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "estimated_tokens": estimated,
+        "cost_usd": telemetry.llm_cost(prompt_tokens, completion_tokens),
+    }
+
+
+def _on_output_error(policy, attempt, error):
+    # The transient errors reaching this point already used all their attempts in the LLM
+    if isinstance(error, TRANSIENT_ERRORS) or not policy.retry_output_errors or attempt >= policy.max_attempts:
+        raise error
+    print(f"Attempt {attempt} failed with error: {error}")
+    print(f"Retrying... Attempt {attempt + 1}/{policy.max_attempts}")
+
+
+def _with_telemetry_callbacks(kwargs):
+    """Adds the callbacks recording the tool calls to the config of an invoke, when the telemetry is enabled."""
+    if TELEMETRY_ENABLED and "config" not in kwargs:
+        kwargs["config"] = {"callbacks": telemetry.callbacks()}
+
+
+def invoke_with_policy(runnable, inputs, node, **kwargs):
+    """
+    Invokes a chain or an agent with the retry policy of a node. The transient API errors are retried by the LLM
+    itself, the errors of the chain (e.g. an invalid output) are retried here if the policy allows it.
+
+    Args:
+        runnable (Runnable): The chain or agent executor
+        inputs (dict): Its inputs
+        node (str): The name of the node, see RETRY_POLICIES
+        **kwargs: Passed to invoke
+
+    Returns:
+        The output of the runnable
+    """
+    policy = RETRY_POLICIES.get(node, DEFAULT_POLICY)
+    attempt = 0
+    _with_telemetry_callbacks(kwargs)
+    with retry_policy(node):
+        while True:
+            try:
+                return runnable.invoke(inputs, **kwargs)
+            except Exception as e:
+                attempt += 1
+                _on_output_error(policy, attempt, e)
+
+
+async def ainvoke_with_policy(runnable, inputs, node, **kwargs):
+    """Async version of invoke_with_policy."""
+    policy = RETRY_POLICIES.get(node, DEFAULT_POLICY)
+    attempt = 0
+    _with_telemetry_callbacks(kwargs)
+    with retry_policy(node):
+        while True:
+            try:
+                return await runnable.ainvoke(inputs, **kwargs)
+            except Exception as e:
+                attempt += 1
+                _on_output_error(policy, attempt, e)
+
+
+# The responses are cached when the cache is enabled, the calls made through invoke (e.g. the plan chains) use it.
+# A cache hit would never reach the cassette, so the cache is off while recording or replaying
+RESPONSE_CACHE = SQLiteResponseCache() if LLM_CACHE_ENABLED and CASSETTE_MODE == "off" else None
+
+telemetry.METRICS.register_collector("llm_rate_limiter", RATE_LIMITER.stats)
+telemetry.METRICS.register_collector("prompt_prefix", PREFIX_TRACKER.stats)
+if RESPONSE_CACHE is not None:
+    telemetry.METRICS.register_collector("llm_cache", RESPONSE_CACHE.stats)
+if get_cassette() is not None:
+    telemetry.METRICS.register_collector("llm_cassette", get_cassette().stats)
+
+# The retries are handled by ScheduledChatOpenAI on every path (invoke, stream and their async versions), not by the
+# openai client
+LLM = ScheduledChatOpenAI(temperature=0, model_name="gpt-4-turbo-preview", streaming=True, cache=RESPONSE_CACHE,
+                          max_retries=0)
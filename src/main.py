@@ -1,9 +1,24 @@
 import gradio as gr
+import telemetry
 from agent import coder_agent_model
+from tools import venv_pool
+
+
+async def chat(message, history, request: gr.Request):
+    """
+    Runs the agent for a chat message, as a job of the browser session that sent it.
+    """
+    async for update in coder_agent_model(message, history, request.session_hash):
+        yield update
+
 
 if __name__ == '__main__':
-    iface = gr.ChatInterface(coder_agent_model)
+    telemetry.start_metrics_server()
+    venv_pool.warm()
+    iface = gr.ChatInterface(chat)
+    # The scheduler bounds the concurrent runs, gradio doesn't need to serialize them
+    iface.queue(default_concurrency_limit=None)
     iface.launch()
 
 
-# import draft.test
\ No newline at end of file
+# import draft.test
@@ -0,0 +1,150 @@
+import collections
+import json
+import threading
+from typing import NamedTuple
+
+from config import PROMPT_PREFIX_HISTORY, PROMPT_PREFIX_MIN_TOKENS
+
+# How long the content of a section stays the same, the sections are laid out from the most to the least stable so
+# that the successive prompts of a session share the longest possible prefix, which the provider caches
+STATIC = 0  # the same for every call of the node, e.g. the instructions
+RUN = 1  # the same during the whole run, e.g. the software description and the folders
+STEP = 2  # the same during a step of the plan, e.g. the step and the steps done
+ITERATION = 3  # changes on every call, e.g. the files being edited and the test feedback
+
+# Rough number of characters per token, to compare the prefixes with the minimum size cached by the provider
+CHARS_PER_TOKEN = 4
+# Only the comparisons that reach this many equal characters are refined character by character
+_CHUNK = 4096
+
+
+class Section(NamedTuple):
+    """
+    A part of a prompt.
+
+    Attributes:
+        title: The heading of the section, empty for none
+        text: The content
+        stability: STATIC, RUN, STEP or ITERATION
+    """
+    title: str
+    text: str
+    stability: int
+
+
+def render_sections(sections):
+    """
+    Lays out the sections of a prompt from the most to the least stable, the sections of the same stability keep
+    their order. The rendering only depends on the sections, so the same sections always give the same bytes.
+
+    Args:
+        sections (list[Section]): The sections
+
+    Returns:
+        str: The prompt
+    """
+    blocks = []
+    for section in sorted(sections, key=lambda section: section.stability):
+        text = section.text.strip('\n')
+        if not text:
+            continue
+        blocks.append(f"## {section.title}\n{text}" if section.title else text)
+    return '\n\n'.join(blocks) + '\n'
+
+
+def common_prefix_length(first, second):
+    """
+    Returns:
+        int: The number of leading characters the two strings have in common
+    """
+    limit = min(len(first), len(second))
+    start = 0
+    # Whole chunks are compared by slices, which is much faster than a loop on the characters
+    while start + _CHUNK <= limit and first[start:start + _CHUNK] == second[start:start + _CHUNK]:
+        start += _CHUNK
+    low, high = start, min(start + _CHUNK, limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[start:middle] == second[start:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def serialise_request(messages, kwargs):
+    """
+    Returns:
+        str: The request as the provider sees it for its prefix cache: the bound functions or tools first, then the
+        messages in order
+    """
+    parts = [json.dumps(kwargs.get("functions") or kwargs.get("tools") or [], sort_keys=True)]
+    for message in messages:
+        extra = json.dumps(message.additional_kwargs, sort_keys=True) if message.additional_kwargs else ""
+        parts.append(f"{message.type}\0{message.content}\0{extra}")
+    return '\n'.join(parts)
+
+
+class PrefixReuseTracker:
+    """
+    Measures how much of every prompt repeats the beginning of a recent prompt of the same session, i.e. could be
+    served from the prompt cache of the provider.
+    """
+
+    def __init__(self, history=PROMPT_PREFIX_HISTORY, min_tokens=PROMPT_PREFIX_MIN_TOKENS, max_sessions=64):
+        self.history = history
+        self.min_chars = min_tokens * CHARS_PER_TOKEN
+        self.max_sessions = max_sessions
+        self.calls = 0
+        self.cacheable_calls = 0
+        self.prompt_chars = 0
+        self.reused_chars = 0
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, session, request):
+        """
+        Compares a request with the recent requests of its session and remembers it.
+
+        Args:
+            session (str): The session
+            request (str): The serialised request, see serialise_request
+
+        Returns:
+            dict: prompt_chars, prefix_chars (the longest prefix shared with a recent request) and prefix_cacheable
+            (whether it is long enough to be cached by the provider)
+        """
+        with self._lock:
+            recent = self._recent.pop(session, None) or collections.deque(maxlen=self.history)
+            self._recent[session] = recent
+            if len(self._recent) > self.max_sessions:
+                self._recent.popitem(last=False)
+            previous = list(recent)
+            recent.append(request)
+
+        prefix = max((common_prefix_length(request, other) for other in previous), default=0)
+        cacheable = prefix >= self.min_chars
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += len(request)
+            if cacheable:
+                self.cacheable_calls += 1
+                self.reused_chars += prefix
+        return {"prompt_chars": len(request), "prefix_chars": prefix, "prefix_cacheable": cacheable}
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of calls, how many had a cacheable prefix, and the share of the prompt characters in
+            the cacheable prefixes
+        """
+        return {
+            "calls": self.calls,
+            "cacheable_calls": self.cacheable_calls,
+            "prompt_chars": self.prompt_chars,
+            "reused_chars": self.reused_chars,
+            "reuse_ratio": self.reused_chars / self.prompt_chars if self.prompt_chars else 0.0,
+        }
+
+
+PREFIX_TRACKER = PrefixReuseTracker()
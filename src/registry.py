@@ -0,0 +1,38 @@
+import threading
+
+# Reentrant: a builder can get the objects it depends on from the registry
+_lock = threading.RLock()
+_registry = {}
+
+
+def get_or_build(key, builder):
+    """
+    Returns the object registered under the given key, building it on first use.
+
+    The registry is shared by every session of the process, so the builders must only create objects that are
+    parameterised by the per-call input (prompts, bound models, agent executors, compiled graphs).
+
+    Args:
+        key (str): The name of the registered object
+        builder (callable): A function without arguments that builds the object
+
+    Returns:
+        The registered object
+    """
+    try:
+        return _registry[key]
+    except KeyError:
+        pass
+
+    with _lock:
+        if key not in _registry:
+            _registry[key] = builder()
+        return _registry[key]
+
+
+def clear():
+    """
+    Drops every registered object so that they are rebuilt on next use (e.g. after the LLM was reconfigured).
+    """
+    with _lock:
+        _registry.clear()
@@ -0,0 +1,180 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import re
+import time
+from collections import OrderedDict, deque
+
+from config import LLM_CONCURRENCY, MAX_CONCURRENT_SESSIONS, SUBPROCESS_CONCURRENCY, WORKSPACE_ROOT
+
+# The session of the running job, inherited by the tasks and threads started by its graph run
+current_session = contextvars.ContextVar("current_session", default="default")
+
+
+class FairLimiter:
+    """
+    Limits the number of concurrent holders of a resource. When the resource is busy, the waiters are served round
+    robin between the sessions, so that a session queueing many requests can't starve the others.
+
+    The limiter also records its queue depth and the time spent waiting for a slot.
+    """
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.in_use = 0
+        self._waiters = OrderedDict()
+        self.acquired = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def would_wait(self):
+        return self.in_use >= self.capacity or bool(self._waiters)
+
+    async def acquire(self, session=None):
+        """
+        Waits for a slot.
+
+        Args:
+            session (str): The session the slot is acquired for, the current session by default
+        """
+        session = session or current_session.get()
+        start = time.monotonic()
+        if not self.would_wait():
+            self.in_use += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(session, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just before the cancellation
+                    self.release()
+                else:
+                    self._discard(session, future)
+                raise
+        self._record_wait(time.monotonic() - start)
+
+    def release(self):
+        """
+        Frees a slot, handing it over to the next waiting session if any.
+        """
+        while self._waiters:
+            session, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            if waiters:
+                # Round robin: the session goes to the back of the line
+                self._waiters.move_to_end(session)
+            else:
+                del self._waiters[session]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, session=None):
+        await self.acquire(session)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _discard(self, session, future):
+        waiters = self._waiters.get(session)
+        if waiters is None:
+            return
+        with contextlib.suppress(ValueError):
+            waiters.remove(future)
+        if not waiters:
+            del self._waiters[session]
+
+    def _record_wait(self, wait):
+        self.acquired += 1
+        if wait > 0.001:
+            self.waited += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        """
+        Returns:
+            dict: The capacity, the slots in use, the queue depth and the wait times in seconds
+        """
+        return {
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "queue_depth": self.queue_depth,
+            "waiting_sessions": len(self._waiters),
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "mean_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class Scheduler:
+    """
+    Schedules the graph runs of the sessions. The runs wait in a job queue for one of the session slots, and inside
+    a run the LLM calls and the CPU heavy subprocesses are bounded by their own limiters, shared by all the sessions.
+    """
+
+    def __init__(self, max_sessions=MAX_CONCURRENT_SESSIONS, llm_concurrency=LLM_CONCURRENCY,
+                 subprocess_concurrency=SUBPROCESS_CONCURRENCY):
+        self.jobs = FairLimiter("jobs", max_sessions)
+        self.llm = FairLimiter("llm", llm_concurrency)
+        self.subprocesses = FairLimiter("subprocesses", subprocess_concurrency)
+
+    @contextlib.asynccontextmanager
+    async def job(self, session_id):
+        """
+        Runs a job of the session: waits for a session slot, and makes session_id the current session of everything
+        the job starts.
+
+        Args:
+            session_id (str): The session
+        """
+        token = current_session.set(session_id)
+        try:
+            async with self.jobs.slot(session_id):
+                print(f"---JOB STARTED FOR SESSION {session_id}: {self.summary()}---")
+                yield
+        finally:
+            current_session.reset(token)
+
+    def summary(self):
+        """
+        Returns:
+            str: The queue depth and slots in use of every limiter, on one line
+        """
+        return ", ".join(
+            f"{limiter.name} {limiter.in_use}/{limiter.capacity} (queued {limiter.queue_depth}, "
+            f"mean wait {limiter.stats()['mean_wait']:.2f}s)"
+            for limiter in (self.jobs, self.llm, self.subprocesses)
+        )
+
+    def stats(self):
+        """
+        Returns:
+            dict: The statistics of the job, LLM and subprocess limiters
+        """
+        return {limiter.name: limiter.stats() for limiter in (self.jobs, self.llm, self.subprocesses)}
+
+
+def session_workspace(session_id, workspace_root=WORKSPACE_ROOT):
+    """
+    Returns:
+        str: The folder in which the projects of the session are created, so that sessions never share a project
+    """
+    name = re.sub(r"[^A-Za-z0-9_-]+", "_", session_id).strip("_") or "default"
+    return os.path.join(workspace_root, name)
+
+
+SCHEDULER = Scheduler()
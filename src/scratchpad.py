@@ -0,0 +1,48 @@
+from langchain.agents.format_scratchpad import format_to_openai_function_messages
+from langchain_core.messages import AIMessage
+
+from config import SCRATCHPAD_KEEP_STEPS, SCRATCHPAD_SUMMARY_CHARS
+
+
+def _shorten(value, max_chars):
+    text = str(value)
+    if len(text) <= max_chars:
+        return repr(text) if isinstance(value, str) else text
+    if isinstance(value, str):
+        lines = len(text.splitlines())
+        return f"<{len(text)} chars, {lines} lines>"
+    return text[:max_chars] + "..."
+
+
+def summarise_step(action, observation, max_chars=SCRATCHPAD_SUMMARY_CHARS):
+    """
+    Returns:
+        str: A one line summary of an agent step: the tool, its arguments (long values replaced by their size) and
+        the first line of its result
+    """
+    tool_input = action.tool_input if isinstance(action.tool_input, dict) else {"input": action.tool_input}
+    arguments = ", ".join(f"{name}={_shorten(value, max_chars)}" for name, value in tool_input.items())
+    lines = str(observation).strip().splitlines()
+    result = lines[0][:max_chars] if lines else ""
+    return f"- {action.tool}({arguments}) -> {result}"
+
+
+def compact_scratchpad(intermediate_steps, keep_steps=SCRATCHPAD_KEEP_STEPS):
+    """
+    Formats the agent scratchpad, replaying only the last steps verbatim. The older steps, whose tool calls carry
+    whole file contents, are summarised in a single message.
+
+    Args:
+        intermediate_steps (list[tuple[AgentAction, str]]): The steps of the agent so far
+        keep_steps (int): The number of most recent steps replayed verbatim
+
+    Returns:
+        list[BaseMessage]: The messages of the scratchpad
+    """
+    if len(intermediate_steps) <= keep_steps:
+        return format_to_openai_function_messages(intermediate_steps)
+    older = intermediate_steps[:len(intermediate_steps) - keep_steps]
+    recent = intermediate_steps[len(intermediate_steps) - keep_steps:]
+    summary = '\n'.join(summarise_step(action, observation) for action, observation in older)
+    return [AIMessage(content=f"Summary of my earlier actions:\n{summary}")] + \
+        format_to_openai_function_messages(recent)
@@ -0,0 +1,149 @@
+import collections
+import os
+import threading
+
+from config import SNAPSHOT_MAX_DIRECTORIES, SNAPSHOT_MAX_FILE_BYTES, SNAPSHOT_MAX_TOTAL_BYTES
+
+IGNORED_DIRS = {"__pycache__", ".pytest_cache", ".mypy_cache", ".ruff_cache", ".git", ".hg", ".tox", ".nox",
+                "venv", ".venv", ".llm_coder", "node_modules"}
+IGNORED_DIR_SUFFIXES = (".egg-info", ".dist-info")
+IGNORED_FILE_SUFFIXES = (".pyc", ".pyo", ".pyd", ".so", ".dll", ".dylib", ".o", ".a", ".zip", ".gz", ".tar",
+                         ".whl", ".png", ".jpg", ".jpeg", ".gif", ".ico", ".pdf", ".db", ".sqlite", ".sqlite3")
+BINARY_SNIFF_BYTES = 8192
+
+
+def is_ignored_dir(name):
+    return name in IGNORED_DIRS or name.endswith(IGNORED_DIR_SUFFIXES)
+
+
+def is_ignored_file(name):
+    return name.endswith(IGNORED_FILE_SUFFIXES)
+
+
+class ProjectSnapshot:
+    """
+    Renders the text files of a directory for the prompts.
+
+    The rendered block of every file is cached by (path, mtime, size, inode), so only the files that changed since
+    the previous call are read again. Cache folders, binary files and files over the size cap are left out.
+
+    The files are rendered from the least to the most recently modified: the files edited by the agents move to the
+    end, so the renderings of successive iterations share a long prefix, which the provider caches.
+    """
+
+    def __init__(self, directory, max_file_bytes=SNAPSHOT_MAX_FILE_BYTES, max_total_bytes=SNAPSHOT_MAX_TOTAL_BYTES):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.reads = 0
+
+    def _list_files(self):
+        """
+        Returns:
+            list[os.DirEntry]: The files of the directory that are not ignored, sorted by path
+        """
+        files = []
+        pending = [self.directory]
+        while pending:
+            current = pending.pop()
+            try:
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not is_ignored_dir(entry.name):
+                        pending.append(entry.path)
+                elif entry.is_file() and not is_ignored_file(entry.name):
+                    files.append(entry)
+        files.sort(key=lambda e: e.path)
+        return files
+
+    def _render_file(self, path, size):
+        """
+        Reads a file and renders its block.
+
+        Returns:
+            str: The block, or an empty string for binary files
+        """
+        self.reads += 1
+        if size > self.max_file_bytes:
+            return f"File: {path}\nContent omitted: the file has {size} bytes (limit {self.max_file_bytes})\n\n"
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            if b'\0' in data[:BINARY_SNIFF_BYTES]:
+                return ""
+            content = data.decode('utf-8')
+        except Exception as e:
+            # Handle cases where the file cannot be read
+            return f"Error reading {path}: {e}\n\n"
+        return f"File: {path}\nContent:\n{content}\n\n"
+
+    def render(self):
+        """
+        Returns:
+            str: The path and content of every file of the directory
+        """
+        with self._lock:
+            # (mtime, path, block) of the files kept, chosen in the order of the paths
+            blocks = []
+            entries = {}
+            total = 0
+            omitted = 0
+            for entry in self._list_files():
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                cached = self._entries.get(entry.path)
+                if cached is not None and cached[0] == key:
+                    block, size = cached[1], cached[2]
+                else:
+                    block = self._render_file(entry.path, stat.st_size)
+                    size = len(block.encode('utf-8', errors='replace'))
+                entries[entry.path] = (key, block, size)
+
+                if total + size > self.max_total_bytes:
+                    omitted += 1
+                    continue
+                total += size
+                blocks.append((stat.st_mtime_ns, entry.path, block))
+
+            # Files that disappeared are dropped from the cache
+            self._entries = entries
+            rendered = [block for _, _, block in sorted(blocks)]
+            if omitted:
+                rendered.append(f"[{omitted} more files omitted, the snapshot is limited to {self.max_total_bytes} "
+                                f"bytes]\n\n")
+            return ''.join(rendered)
+
+
+# directory -> snapshot, the least recently used first
+_snapshots = collections.OrderedDict()
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(directory, max_directories=SNAPSHOT_MAX_DIRECTORIES):
+    """
+    Returns the snapshot of a directory, shared by every caller of the process. Only the snapshots of the
+    max_directories most recently used directories are kept, with the content of their files.
+
+    Args:
+        directory (str): The path of the directory
+        max_directories (int): The number of snapshots kept
+
+    Returns:
+        ProjectSnapshot: The snapshot
+    """
+    directory = os.path.abspath(directory)
+    with _snapshots_lock:
+        snapshot = _snapshots.pop(directory, None) or ProjectSnapshot(directory)
+        _snapshots[directory] = snapshot
+        while len(_snapshots) > max_directories:
+            _snapshots.popitem(last=False)
+        return snapshot
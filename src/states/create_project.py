@@ -1,19 +1,24 @@
+import asyncio
 import json
+import os
+import re
+import shutil
 
 from langchain.agents import AgentExecutor
-from langchain.agents.format_scratchpad import format_to_openai_function_messages
 from langchain_core.agents import AgentFinish, AgentActionMessageLog
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.pydantic_v1 import BaseModel, Field
 
-from llm import LLM
+from llm import LLM, ainvoke_with_policy, invoke_with_policy
 
 from tools.file_tools import create_directory_tool
-from tools.venv_tools import create_virtual_env_tool
+from tools.venv_tools import create_virtual_env_tool, provision_virtual_env, aprovision_virtual_env
 from tools.file_tools import create_file_tool
+from tools import venv_pool
+from registry import get_or_build
+from scratchpad import compact_scratchpad
 
-WORKDIR = "/home/florent/Desktop/test_code_generator"
-
+from config import CREATE_PROJECT_MODE, PIPELINE_CREATE_PROJECT, WORKSPACE_ROOT
 
 
 class Project(BaseModel):
@@ -46,27 +51,230 @@ def parse(output):
         )
 
 
-def create_project(state):
+prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """You are senior python developer. Use the provided tools to accomplish the task given by the user.
+            """,
+        ),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+        ("user", "{input}"),
+    ]
+)
+
+
+def build_agent_executor():
+    """
+    Builds the agent executor used by create_project. It only depends on the per-call input so it is built once per
+    process and shared by all sessions.
+
+    Returns:
+        AgentExecutor: The agent executor
+    """
+    tools = [create_virtual_env_tool, create_directory_tool, create_file_tool]
+    llm_with_tools = LLM.bind_functions(tools + [Project])
+    agent = (
+            {
+                "input": lambda x: x["input"],
+                # Format agent scratchpad from intermediate steps, the older ones summarised
+                "agent_scratchpad": lambda x: compact_scratchpad(x["intermediate_steps"]),
+            }
+            | prompt
+            | llm_with_tools
+            | parse
+    )
+    return AgentExecutor(
+        agent=agent,
+        tools=tools,
+        verbose=True
+    )
+
+
+def curate_project_name(project_name):
+    """
+    Turns a project name into a folder name: lower case letters, digits and underscores.
+    """
+    name = re.sub(r"[^a-z0-9]+", "_", project_name.lower()).strip("_")
+    return name or "project"
+
+
+def _claim_folder(name, workspace_root):
+    """
+    Creates an empty folder named after the project, with a numeric suffix if the name is already taken.
+
+    Returns:
+        str: The folder
     """
-    create a folder for the project and a virtual environment in the folder for the project.
+    os.makedirs(workspace_root, exist_ok=True)
+    project_folder = os.path.join(workspace_root, name)
+    suffix = 1
+    while True:
+        try:
+            os.makedirs(project_folder)
+            return project_folder
+        except FileExistsError:
+            suffix += 1
+            project_folder = os.path.join(workspace_root, f"{name}_{suffix}")
+
+
+def _make_layout(project_name, workspace_root):
+    """
+    Creates the project folder (with a numeric suffix if the name is already taken), its pytest.ini and its "src"
+    and "tests" folders.
+
+    Returns:
+        tuple[str, str, str]: The project, source and test folders
+    """
+    project_folder = _claim_folder(curate_project_name(project_name), workspace_root)
+    with open(os.path.join(project_folder, "pytest.ini"), 'w') as f:
+        f.write("[pytest]\npythonpath = src\n")
+    source_folder = os.path.join(project_folder, "src")
+    test_folder = os.path.join(project_folder, "tests")
+    os.makedirs(source_folder)
+    os.makedirs(test_folder)
+    return project_folder, source_folder, test_folder
+
+
+def scaffold_project(project_name, workspace_root=WORKSPACE_ROOT):
+    """
+    Creates the project layout without any LLM call: a folder named after the project (with a numeric suffix if
+    the name is already taken), a pytest.ini with pythonpath = src, a venv, and the "src" and "tests" folders.
+
     Args:
-        state (dict): The state dict
+        project_name (str): The name of the project
+        workspace_root (str): The folder in which the project is created
 
     Returns:
-        state (dict): New key added to state
+        dict: The project_folder, source_folder, test_folder and python_path
     """
+    project_folder, source_folder, test_folder = _make_layout(project_name, workspace_root)
+    python_path = provision_virtual_env(os.path.join(project_folder, "venv"))
 
-    print("---CREATE PROJECT AND VENV---")
+    return {
+        "project_folder": project_folder,
+        "source_folder": source_folder,
+        "test_folder": test_folder,
+        "python_path": python_path,
+    }
 
-    ## State
-    state_dict = state["keys"]
-    iterations = state_dict["iterations"]
-    project_name = state_dict["project_name"]
 
+async def ascaffold_project(project_name, workspace_root=WORKSPACE_ROOT):
+    """Async version of scaffold_project, the project folder is removed if the venv creation fails or is cancelled."""
+    project_folder, source_folder, test_folder = _make_layout(project_name, workspace_root)
+    try:
+        python_path = await aprovision_virtual_env(os.path.join(project_folder, "venv"))
+    except BaseException:
+        shutil.rmtree(project_folder, ignore_errors=True)
+        raise
+
+    return {
+        "project_folder": project_folder,
+        "source_folder": source_folder,
+        "test_folder": test_folder,
+        "python_path": python_path,
+    }
+
+
+def _project_folders(project_folder):
+    return {
+        "project_folder": project_folder,
+        "source_folder": os.path.join(project_folder, "src"),
+        "test_folder": os.path.join(project_folder, "tests"),
+        "python_path": os.path.join(project_folder, "venv", "bin", "python"),
+    }
+
+
+def rename_project(result, project_name, workspace_root=WORKSPACE_ROOT):
+    """
+    Gives a scaffolded project the folder of another project name, e.g. when the plan was regenerated after the
+    project was created. The venv is relocated to its new path.
+
+    Args:
+        result (dict): The folders of the project, as returned by scaffold_project
+        project_name (str): The new name of the project
+        workspace_root (str): The folder in which the project was created
+
+    Returns:
+        dict: The new project_folder, source_folder, test_folder and python_path
+    """
+    name = curate_project_name(project_name)
+    old_folder = result["project_folder"]
+    if re.fullmatch(rf"{re.escape(name)}(_\d+)?", os.path.basename(old_folder)):
+        return result
+    new_folder = _claim_folder(name, workspace_root)
+    # The claimed folder is empty, rename replaces it
+    os.rename(old_folder, new_folder)
+    venv_pool.relocate(os.path.join(new_folder, "venv"), os.path.abspath(os.path.join(old_folder, "venv")))
+    print(f"---RENAMED PROJECT {old_folder} TO {new_folder}---")
+    return _project_folders(new_folder)
+
+
+# run_id -> the scaffolding started as soon as the plan had a name, see prefetch_project
+_prefetched = {}
+
+
+def prefetch_project(state_dict):
+    """
+    Starts scaffolding the project in the background as soon as the plan has a name, so that the venv is created
+    while the plan is being validated. create_project then reuses it, renamed if the plan was regenerated with
+    another name. Only the first plan of a run starts a prefetch, and only in the pipelined scaffold mode.
+
+    Must be called from the event loop running the graph.
+
+    Args:
+        state_dict (dict): The state dict, with the run_id and the project_name
+    """
+    run_id = state_dict.get("run_id")
+    if not PIPELINE_CREATE_PROJECT or CREATE_PROJECT_MODE != "scaffold" or run_id is None or run_id in _prefetched:
+        return
+    print("---PREFETCH PROJECT AND VENV---")
+    workspace_root = state_dict.get("workspace_root", WORKSPACE_ROOT)
+    _prefetched[run_id] = asyncio.ensure_future(ascaffold_project(state_dict["project_name"], workspace_root))
+
+
+async def _take_prefetched(state_dict, workspace_root):
+    """
+    Returns:
+        dict: The prefetched project named after the current plan, or None if there is none or it failed
+    """
+    task = _prefetched.pop(state_dict.get("run_id"), None)
+    if task is None:
+        return None
+    try:
+        result = await task
+    except Exception as e:
+        print(f"---PREFETCH FAILED: {e}---")
+        return None
+    return await asyncio.to_thread(rename_project, result, state_dict["project_name"], workspace_root)
+
+
+async def discard_prefetched(run_id):
+    """
+    Cancels the prefetch of a run that create_project didn't take, e.g. because the run failed or was cancelled
+    before, and removes its project folder.
+
+    Args:
+        run_id (str): The run
+    """
+    task = _prefetched.pop(run_id, None)
+    if task is None:
+        return
+    task.cancel()
+    try:
+        result = await task
+    except (asyncio.CancelledError, Exception):
+        # ascaffold_project removed its folder
+        return
+    print(f"---DISCARD PREFETCHED PROJECT {result['project_folder']}---")
+    await asyncio.to_thread(shutil.rmtree, result["project_folder"], True)
+
+
+def _agent_input(project_name, workspace_root):
     ## Prompt
-    user_input = f"""
+    return f"""
     This is the name of the project: {project_name}. The folder name should be curated.
-    This is the location where you should create a folder for the project: {WORKDIR}
+    This is the location where you should create a folder for the project: {workspace_root}
 
     1. Create a single folder for the project using the project name
     2. Create a pytest.ini file at the root of the project with pythonpath = src.
@@ -76,43 +284,29 @@ def create_project(state):
     6. Return the result as a pydantic object
     
         """
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                """You are senior python developer. Use the provided tools to accomplish the task given by the user.
-                """,
-            ),
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-            ("user", user_input),
-        ]
-    )
 
-    # Tools
-    tools = [create_virtual_env_tool, create_directory_tool, create_file_tool, Project]
-    llm_with_tools = LLM.bind_functions(tools)
-    agent = (
-            {
-                "input": lambda x: x["input"],
-                # Format agent scratchpad from intermediate steps
-                "agent_scratchpad": lambda x: format_to_openai_function_messages(
-                    x["intermediate_steps"]
-                ),
-            }
-            | prompt
-            | llm_with_tools
-            | parse
-    )
-    agent_executor = AgentExecutor(
-        agent=agent,
-        tools=[create_virtual_env_tool, create_directory_tool, create_file_tool],
-        verbose=True
-    )
 
-    result = agent_executor.invoke({"input": ""}, return_only_outputs=True)
+def create_project_with_agent(project_name, workspace_root=WORKSPACE_ROOT):
+    """
+    Lets an agent create the project layout.
 
-    iterations = iterations + 1
-    state_dict["iterations"] = iterations
+    Returns:
+        dict: The project_folder, source_folder, test_folder and python_path
+    """
+    agent_executor = get_or_build("create_project.agent_executor", build_agent_executor)
+    inputs = {"input": _agent_input(project_name, workspace_root)}
+    return invoke_with_policy(agent_executor, inputs, "create_project", return_only_outputs=True)
+
+
+async def acreate_project_with_agent(project_name, workspace_root=WORKSPACE_ROOT):
+    """Async version of create_project_with_agent."""
+    agent_executor = get_or_build("create_project.agent_executor", build_agent_executor)
+    inputs = {"input": _agent_input(project_name, workspace_root)}
+    return await ainvoke_with_policy(agent_executor, inputs, "create_project", return_only_outputs=True)
+
+
+def _apply_result(state_dict, result):
+    state_dict["iterations"] = state_dict["iterations"] + 1
     state_dict["project_folder"] = result["project_folder"]
     state_dict["source_folder"] = result["source_folder"]
     state_dict["test_folder"] = result["test_folder"]
@@ -122,3 +316,44 @@ def create_project(state):
     return {
         "keys": state_dict
     }
+
+
+def create_project(state):
+    """
+    create a folder for the project and a virtual environment in the folder for the project, directly (default) or
+    through an agent (CREATE_PROJECT_MODE = "agent"). The project is created in the workspace of the session.
+    Args:
+        state (dict): The state dict
+
+    Returns:
+        state (dict): New key added to state
+    """
+
+    print("---CREATE PROJECT AND VENV---")
+    state_dict = state["keys"]
+    project_name = state_dict["project_name"]
+    workspace_root = state_dict.get("workspace_root", WORKSPACE_ROOT)
+
+    if CREATE_PROJECT_MODE == "agent":
+        result = create_project_with_agent(project_name, workspace_root)
+    else:
+        result = scaffold_project(project_name, workspace_root)
+
+    return _apply_result(state_dict, result)
+
+
+async def acreate_project(state):
+    """Async version of create_project."""
+    print("---CREATE PROJECT AND VENV---")
+    state_dict = state["keys"]
+    project_name = state_dict["project_name"]
+    workspace_root = state_dict.get("workspace_root", WORKSPACE_ROOT)
+
+    if CREATE_PROJECT_MODE == "agent":
+        result = await acreate_project_with_agent(project_name, workspace_root)
+    else:
+        result = await _take_prefetched(state_dict, workspace_root)
+        if result is None:
+            result = await ascaffold_project(project_name, workspace_root)
+
+    return _apply_result(state_dict, result)
@@ -0,0 +1,129 @@
+import os
+import shutil
+
+from config import REWORK_ESCALATION, REWORK_MAX_ATTEMPTS, REWORK_REPEAT_LIMIT
+from snapshot import is_ignored_dir
+
+ESCALATION_ACTIONS = ("escalate", "rollback", "replan", "skip")
+# The copy of the project taken when its tests last passed, the folder is ignored by the snapshots
+GREEN_DIR = os.path.join(".llm_coder", "green")
+
+_unknown = [action for action in REWORK_ESCALATION if action not in ESCALATION_ACTIONS]
+if _unknown:
+    raise ValueError(f"LLM_CODER_REWORK_ESCALATION only accepts {', '.join(ESCALATION_ACTIONS)}, not "
+                     f"{', '.join(_unknown)}")
+
+
+def track_test_result(state_dict, passed, fingerprint):
+    """
+    Records the result of a test run of the current step and decides what to do next:
+    - "rework": fix the code
+    - "escalate": fix the code with the stronger prompt / model
+    - "rollback", "replan" or "skip", see REWORK_ESCALATION
+
+    The step moves to the next action of REWORK_ESCALATION when the same failure was seen REWORK_REPEAT_LIMIT times
+    since its last move, and is skipped after REWORK_MAX_ATTEMPTS failed runs.
+
+    Args:
+        state_dict (dict): The state dict, its "failure_tracking" and "failure_action" keys are updated
+        passed (bool): Whether the tests passed
+        fingerprint (str): The fingerprint of the failures, see failure_fingerprint
+    """
+    if passed:
+        state_dict["failure_action"] = None
+        return
+
+    step = state_dict.get("current_step")
+    tracking = state_dict.get("failure_tracking")
+    if not tracking or tracking["step"] != step:
+        tracking = {"step": step, "attempts": 0, "level": 0, "fingerprints": [], "escalated": False, "fixes": []}
+    # A new dict, the parallel branches share the tracking of the state they were copied from
+    tracking = dict(tracking, attempts=tracking["attempts"] + 1,
+                    fingerprints=tracking["fingerprints"] + [fingerprint])
+
+    action = "escalate" if tracking["escalated"] else "rework"
+    if tracking["attempts"] >= REWORK_MAX_ATTEMPTS:
+        print(f"---{tracking['attempts']} FAILED TEST RUNS FOR THE STEP---")
+        action = "skip"
+    elif tracking["fingerprints"].count(fingerprint) >= REWORK_REPEAT_LIMIT:
+        print(f"---SAME FAILURE {REWORK_REPEAT_LIMIT} TIMES: THE REWORK IS NOT CONVERGING---")
+        tracking["level"] += 1
+        tracking["fingerprints"] = []
+        action = REWORK_ESCALATION[tracking["level"] - 1] if tracking["level"] <= len(REWORK_ESCALATION) else "skip"
+        if action == "escalate":
+            tracking["escalated"] = True
+
+    state_dict["failure_tracking"] = tracking
+    state_dict["failure_action"] = action
+
+
+def note_rework(state_dict, description):
+    """Remembers the fixes tried for the current step, they are listed in the escalated prompt."""
+    tracking = state_dict.get("failure_tracking")
+    if tracking:
+        state_dict["failure_tracking"] = dict(tracking, fixes=tracking["fixes"] + [description])
+
+
+def escalation_context(state_dict):
+    """
+    Returns:
+        str: The part of the rework prompt describing the fixes that didn't work, empty unless the step escalated
+    """
+    tracking = state_dict.get("failure_tracking")
+    if not tracking or not tracking["escalated"]:
+        return ""
+    fixes = '\n'.join(f"- {fix}" for fix in tracking["fixes"][-5:]) or "- (no description)"
+    return f"""
+The previous fixes did not work, the tests failed {tracking['attempts']} times, repeatedly with the same errors.
+These fixes were already tried:
+{fixes}
+Do not repeat them. Find the root cause of the failure before changing anything: re-read the code involved, check
+the imports, the names and the signatures used by the tests. If a test contradicts the task, fix the test instead.
+"""
+
+
+def _copy_project(source, destination):
+    shutil.copytree(source, destination, symlinks=True, dirs_exist_ok=True,
+                    ignore=lambda directory, names: [name for name in names if is_ignored_dir(name)])
+
+
+def save_green(state_dict):
+    """
+    Copies the project (without its venv and the .llm_coder folder) as its last green snapshot, with the
+    requirements of the state.
+    """
+    project_folder = state_dict["project_folder"]
+    green = os.path.join(project_folder, GREEN_DIR)
+    shutil.rmtree(green, ignore_errors=True)
+    _copy_project(project_folder, green)
+    state_dict["green_requirements"] = sorted(state_dict.get("requirements") or [])
+
+
+def ensure_green(state_dict):
+    """Takes the first green snapshot of the project, before its first step, when there is none yet."""
+    if not os.path.isdir(os.path.join(state_dict["project_folder"], GREEN_DIR)):
+        save_green(state_dict)
+
+
+def restore_green(state_dict):
+    """
+    Restores the project and its requirements to the last green snapshot: the files that are not in the snapshot
+    are removed, the venv and the .llm_coder folder are kept.
+
+    Returns:
+        bool: Whether there was a snapshot to restore
+    """
+    project_folder = state_dict["project_folder"]
+    green = os.path.join(project_folder, GREEN_DIR)
+    if not os.path.isdir(green):
+        print("---NO GREEN SNAPSHOT TO RESTORE---")
+        return False
+    for entry in os.scandir(project_folder):
+        if entry.is_dir(follow_symlinks=False):
+            if not is_ignored_dir(entry.name):
+                shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+    _copy_project(green, project_folder)
+    state_dict["requirements"] = set(state_dict.get("green_requirements") or [])
+    return True
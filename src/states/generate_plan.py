@@ -1,9 +1,17 @@
+import asyncio
+import functools
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from operator import itemgetter
 from langchain.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain.output_parsers.openai_tools import PydanticToolsParser
 
-from llm import LLM
+from llm import LLM, ainvoke_with_policy, invoke_with_policy
+from registry import get_or_build
+from config import PLAN_CANDIDATE_TEMPERATURE, PLAN_CANDIDATES
+from states import validate_plan
+from states.create_project import prefetch_project
+from states.parallel_steps import normalise_dependencies
 
 
 class Plan(BaseModel):
@@ -11,38 +19,34 @@ class Plan(BaseModel):
     description: str = Field(description="Description of the problem and approach")
     steps: list[str] = Field(description="A list of steps that need to be taken to solve the problem")
     project_name: str = Field(description="A suitable name for the project based on the description")
+    dependencies: list[list[int]] = Field(default=[], description="For every step, in order, the indices (starting "
+                                                                  "at 0) of the earlier steps it builds upon")
 
 
-def generate_plan(state):
-    """
-    Generate a plan to develop a software step by step
-
-    Args:
-        state (dict): The state dict
-
-    Returns:
-        state (dict): New key added to state
-    """
-
-    ## State
-    state_dict = state["keys"]
-    software_description = state_dict["software_description"]
-    iterations = state_dict["iterations"]
+GENERATE_TEMPLATE = """"As a python software architect, you will receive specifications or requirements for a software project. 
+        Your primary task is to decompose the overall problem into manageable, executable steps or sub-problems. 
+        Each step should be designed in such a way that, upon completion, the software is in a functional state, 
+        even if it does not yet include all the planned features or capabilities. Each step should add or change code.
 
-    ## LLM
-    llm_with_tool = LLM.bind_tools([Plan])
+        Please follow these guidelines when breaking down the software project:
+        1. Identify Key Components: Determine the core components or modules that make up the software system. 
+            These components should reflect major functional areas of the software.
+        2. Sequential Steps: Organize the development process into sequential steps. 
+            Each step should focus on implementing a specific component or enhancing the software's functionality progressively.
+        3. Ensure Functionality at Each Stage: Design each step so that the software remains operational and can perform a 
+            subset of its intended functions after the step is completed.
+        4. Dependencies: For every step, list the earlier steps it builds upon. Steps that don't depend on each other
+            can be implemented at the same time.
 
-    # Parser
-    parser_tool = PydanticToolsParser(tools=[Plan])
+        Here is the description of the software project you will be working on: 
+        {software_description}
 
-    ## Generation
-    if "plan_feedback" in state_dict:
-        print("---RE-GENERATE PLAN w/ FEEDBACK---")
+        Please proceed by breaking down the project into a list of detailed steps, 
+        keeping in mind the goal of maintaining software functionality throughout the development process.
+        Don't mention testing as it is not your responsibility. Also find a suitable name for the project.
+        """
 
-        feedback = state_dict["plan_feedback"]
-        plan_steps = state_dict["plan_steps"]
-        # Update prompt
-        template = """
+REGENERATE_TEMPLATE = """
 As a python software architect tasked with refining a software development plan, 
 you are asked to enhance the project's trajectory based on received feedback.
 
@@ -60,97 +64,233 @@ Revision Guidelines:
 Reflect on Feedback: Carefully consider the feedback provided, identifying specific areas where the 
 initial plan can be improved or adjusted to better meet the project's needs.
 
+Dependencies: For every step, list the earlier steps it builds upon. Steps that don't depend on each other can be
+implemented at the same time.
+
 Please proceed by breaking down the project into detailed steps, 
 Don't mention testing and documentation as it is not your responsibility. Also find a suitable name for the project.       
 """
-        # Prompt
-        prompt = PromptTemplate(
-            template=template,
-            input_variables=["software_description", "feedback", "plan_steps"],
-        )
-
-        # Chain
-        chain = (
-                {
-                    "software_description": itemgetter("software_description"),
-                    "feedback": itemgetter("feedback"),
-                    "plan_steps": itemgetter("plan_steps"),
-                }
-                | prompt
-                | llm_with_tool
-                | parser_tool
-        )
-        plan = chain.invoke({
-            "software_description": software_description,
-            "feedback": feedback,
-            "plan_steps": plan_steps,
-        })
 
-    else:
-        print("---GENERATE PLAN---")
 
-        ## Prompt
-        template = """"As a python software architect, you will receive specifications or requirements for a software project. 
-        Your primary task is to decompose the overall problem into manageable, executable steps or sub-problems. 
-        Each step should be designed in such a way that, upon completion, the software is in a functional state, 
-        even if it does not yet include all the planned features or capabilities. Each step should add or change code.
+def _plan_model(candidate):
+    """
+    The first candidate is the deterministic plan, the others are sampled with their own seed so that the candidates
+    differ and are still cached separately.
+    """
+    model = LLM.bind_tools([Plan])
+    if candidate:
+        model = model.bind(temperature=PLAN_CANDIDATE_TEMPERATURE, seed=candidate)
+    return model
 
-        Please follow these guidelines when breaking down the software project:
-        1. Identify Key Components: Determine the core components or modules that make up the software system. 
-            These components should reflect major functional areas of the software.
-        2. Sequential Steps: Organize the development process into sequential steps. 
-            Each step should focus on implementing a specific component or enhancing the software's functionality progressively.
-        3. Ensure Functionality at Each Stage: Design each step so that the software remains operational and can perform a 
-            subset of its intended functions after the step is completed.
 
-        Here is the description of the software project you will be working on: 
-        {software_description}
+def build_generate_chain(candidate=0):
+    """
+    Builds the chain generating a first plan from the software description.
 
-        Please proceed by breaking down the project into a list of detailed steps, 
-        keeping in mind the goal of maintaining software functionality throughout the development process.
-        Don't mention testing as it is not your responsibility. Also find a suitable name for the project.
-        """
+    Args:
+        candidate (int): The index of the candidate plan generated by the chain
+
+    Returns:
+        Runnable: The chain
+    """
+    prompt = PromptTemplate(
+        template=GENERATE_TEMPLATE,
+        input_variables=["software_description"],
+    )
+    return (
+            {
+                "software_description": itemgetter("software_description"),
+            }
+            | prompt
+            | _plan_model(candidate)
+            | PydanticToolsParser(tools=[Plan])
+    )
+
+
+def build_regenerate_chain(candidate=0):
+    """
+    Builds the chain generating a new plan from a previous plan and the feedback received on it.
 
-        # Prompt
-        prompt = PromptTemplate(
-            template=template,
-            input_variables=["software_description"],
-        )
-
-        # Chain
-        chain = (
-                {
-                    "software_description": itemgetter("software_description"),
-                }
-                | prompt
-                | llm_with_tool
-                | parser_tool
-        )
-
-        max_attempts = 3
-        attempts = 0
-
-        while attempts < max_attempts:
-            try:
-                plan = chain.invoke({"software_description": software_description})
-                break
-            except Exception as e:
-                attempts += 1
-                print(f"Attempt {attempts} failed with error: {e}")
-                if attempts >= max_attempts:
-                    raise e
-                else:
-                    print(f"Retrying... Attempt {attempts + 1}/{max_attempts}")
-
-    iterations = iterations + 1
-
-    state_dict["iterations"] = iterations
+    Args:
+        candidate (int): The index of the candidate plan generated by the chain
+
+    Returns:
+        Runnable: The chain
+    """
+    prompt = PromptTemplate(
+        template=REGENERATE_TEMPLATE,
+        input_variables=["software_description", "feedback", "plan_steps"],
+    )
+    return (
+            {
+                "software_description": itemgetter("software_description"),
+                "feedback": itemgetter("feedback"),
+                "plan_steps": itemgetter("plan_steps"),
+            }
+            | prompt
+            | _plan_model(candidate)
+            | PydanticToolsParser(tools=[Plan])
+    )
+
+
+def _chain(name, builder, candidate):
+    key = f"generate_plan.{name}" + (f".{candidate}" if candidate else "")
+    return get_or_build(key, functools.partial(builder, candidate))
+
+
+def _plan_request(state_dict, candidate=0):
+    """
+    Returns:
+        tuple[Runnable, dict, str]: The chain to invoke, its inputs and the name of its retry policy
+    """
+    software_description = state_dict["software_description"]
+    if "plan_feedback" in state_dict:
+        print("---RE-GENERATE PLAN w/ FEEDBACK---")
+        chain = _chain("regenerate_chain", build_regenerate_chain, candidate)
+        return chain, {
+            "software_description": software_description,
+            "feedback": state_dict["plan_feedback"],
+            "plan_steps": state_dict["plan_steps"],
+        }, "regenerate_plan"
+
+    print("---GENERATE PLAN---")
+    chain = _chain("generate_chain", build_generate_chain, candidate)
+    return chain, {"software_description": software_description}, "generate_plan"
+
+
+def _apply_plan(state_dict, plan):
+    state_dict["iterations"] = state_dict["iterations"] + 1
     state_dict["plan_description"] = plan[0].description
     state_dict["plan_steps"] = plan[0].steps
-    state_dict["steps_todo"] = plan[0].steps
+    state_dict["plan_dependencies"] = normalise_dependencies(plan[0].steps, plan[0].dependencies)
+    # A copy, the steps are moved from the todo list to the done list
+    state_dict["steps_todo"] = list(plan[0].steps)
     state_dict["steps_done"] = []
     state_dict["project_name"] = plan[0].project_name
 
     return {
         "keys": state_dict
     }
+
+
+def _plan_and_validate(state_dict, candidate):
+    chain, inputs, policy = _plan_request(state_dict, candidate)
+    plan = invoke_with_policy(chain, inputs, policy)
+    validation_chain = get_or_build("validate_plan.chain", validate_plan.build_chain)
+    inputs = validate_plan.validation_inputs(state_dict["software_description"], plan[0].steps)
+    return plan, invoke_with_policy(validation_chain, inputs, "validate_plan")
+
+
+async def _aplan_and_validate(state_dict, candidate):
+    chain, inputs, policy = _plan_request(state_dict, candidate)
+    plan = await ainvoke_with_policy(chain, inputs, policy)
+    validation_chain = get_or_build("validate_plan.chain", validate_plan.build_chain)
+    inputs = validate_plan.validation_inputs(state_dict["software_description"], plan[0].steps)
+    return plan, await ainvoke_with_policy(validation_chain, inputs, "validate_plan")
+
+
+def _apply_candidate(state_dict, candidate, plan, plan_validation):
+    """
+    Stores the selected candidate and its validation, validate_plan then only records the decision.
+    """
+    status = "accepted" if plan_validation[0].is_ok else "rejected"
+    print(f"---PLAN CANDIDATE {candidate + 1}/{PLAN_CANDIDATES} {status.upper()}---")
+    result = _apply_plan(state_dict, plan)
+    state_dict["plan_feedback"] = plan_validation[0].feedback
+    state_dict["plan_ok"] = plan_validation[0].is_ok
+    state_dict["plan_validated"] = True
+    return result
+
+
+def speculate_plan(state_dict):
+    """
+    Generates and validates PLAN_CANDIDATES plans in parallel threads. The first accepted candidate is selected and
+    the pending ones are dropped. When every candidate is rejected, the first one to finish is kept with its feedback.
+    """
+    first = None
+    error = None
+    executor = ThreadPoolExecutor(max_workers=PLAN_CANDIDATES)
+    try:
+        pending = {executor.submit(_plan_and_validate, state_dict, candidate): candidate
+                   for candidate in range(PLAN_CANDIDATES)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                candidate = pending.pop(future)
+                try:
+                    plan, plan_validation = future.result()
+                except Exception as e:
+                    print(f"---PLAN CANDIDATE {candidate + 1}/{PLAN_CANDIDATES} FAILED: {e}---")
+                    error = e
+                    continue
+                if plan_validation[0].is_ok:
+                    return _apply_candidate(state_dict, candidate, plan, plan_validation)
+                first = first or (candidate, plan, plan_validation)
+    finally:
+        # The threads already calling the LLM can't be interrupted, their result is ignored
+        executor.shutdown(wait=False, cancel_futures=True)
+    if first is None:
+        raise error
+    return _apply_candidate(state_dict, *first)
+
+
+async def aspeculate_plan(state_dict):
+    """Async version of speculate_plan, the candidates that lost are cancelled."""
+    first = None
+    error = None
+    tasks = {asyncio.ensure_future(_aplan_and_validate(state_dict, candidate)): candidate
+             for candidate in range(PLAN_CANDIDATES)}
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                candidate = tasks[task]
+                try:
+                    plan, plan_validation = task.result()
+                except Exception as e:
+                    print(f"---PLAN CANDIDATE {candidate + 1}/{PLAN_CANDIDATES} FAILED: {e}---")
+                    error = e
+                    continue
+                if plan_validation[0].is_ok:
+                    return _apply_candidate(state_dict, candidate, plan, plan_validation)
+                first = first or (candidate, plan, plan_validation)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if first is None:
+        raise error
+    return _apply_candidate(state_dict, *first)
+
+
+def generate_plan(state):
+    """
+    Generate a plan to develop a software step by step. With PLAN_CANDIDATES > 1, several candidate plans are
+    generated and validated in parallel, see speculate_plan.
+
+    Args:
+        state (dict): The state dict
+
+    Returns:
+        state (dict): New key added to state
+    """
+    state_dict = state["keys"]
+    if PLAN_CANDIDATES > 1:
+        return speculate_plan(state_dict)
+    chain, inputs, policy = _plan_request(state_dict)
+    plan = invoke_with_policy(chain, inputs, policy)
+    return _apply_plan(state_dict, plan)
+
+
+async def agenerate_plan(state):
+    """Async version of generate_plan, it also starts creating the project in the background."""
+    state_dict = state["keys"]
+    if PLAN_CANDIDATES > 1:
+        result = await aspeculate_plan(state_dict)
+    else:
+        chain, inputs, policy = _plan_request(state_dict)
+        result = _apply_plan(state_dict, await ainvoke_with_policy(chain, inputs, policy))
+    # The project only needs a name, it is created while the plan is validated
+    prefetch_project(state_dict)
+    return result
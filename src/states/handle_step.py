@@ -1,16 +1,22 @@
+import asyncio
 import json
 
 from langchain.agents import AgentExecutor
-from langchain.agents.format_scratchpad import format_to_openai_function_messages
 from langchain_core.agents import AgentFinish, AgentActionMessageLog
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.pydantic_v1 import BaseModel, Field
 
-from llm import LLM
+from llm import LLM, ainvoke_with_policy, invoke_with_policy
 
 from tools.file_tools import create_directory_tool, create_file_tool, update_file_content_tool, read_file_content_tool
 
+from tools.patch_tools import apply_patch_tool
+
 from helpers import read_files_in_directory_as_string
+from prompt_layout import ITERATION, RUN, STATIC, STEP, Section, render_sections
+from registry import get_or_build
+from scratchpad import compact_scratchpad
+from states.failure_policy import ensure_green
 
 
 class Result(BaseModel):
@@ -41,97 +47,126 @@ def parse(output):
         )
 
 
-def handle_step(state):
-    """
-    creates an agent that will handle a single step of the project plan.
-    Args:
-        state (dict): The state dict
-
-    Returns:
-        state (dict): New key added to state
-    """
+prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """You are senior python developer. Use the provided tools to accomplish the task given by the user.
+            """,
+        ),
+        ("user", "{input}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ]
+)
 
-    ## State
-    state_dict = state["keys"]
 
-    iterations = state_dict["iterations"]
-    software_description = state_dict["software_description"]
-    steps_done = state_dict["steps_done"]
-    steps_todo = state_dict["steps_todo"]
-    source = state_dict["source_folder"]
-    test = state_dict["test_folder"]
-    current_step = steps_todo[0]
-
-    src_files = read_files_in_directory_as_string(source)
-    test_files = read_files_in_directory_as_string(test)
-
-    print("---HANDLE STEP---")
-    user_input = f"""
-    Implement the given task. The final goal is to create:
-    "{software_description}".
-
-    In order to achieve this, here are the steps that have already been implemented:
-    {steps_done}
-    You only need to focus on the next step (this is your task):
-    {current_step}
-    
-    here are the current source files:
-    {src_files}
-    
-    here are the test files:
-    {test_files}
-
-    Analyze what needs to be done, and add changes to the code where needed.
-    Always make minimal changes and make sure the code is documented with docstrings.
-    Create files and folders if needed to keep the code organized. Aim to keep files small.
-    All the code should be put in the existing source folder located at: {source} and started by running a single
-    entry point python file.
-    Also add tests (using pytest) for the new feature in the existing {test} folder. 
-    keep track of the requirements that need to be installed to run the code.
-    Return the result as a pydantic object
+def build_agent_executor():
     """
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                """You are senior python developer. Use the provided tools to accomplish the task given by the user.
-                """,
-            ),
-            ("user", user_input),
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-        ]
-    )
+    Builds the agent executor used by handle_step. It only depends on the per-call input so it is built once per
+    process and shared by all sessions.
 
-    # Tools
-    tools = [create_directory_tool, create_file_tool, update_file_content_tool, Result]
-    llm_with_tools = LLM.bind_functions(tools)
+    Returns:
+        AgentExecutor: The agent executor
+    """
+    tools = [create_directory_tool, create_file_tool, update_file_content_tool, apply_patch_tool]
+    llm_with_tools = LLM.bind_functions(tools + [Result])
     agent = (
             {
                 "input": lambda x: x["input"],
-                # Format agent scratchpad from intermediate steps
-                "agent_scratchpad": lambda x: format_to_openai_function_messages(
-                    x["intermediate_steps"]
-                ),
+                # Format agent scratchpad from intermediate steps, the older ones summarised
+                "agent_scratchpad": lambda x: compact_scratchpad(x["intermediate_steps"]),
             }
             | prompt
             | llm_with_tools
             | parse
     )
-    agent_executor = AgentExecutor(
+    return AgentExecutor(
         agent=agent,
-        tools=[create_directory_tool, create_file_tool, update_file_content_tool],
+        tools=tools,
         verbose=True
     )
-    result = agent_executor.invoke({"input": ""}, return_only_outputs=True)
+
+
+INSTRUCTIONS = """Implement the given task: the next step of the plan of the software described below.
+Analyze what needs to be done, and add changes to the code where needed.
+Always make minimal changes and make sure the code is documented with docstrings.
+To change part of an existing file use the ApplyPatch tool, only rewrite whole files that change completely.
+Create files and folders if needed to keep the code organized. Aim to keep files small.
+All the code should be put in the existing source folder and started by running a single entry point python file.
+Also add tests (using pytest) for the new feature in the existing test folder.
+keep track of the requirements that need to be installed to run the code.
+Return the result as a pydantic object"""
+
+
+def _user_input(state_dict):
+    """
+    Builds the task given to the agent from the state and the current files of the project. The sections go from
+    the most to the least stable, see render_sections.
+    """
+    source = state_dict["source_folder"]
+    test = state_dict["test_folder"]
+
+    sections = [
+        Section("Instructions", INSTRUCTIONS, STATIC),
+        Section("The final goal is to create", state_dict["software_description"], RUN),
+        Section("Project folders", f"source folder: {source}\ntest folder: {test}", RUN),
+        Section("Steps already implemented", '\n'.join(state_dict["steps_done"]) or "(none)", STEP),
+        Section("Your task: the next step", state_dict["steps_todo"][0], STEP),
+    ]
+    if state_dict.get("step_retry_feedback"):
+        sections.append(Section(
+            "Previous attempt",
+            f"A previous implementation of this step was rolled back because its tests kept failing with:\n"
+            f"{state_dict['step_retry_feedback']}\nTake a different approach.",
+            STEP,
+        ))
+    sections.extend([
+        Section("Test files", read_files_in_directory_as_string(test), ITERATION),
+        Section("Source files", read_files_in_directory_as_string(source), ITERATION),
+    ])
+    return render_sections(sections)
+
+
+def _apply_result(state_dict, result):
     print("===1====")
     print(result)
     print("=======")
-    iterations = iterations + 1
-    state_dict["iterations"] = iterations
+    state_dict["iterations"] = state_dict["iterations"] + 1
     state_dict["requirements"] = set(result["requirements"])
     state_dict["current_step_description"] = result["description"]
-    state_dict["current_step"] = current_step
+    state_dict["current_step"] = state_dict["steps_todo"][0]
+    state_dict.pop("step_retry_feedback", None)
 
     return {
         "keys": state_dict
     }
+
+
+def handle_step(state):
+    """
+    creates an agent that will handle a single step of the project plan.
+    Args:
+        state (dict): The state dict
+
+    Returns:
+        state (dict): New key added to state
+    """
+    print("---HANDLE STEP---")
+    state_dict = state["keys"]
+    ensure_green(state_dict)
+    user_input = _user_input(state_dict)
+    agent_executor = get_or_build("handle_step.agent_executor", build_agent_executor)
+    result = invoke_with_policy(agent_executor, {"input": user_input}, "handle_step", return_only_outputs=True)
+    return _apply_result(state_dict, result)
+
+
+async def ahandle_step(state):
+    """Async version of handle_step."""
+    print("---HANDLE STEP---")
+    state_dict = state["keys"]
+    await asyncio.to_thread(ensure_green, state_dict)
+    # Reading the project files is blocking IO
+    user_input = await asyncio.to_thread(_user_input, state_dict)
+    agent_executor = get_or_build("handle_step.agent_executor", build_agent_executor)
+    result = await ainvoke_with_policy(agent_executor, {"input": user_input}, "handle_step", return_only_outputs=True)
+    return _apply_result(state_dict, result)
@@ -0,0 +1,272 @@
+import asyncio
+import hashlib
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from config import PARALLEL_STEP_MAX_REWORKS, PARALLEL_STEPS
+from snapshot import is_ignored_dir
+from states.handle_step import ahandle_step, handle_step
+from states.rework_code import arework_code, rework_code
+from states.test_step import atest_step, test_step
+
+# The copies of the project in which the steps are implemented, the folder is ignored by the snapshots
+BRANCHES_DIR = os.path.join(".llm_coder", "branches")
+# Files regenerated from the state by test_step, they are never merged
+GENERATED_FILES = {"requirements.txt"}
+
+
+def normalise_dependencies(steps, dependencies):
+    """
+    Checks the dependencies of the steps of a plan. A step can only depend on earlier steps, when the dependencies
+    are missing or invalid every step depends on all the previous ones, i.e. the steps run one at a time.
+
+    Args:
+        steps (list[str]): The steps of the plan
+        dependencies (list[list[int]]): For every step, the indices of the steps it depends on
+
+    Returns:
+        list[list[int]]: The dependencies
+    """
+    valid = len(dependencies) == len(steps) and all(
+        isinstance(dependency, int) and 0 <= dependency < index
+        for index, step_dependencies in enumerate(dependencies)
+        for dependency in step_dependencies
+    )
+    if not valid:
+        return [list(range(index)) for index in range(len(steps))]
+    return [sorted(set(step_dependencies)) for step_dependencies in dependencies]
+
+
+def ready_steps(state_dict):
+    """
+    Returns:
+        list[str]: The steps to do whose dependencies are done, in the order of the plan and at most PARALLEL_STEPS.
+        The steps sent back to the serial loop are left out
+    """
+    plan_steps = state_dict["plan_steps"]
+    dependencies = state_dict.get("plan_dependencies") or normalise_dependencies(plan_steps, [])
+    # A skipped step doesn't block the steps depending on it
+    done = set(state_dict["steps_done"]) | set(state_dict.get("steps_skipped") or [])
+    serial = set(state_dict.get("serial_steps") or [])
+    ready = []
+    for step in state_dict["steps_todo"]:
+        if step in serial:
+            continue
+        if all(plan_steps[dependency] in done for dependency in dependencies[plan_steps.index(step)]):
+            ready.append(step)
+    return ready[:PARALLEL_STEPS]
+
+
+def decide_step_mode(state):
+    """
+    Determines whether the next steps are implemented in parallel or the next step alone.
+
+    Args:
+       state (dict): The current graph state
+
+    Returns:
+        str: Next node to call
+    """
+    state_dict = state["keys"]
+    serial = state_dict.get("serial_steps") or []
+    if PARALLEL_STEPS > 1 and state_dict["steps_todo"][0] not in serial and len(ready_steps(state_dict)) > 1:
+        print("---INDEPENDENT STEPS: IMPLEMENT THEM IN PARALLEL---")
+        return "parallel_steps"
+    return "handle_step"
+
+
+def _file_hashes(root):
+    """
+    Returns:
+        dict: relative path -> content hash, for the files of the project that can be merged
+    """
+    hashes = {}
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [name for name in dirs if not is_ignored_dir(name)]
+        for name in files:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root)
+            if relative in GENERATED_FILES or os.path.islink(path):
+                continue
+            with open(path, 'rb') as f:
+                hashes[relative] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def _changes(base, branch):
+    """
+    Returns:
+        dict: relative path -> new content hash, None for the deleted files
+    """
+    changes = {path: digest for path, digest in branch.items() if base.get(path) != digest}
+    changes.update({path: None for path in base if path not in branch})
+    return changes
+
+
+def _branch_state(state_dict, step, index):
+    """
+    Copies the project (without its venv) for a step and returns the state of the step, pointing to the copy.
+    The copy shares the venv of the project.
+    """
+    project_folder = state_dict["project_folder"]
+    branch = os.path.join(project_folder, BRANCHES_DIR, f"step-{index}")
+    shutil.rmtree(branch, ignore_errors=True)
+    shutil.copytree(project_folder, branch, symlinks=True,
+                    ignore=lambda directory, names: [name for name in names if is_ignored_dir(name)])
+
+    branch_state = dict(state_dict)
+    branch_state.update({
+        "project_folder": branch,
+        "source_folder": os.path.join(branch, os.path.relpath(state_dict["source_folder"], project_folder)),
+        "test_folder": os.path.join(branch, os.path.relpath(state_dict["test_folder"], project_folder)),
+        "steps_todo": [step],
+        "steps_done": list(state_dict["steps_done"]),
+        "requirements": set(state_dict["requirements"]),
+        "iterations": 0,
+    })
+    return branch_state
+
+
+def _run_branch(branch_state):
+    """
+    Implements a step in its copy of the project, with at most PARALLEL_STEP_MAX_REWORKS reworks.
+
+    Returns:
+        dict: The final state of the step, or None if its tests still fail
+    """
+    state = handle_step({"keys": branch_state})
+    for attempt in range(PARALLEL_STEP_MAX_REWORKS + 1):
+        state = test_step(state)
+        if state["keys"]["test_result"]:
+            return state["keys"]
+        if attempt < PARALLEL_STEP_MAX_REWORKS:
+            state = rework_code(state)
+    return None
+
+
+async def _arun_branch(branch_state):
+    """Async version of _run_branch."""
+    state = await ahandle_step({"keys": branch_state})
+    for attempt in range(PARALLEL_STEP_MAX_REWORKS + 1):
+        state = await atest_step(state)
+        if state["keys"]["test_result"]:
+            return state["keys"]
+        if attempt < PARALLEL_STEP_MAX_REWORKS:
+            state = await arework_code(state)
+    return None
+
+
+def _merge(state_dict, steps, results, base):
+    """
+    Copies the changes of the steps into the project, in the order of the plan. A step whose tests failed, or that
+    changed a file already changed by a merged step, is not merged.
+
+    Returns:
+        tuple[list[tuple[str, dict]], list[str]]: The merged steps with their final state, and the other steps
+    """
+    project_folder = state_dict["project_folder"]
+    changed = set()
+    merged = []
+    deferred = []
+    for step, result in zip(steps, results):
+        if isinstance(result, BaseException) or result is None:
+            print(f"---STEP FAILED IN PARALLEL, DEFERRED: {step}---")
+            deferred.append(step)
+            continue
+        branch = result["project_folder"]
+        changes = _changes(base, _file_hashes(branch))
+        conflicts = changed & changes.keys()
+        if conflicts:
+            print(f"---STEP CONFLICTS ON {sorted(conflicts)}, DEFERRED: {step}---")
+            deferred.append(step)
+            continue
+        for path, digest in changes.items():
+            target = os.path.join(project_folder, path)
+            if digest is None:
+                if os.path.exists(target):
+                    os.remove(target)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(branch, path), target)
+        changed |= changes.keys()
+        merged.append((step, result))
+    return merged, deferred
+
+
+def _apply_merge(state_dict, merged, deferred):
+    state_dict["iterations"] = state_dict["iterations"] + 1
+    state_dict["current_steps"] = [step for step, _ in merged]
+    state_dict["current_step"] = '\n'.join(state_dict["current_steps"])
+    state_dict["current_step_description"] = '\n'.join(
+        str(result["current_step_description"]) for _, result in merged
+    )
+    for _, result in merged:
+        state_dict["requirements"] = state_dict["requirements"] | result["requirements"]
+    state_dict["serial_steps"] = (state_dict.get("serial_steps") or []) + deferred
+    state_dict["deferred_steps"] = deferred
+    shutil.rmtree(os.path.join(state_dict["project_folder"], BRANCHES_DIR), ignore_errors=True)
+
+    return {
+        "keys": state_dict
+    }
+
+
+def parallel_steps(state):
+    """
+    Implements the independent steps that are ready at the same time, each in its own copy of the project, and
+    merges the ones that passed their tests and don't conflict. The other steps go back to the serial loop.
+
+    Args:
+        state (dict): The state dict
+
+    Returns:
+        state (dict): New key added to state
+    """
+    print("---PARALLEL STEPS---")
+    state_dict = state["keys"]
+    steps = ready_steps(state_dict)
+    base = _file_hashes(state_dict["project_folder"])
+    branch_states = [_branch_state(state_dict, step, index) for index, step in enumerate(steps)]
+
+    def run(branch_state):
+        try:
+            return _run_branch(branch_state)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=len(branch_states)) as executor:
+        results = list(executor.map(run, branch_states))
+    merged, deferred = _merge(state_dict, steps, results, base)
+    return _apply_merge(state_dict, merged, deferred)
+
+
+async def aparallel_steps(state):
+    """Async version of parallel_steps."""
+    print("---PARALLEL STEPS---")
+    state_dict = state["keys"]
+    steps = ready_steps(state_dict)
+    base = await asyncio.to_thread(_file_hashes, state_dict["project_folder"])
+    branch_states = await asyncio.to_thread(
+        lambda: [_branch_state(state_dict, step, index) for index, step in enumerate(steps)]
+    )
+    results = await asyncio.gather(*(_arun_branch(branch_state) for branch_state in branch_states),
+                                   return_exceptions=True)
+    merged, deferred = await asyncio.to_thread(_merge, state_dict, steps, results, base)
+    return _apply_merge(state_dict, merged, deferred)
+
+
+def decide_after_parallel_steps(state):
+    """
+    Determines whether the merged steps are tested together, or if no step was merged.
+
+    Args:
+       state (dict): The current graph state
+
+    Returns:
+        str: Next node to call
+    """
+    if state["keys"]["current_steps"]:
+        return "test_step"
+    print("---NO STEP MERGED---")
+    return "prepare_next_step"
@@ -1,3 +1,6 @@
+from states.parallel_steps import decide_step_mode
+
+
 def move_first_todo_to_done(state_dict):
     """
     Moves the first item from the 'todos' list to the 'done' list within a dictionary.
@@ -14,6 +17,18 @@ def move_first_todo_to_done(state_dict):
         raise Exception("No tasks in 'todos' list to move.")
 
 
+def move_steps_to_done(state_dict, steps):
+    """
+    Moves the given steps from the 'todos' list to the 'done' list, e.g. the steps implemented in parallel.
+
+    :param state_dict: Dictionary with 'todos' and 'done' lists.
+    :param steps: The steps to move.
+    """
+    for step in steps:
+        state_dict['steps_todo'].remove(step)
+        state_dict['steps_done'].append(step)
+
+
 def prepare_next_step(state):
     """
     prepare the agent for the next step
@@ -26,7 +41,13 @@ def prepare_next_step(state):
     """
     ## State
     state_dict = state["keys"]
-    move_first_todo_to_done(state_dict)
+    # The failures of the step are forgotten once its tests passed
+    state_dict.pop("failure_tracking", None)
+    current_steps = state_dict.pop("current_steps", None)
+    if current_steps is None:
+        move_first_todo_to_done(state_dict)
+    else:
+        move_steps_to_done(state_dict, current_steps)
 
     return {
         "keys": state_dict
@@ -51,6 +72,5 @@ def decide_finished(state):
         print("---WE ARE DONE :D--")
         return "FINISH"
     else:
-        # We have relevant documents, so generate answer
         print("---THERE ARE STILL SOME STEPS TO DO---")
-        return "handle_step"
+        return decide_step_mode(state)
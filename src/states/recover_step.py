@@ -0,0 +1,165 @@
+import asyncio
+from operator import itemgetter
+
+from langchain.output_parsers.openai_tools import PydanticToolsParser
+from langchain_core.prompts import PromptTemplate
+from langchain_core.pydantic_v1 import BaseModel, Field
+
+from llm import LLM, ainvoke_with_policy, invoke_with_policy
+from registry import get_or_build
+from states.failure_policy import restore_green
+from states.parallel_steps import normalise_dependencies
+from states.prepare_next import decide_finished
+
+REPLAN_TEMPLATE = """As a python software architect, you planned the development of a software in small steps.
+The software to develop is:
+{software_description}
+
+These steps are done:
+{steps_done}
+
+The following step could not be implemented, its tests kept failing the same way:
+{failed_steps}
+
+The failures were:
+{failure}
+
+Rewrite this step into 1 to 3 smaller steps that are easier to implement and test, they replace it in the plan.
+Each new step must be implementable and testable on its own, in the order given.
+"""
+
+
+class StepPlan(BaseModel):
+    """Smaller steps replacing a step that failed"""
+
+    steps: list[str] = Field(description="The new steps, in the order they must be implemented")
+
+
+def build_replan_chain():
+    """
+    Builds the chain rewriting a step that failed into smaller steps.
+
+    Returns:
+        Runnable: The chain
+    """
+    prompt = PromptTemplate(
+        template=REPLAN_TEMPLATE,
+        input_variables=["software_description", "steps_done", "failed_steps", "failure"],
+    )
+    return (
+            {
+                "software_description": itemgetter("software_description"),
+                "steps_done": itemgetter("steps_done"),
+                "failed_steps": itemgetter("failed_steps"),
+                "failure": itemgetter("failure"),
+            }
+            | prompt
+            | LLM.bind_tools([StepPlan])
+            | PydanticToolsParser(tools=[StepPlan])
+    )
+
+
+def _failure(state_dict):
+    return state_dict.get("test_digest") or state_dict.get("test_feedback") or ""
+
+
+def _replan_inputs(state_dict, steps):
+    return {
+        "software_description": state_dict["software_description"],
+        "steps_done": '\n'.join(state_dict["steps_done"]) or "(none)",
+        "failed_steps": '\n'.join(steps),
+        "failure": _failure(state_dict),
+    }
+
+
+def _failed_steps(state_dict):
+    """
+    Returns:
+        list[str]: The steps being tested: the steps merged by parallel_steps, or the first step to do
+    """
+    return state_dict.pop("current_steps", None) or [state_dict["steps_todo"][0]]
+
+
+def _replace_steps(state_dict, steps, new_steps):
+    """Puts the new steps in the plan and in the steps to do, where the first replaced step was."""
+    todo = state_dict["steps_todo"]
+    position = todo.index(steps[0])
+    state_dict["steps_todo"] = todo[:position] + new_steps + [step for step in todo[position:] if step not in steps]
+    plan_steps = state_dict["plan_steps"]
+    position = plan_steps.index(steps[0])
+    state_dict["plan_steps"] = (plan_steps[:position] + new_steps
+                                + [step for step in plan_steps[position:] if step not in steps])
+    # The new steps run one after the other
+    state_dict["plan_dependencies"] = normalise_dependencies(state_dict["plan_steps"], [])
+
+
+def _apply_recovery(state_dict, action, steps, new_steps=None):
+    state_dict["iterations"] = state_dict["iterations"] + 1
+    state_dict["recovery"] = {"action": action, "steps": steps, "new_steps": new_steps or []}
+    if action == "skip":
+        state_dict["steps_todo"] = [step for step in state_dict["steps_todo"] if step not in steps]
+        state_dict["steps_skipped"] = (state_dict.get("steps_skipped") or []) + steps
+        state_dict.pop("failure_tracking", None)
+        return {"keys": state_dict}
+
+    # The step is implemented again, knowing how its previous implementation failed
+    state_dict["step_retry_feedback"] = _failure(state_dict)
+    if action == "replan":
+        _replace_steps(state_dict, steps, new_steps)
+    elif len(steps) > 1:
+        # Steps merged by parallel_steps are implemented again one at a time
+        state_dict["serial_steps"] = (state_dict.get("serial_steps") or []) + steps
+    return {"keys": state_dict}
+
+
+def recover_step(state):
+    """
+    Gets a step out of a test/rework loop that doesn't converge, with the action chosen by the failure policy:
+    rollback (implement the step again from the last green snapshot), replan (rewrite the step into smaller
+    steps) or skip (leave the step out). The project is restored to its last green snapshot in all cases.
+
+    Args:
+        state (dict): The state dict
+
+    Returns:
+        state (dict): New key added to state
+    """
+    state_dict = state["keys"]
+    action = state_dict["failure_action"]
+    print(f"---RECOVER STEP: {action.upper()}---")
+    steps = _failed_steps(state_dict)
+    restore_green(state_dict)
+    new_steps = None
+    if action == "replan":
+        chain = get_or_build("recover_step.replan_chain", build_replan_chain)
+        new_steps = invoke_with_policy(chain, _replan_inputs(state_dict, steps), "replan_step")[0].steps
+    return _apply_recovery(state_dict, action, steps, new_steps)
+
+
+async def arecover_step(state):
+    """Async version of recover_step."""
+    state_dict = state["keys"]
+    action = state_dict["failure_action"]
+    print(f"---RECOVER STEP: {action.upper()}---")
+    steps = _failed_steps(state_dict)
+    await asyncio.to_thread(restore_green, state_dict)
+    new_steps = None
+    if action == "replan":
+        chain = get_or_build("recover_step.replan_chain", build_replan_chain)
+        new_steps = (await ainvoke_with_policy(chain, _replan_inputs(state_dict, steps), "replan_step"))[0].steps
+    return _apply_recovery(state_dict, action, steps, new_steps)
+
+
+def decide_after_recovery(state):
+    """
+    Determines whether the step is implemented again, or the run moves on to the next steps after a skip.
+
+    Args:
+       state (dict): The current graph state
+
+    Returns:
+        str: Next node to call
+    """
+    if state["keys"]["recovery"]["action"] == "skip":
+        return decide_finished(state)
+    return "handle_step"
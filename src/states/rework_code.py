@@ -1,16 +1,23 @@
+import asyncio
+import functools
 import json
 
 from langchain.agents import AgentExecutor
-from langchain.agents.format_scratchpad import format_to_openai_function_messages
 from langchain_core.agents import AgentFinish, AgentActionMessageLog
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.pydantic_v1 import BaseModel, Field
 
-from llm import LLM
+from llm import LLM, ainvoke_with_policy, invoke_with_policy
 
 from tools.file_tools import update_file_content_tool
+from tools.patch_tools import apply_patch_tool
 
 from helpers import read_files_in_directory_as_string
+from prompt_layout import ITERATION, STATIC, Section, render_sections
+from registry import get_or_build
+from scratchpad import compact_scratchpad
+from config import ESCALATION_MODEL
+from states.failure_policy import escalation_context, note_rework
 
 
 class Result(BaseModel):
@@ -41,88 +48,129 @@ def parse(output):
         )
 
 
-def rework_code(state):
+prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """You are senior python developer. Use the provided tools to accomplish the task given by the user.
+            Do not refactor code, just make fixes. respond with a pydantic object after you made the required
+            changes.
+            """,
+        ),
+        ("user", "{input}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ]
+)
+
+
+def build_agent_executor(model=None):
     """
-    creates an agent that will rework some code.
+    Builds the agent executor used by rework_code. It only depends on the per-call input so it is built once per
+    process and shared by all sessions.
+
     Args:
-        state (dict): The state dict
+        model (str): The model replacing the default one, e.g. for the escalated reworks
 
     Returns:
-        state (dict): New key added to state
+        AgentExecutor: The agent executor
     """
-    ## State
-    state_dict = state["keys"]
-
-    iterations = state_dict["iterations"]
-    source = state_dict["source_folder"]
-    test = state_dict["test_folder"]
-
-    src_files = read_files_in_directory_as_string(source)
-    test_files = read_files_in_directory_as_string(test)
-
-    feedback = state_dict["test_feedback"].replace('{', '{{').replace('}', '}}')
-
-    user_input = f"""
-I would like you fix/rework some code and explain the changes you made. Also keep track of the 
-requirements that need to be installed to run the code.
-
-Here are the source files before modifications:
-{src_files}
-
-Here are the test files before modification:
-{test_files}
-
-here is the output that was created when running the code before modifications:
-{feedback}
-
-Make sure the code is documented with docstrings. Only make minimal changes and never modify the same
-file more than once. Do not refactor code, just make fixes.
-respond with a pydantic object as quick as possible. 
-"""
-
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                """You are senior python developer. Use the provided tools to accomplish the task given by the user.
-                Do not refactor code, just make fixes. respond with a pydantic object after you made the required
-                changes.
-                """,
-            ),
-            ("user", user_input),
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-        ]
-    )
-
-    # Tools
-    tools = [update_file_content_tool, Result]
-    llm_with_tools = LLM.bind_functions(tools)
+    tools = [apply_patch_tool, update_file_content_tool]
+    llm_with_tools = LLM.bind_functions(tools + [Result])
+    if model:
+        llm_with_tools = llm_with_tools.bind(model=model)
     agent = (
             {
                 "input": lambda x: x["input"],
-                # Format agent scratchpad from intermediate steps
-                "agent_scratchpad": lambda x: format_to_openai_function_messages(
-                    x["intermediate_steps"]
-                ),
+                # Format agent scratchpad from intermediate steps, the older ones summarised
+                "agent_scratchpad": lambda x: compact_scratchpad(x["intermediate_steps"]),
             }
             | prompt
             | llm_with_tools
             | parse
     )
-    agent_executor = AgentExecutor(
+    return AgentExecutor(
         agent=agent,
-        tools=[update_file_content_tool],
+        tools=tools,
         verbose=True
     )
-    result = agent_executor.invoke({"input": ""}, return_only_outputs=True)
+
+
+INSTRUCTIONS = """I would like you fix/rework some code and explain the changes you made. Also keep track of the
+requirements that need to be installed to run the code.
+Make sure the code is documented with docstrings. Only make minimal changes and never modify the same
+file more than once. Do not refactor code, just make fixes. Make the fixes with the ApplyPatch tool, all the changes
+of a file in a single patch, and only rewrite a whole file with UpdateFileContent if most of it changes.
+respond with a pydantic object as quick as possible."""
+
+
+def _user_input(state_dict):
+    """
+    Builds the task given to the agent from the test feedback and the current files of the project. The sections go
+    from the most to the least stable, see render_sections: the test files change less often than the source files
+    during the reworks, and the feedback changes every time.
+    """
+    source = state_dict["source_folder"]
+    test = state_dict["test_folder"]
+
+    # The failure digest is much smaller than the raw test output when it is available
+    feedback = state_dict.get("test_digest") or state_dict["test_feedback"]
+
+    return render_sections([
+        Section("Instructions", INSTRUCTIONS, STATIC),
+        Section("Test files before modification", read_files_in_directory_as_string(test), ITERATION),
+        Section("Source files before modification", read_files_in_directory_as_string(source), ITERATION),
+        Section("Output of the tests before modification", feedback, ITERATION),
+        Section("", escalation_context(state_dict), ITERATION),
+    ])
+
+
+def _apply_result(state_dict, result):
     print("===1====")
     print(result)
     print("=======")
-    iterations = iterations + 1
-    state_dict["iterations"] = iterations
+    state_dict["iterations"] = state_dict["iterations"] + 1
     state_dict["requirements"] = set(result["requirements"])
     state_dict["current_rework_description"] = result["description"]
+    note_rework(state_dict, result["description"])
 
     return {
         "keys": state_dict
     }
+
+
+def _agent_executor(state_dict):
+    """
+    Returns:
+        AgentExecutor: The executor of the escalated model once the rework of the step escalated, if one is set
+    """
+    tracking = state_dict.get("failure_tracking")
+    if ESCALATION_MODEL and tracking and tracking["escalated"]:
+        return get_or_build("rework_code.agent_executor.escalated",
+                            functools.partial(build_agent_executor, ESCALATION_MODEL))
+    return get_or_build("rework_code.agent_executor", build_agent_executor)
+
+
+def rework_code(state):
+    """
+    creates an agent that will rework some code.
+    Args:
+        state (dict): The state dict
+
+    Returns:
+        state (dict): New key added to state
+    """
+    state_dict = state["keys"]
+    user_input = _user_input(state_dict)
+    agent_executor = _agent_executor(state_dict)
+    result = invoke_with_policy(agent_executor, {"input": user_input}, "rework_code", return_only_outputs=True)
+    return _apply_result(state_dict, result)
+
+
+async def arework_code(state):
+    """Async version of rework_code."""
+    state_dict = state["keys"]
+    # Reading the project files is blocking IO
+    user_input = await asyncio.to_thread(_user_input, state_dict)
+    agent_executor = _agent_executor(state_dict)
+    result = await ainvoke_with_policy(agent_executor, {"input": user_input}, "rework_code", return_only_outputs=True)
+    return _apply_result(state_dict, result)
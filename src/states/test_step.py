@@ -1,17 +1,25 @@
+import asyncio
 import json
+import os
 from typing import Optional
 
 from langchain.agents import AgentExecutor
-from langchain.agents.format_scratchpad import format_to_openai_function_messages
 from langchain_core.agents import AgentFinish, AgentActionMessageLog
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.pydantic_v1 import BaseModel, Field
 
-from llm import LLM
+from llm import LLM, ainvoke_with_policy, invoke_with_policy
 
 from tools.venv_tools import create_requirements_file_tool, install_requirements_tool
+from tools.venv_tools import create_requirements_file, install_requirements_in_env, ainstall_requirements_in_env
 
-from tools.python_tools import run_pytest_tool
+from tools.python_tools import run_pytest_tool, execute_pytest, aexecute_pytest
+from tools.pytest_report import failure_digest, failure_fingerprint
+from tools.test_selection import TestSelector
+from config import TEST_SELECTION, TEST_STEP_MODE
+from registry import get_or_build
+from scratchpad import compact_scratchpad
+from states.failure_policy import save_green, track_test_result
 
 
 class Result(BaseModel):
@@ -43,26 +51,53 @@ def parse(output):
         )
 
 
-def test_step(state):
+prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """You are senior python developer. Use the provided tools to accomplish the task given by the user.
+            """,
+        ),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+        ("user", "{input}"),
+    ]
+)
+
+
+def build_agent_executor():
     """
-    creates an agent that will handle a single step of the project plan.
-    Args:
-        state (dict): The state dict
+    Builds the agent executor used by test_step. It only depends on the per-call input so it is built once per
+    process and shared by all sessions.
 
     Returns:
-        state (dict): New key added to state
+        AgentExecutor: The agent executor
     """
-    print("---TEST STEP---")
+    tools = [create_requirements_file_tool, install_requirements_tool, run_pytest_tool]
+    llm_with_tools = LLM.bind_functions(tools + [Result])
+    agent = (
+            {
+                "input": lambda x: x["input"],
+                # Format agent scratchpad from intermediate steps, the older ones summarised
+                "agent_scratchpad": lambda x: compact_scratchpad(x["intermediate_steps"]),
+            }
+            | prompt
+            | llm_with_tools
+            | parse
+    )
+    return AgentExecutor(
+        agent=agent,
+        tools=tools,
+        verbose=True
+    )
 
-    ## State
-    state_dict = state["keys"]
-    iterations = state_dict["iterations"]
+
+def _agent_input(state_dict):
     project_folder = state_dict["project_folder"]
     requirements = state_dict["requirements"]
     test = state_dict["test_folder"]
     ## Prompt
 
-    user_input = f"""
+    return f"""
     This is the project folder path:{project_folder}
     This is a list of requirements: {str(list(requirements))}
     This is the path to the test folder : {test}
@@ -71,52 +106,173 @@ def test_step(state):
     3. run the test using pytest
     when done, return the output as a pydantic object
     """
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                """You are senior python developer. Use the provided tools to accomplish the task given by the user.
-                """,
-            ),
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-            ("user", user_input),
-        ]
-    )
-    # Tools
-    tools = [create_requirements_file_tool, install_requirements_tool, run_pytest_tool, Result]
-    llm_with_tools = LLM.bind_functions(tools)
-    agent = (
-            {
-                "input": lambda x: x["input"],
-                # Format agent scratchpad from intermediate steps
-                "agent_scratchpad": lambda x: format_to_openai_function_messages(
-                    x["intermediate_steps"]
-                ),
-            }
-            | prompt
-            | llm_with_tools
-            | parse
-    )
-    agent_executor = AgentExecutor(
-        agent=agent,
-        tools=[create_requirements_file_tool, install_requirements_tool, run_pytest_tool],
-        verbose=True
-    )
-    result = agent_executor.invoke({"input": ""}, return_only_outputs=True)
 
-    iterations = iterations + 1
-    state_dict["iterations"] = iterations
+
+def run_tests_with_agent(state_dict):
+    """
+    Lets an agent create the requirements file, install the requirements and run the tests.
+
+    Args:
+        state_dict (dict): The state dict
+
+    Returns:
+        dict: "result" (bool) and optionally "feedback" (str)
+    """
+    agent_executor = get_or_build("test_step.agent_executor", build_agent_executor)
+    inputs = {"input": _agent_input(state_dict)}
+    return invoke_with_policy(agent_executor, inputs, "test_step", return_only_outputs=True)
+
+
+async def arun_tests_with_agent(state_dict):
+    """Async version of run_tests_with_agent."""
+    agent_executor = get_or_build("test_step.agent_executor", build_agent_executor)
+    inputs = {"input": _agent_input(state_dict)}
+    return await ainvoke_with_policy(agent_executor, inputs, "test_step", return_only_outputs=True)
+
+
+def _select_tests(state_dict):
+    """
+    Returns:
+        tuple[Optional[TestSelector], Optional[list[str]]]: The selector (None unless TEST_SELECTION = "affected")
+        and the test files to run (None for all of them)
+    """
+    if TEST_SELECTION != "affected":
+        return None, None
+    selector = TestSelector(state_dict["project_folder"], state_dict["source_folder"], state_dict["test_folder"])
+    selected = selector.select()
+    if selected:
+        print(f"---RUNNING {len(selected)} TEST FILES---")
+    elif selected is None:
+        print("---RUNNING ALL TEST FILES---")
+    return selector, selected
+
+
+def _run_result(run):
+    if run.returncode != 0:
+        return {
+            "result": False,
+            "feedback": f"Tests failed with exit code {run.returncode}:\n{run.output}",
+            "digest": failure_digest(run.outcomes, run.output),
+            "fingerprint": failure_fingerprint(run.outcomes, run.output),
+        }
+    # Only keep the pytest summary line when everything passed
+    summary = [line for line in run.output.splitlines() if line.strip()]
+    return {"result": True, "feedback": summary[-1] if summary else ""}
+
+
+NO_AFFECTED_TEST = {"result": True, "feedback": "No file changed since the last green run"}
+
+
+def run_tests_directly(state_dict):
+    """
+    Creates the requirements file, installs the requirements and runs the tests without any LLM call. The result
+    comes from the pytest exit code.
+
+    Args:
+        state_dict (dict): The state dict
+
+    Returns:
+        dict: "result" (bool), "feedback" (str) and, when the tests failed, "digest": a compact description of the
+        failures for rework_code
+    """
+    project_folder = state_dict["project_folder"]
+    python_path = state_dict["python_path"]
+
+    try:
+        create_requirements_file(project_folder, sorted(state_dict["requirements"]))
+        install_requirements_in_env(python_path, os.path.join(project_folder, "requirements.txt"))
+
+        selector, selected = _select_tests(state_dict)
+        if selected == []:
+            return dict(NO_AFFECTED_TEST)
+
+        run = execute_pytest(state_dict["test_folder"], python_path, selected)
+        if selector is not None:
+            selector.record_run(selected, run.returncode == 0)
+    except Exception as e:
+        return {"result": False, "feedback": str(e)}
+
+    return _run_result(run)
+
+
+async def arun_tests_directly(state_dict):
+    """Async version of run_tests_directly, pip and pytest run as subprocesses of the event loop."""
+    project_folder = state_dict["project_folder"]
+    python_path = state_dict["python_path"]
+
+    try:
+        create_requirements_file(project_folder, sorted(state_dict["requirements"]))
+        await ainstall_requirements_in_env(python_path, os.path.join(project_folder, "requirements.txt"))
+
+        # The selection hashes the project files
+        selector, selected = await asyncio.to_thread(_select_tests, state_dict)
+        if selected == []:
+            return dict(NO_AFFECTED_TEST)
+
+        run = await aexecute_pytest(state_dict["test_folder"], python_path, selected)
+        if selector is not None:
+            selector.record_run(selected, run.returncode == 0)
+    except Exception as e:
+        return {"result": False, "feedback": str(e)}
+
+    return _run_result(run)
+
+
+def _apply_result(state_dict, result):
+    state_dict["iterations"] = state_dict["iterations"] + 1
     state_dict["test_result"] = result["result"]
     state_dict["test_feedback"] = result["feedback"] if "feedback" in result else ""
+    state_dict["test_digest"] = result.get("digest")
+    fingerprint = result.get("fingerprint") or failure_fingerprint([], state_dict["test_feedback"])
+    track_test_result(state_dict, result["result"], fingerprint)
 
     return {
         "keys": state_dict
     }
 
 
+def test_step(state):
+    """
+    Installs the requirements and runs the tests of the project, either directly (default) or through an agent
+    (TEST_STEP_MODE = "agent").
+    Args:
+        state (dict): The state dict
+
+    Returns:
+        state (dict): New key added to state
+    """
+    print("---TEST STEP---")
+    state_dict = state["keys"]
+
+    if TEST_STEP_MODE == "agent":
+        result = run_tests_with_agent(state_dict)
+    else:
+        result = run_tests_directly(state_dict)
+
+    if result["result"]:
+        save_green(state_dict)
+    return _apply_result(state_dict, result)
+
+
+async def atest_step(state):
+    """Async version of test_step."""
+    print("---TEST STEP---")
+    state_dict = state["keys"]
+
+    if TEST_STEP_MODE == "agent":
+        result = await arun_tests_with_agent(state_dict)
+    else:
+        result = await arun_tests_directly(state_dict)
+
+    if result["result"]:
+        await asyncio.to_thread(save_green, state_dict)
+    return _apply_result(state_dict, result)
+
+
 def decide_rework_code(state):
     """
-    Determines if we continue or if the code needs to be reworked.
+    Determines if we continue, if the code needs to be reworked, or if the step must be recovered because its
+    rework doesn't converge (see track_test_result).
 
     Args:
        state (dict): The current graph state
@@ -131,7 +287,9 @@ def decide_rework_code(state):
     if success is True:
         print("---TEST PASSED: LET'S CONTINUE")
         return "prepare_next_step"
-    else:
-        # We have relevant documents, so generate answer
-        print("---TEST FAILED: NEED TO REWORK CODE")
+    action = state_dict.get("failure_action") or "rework"
+    if action in ("rework", "escalate"):
+        print("---TEST FAILED: NEED TO REWORK CODE" + (" (ESCALATED)" if action == "escalate" else ""))
         return "rework_code"
+    print(f"---TEST FAILED: THE REWORK DOESN'T CONVERGE, {action.upper()} THE STEP---")
+    return "recover_step"
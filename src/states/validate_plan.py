@@ -5,7 +5,8 @@ from langchain.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain.output_parsers.openai_tools import PydanticToolsParser
 
-from llm import LLM
+from llm import LLM, ainvoke_with_policy, invoke_with_policy
+from registry import get_or_build
 
 
 class ValidatePlan(BaseModel):
@@ -14,31 +15,7 @@ class ValidatePlan(BaseModel):
     is_ok: bool = Field(description="True if the plan doesn't need feedback, False if it needs to be reworked")
 
 
-def validate_plan(state):
-    """
-    validate a plan to develop a software step by step
-
-    Args:
-        state (dict): The state dict
-
-    Returns:
-        state (dict): New key added to state
-    """
-
-    ## State
-    state_dict = state["keys"]
-    software_description = state_dict["software_description"]
-    iterations = state_dict["iterations"]
-    plan_steps = state_dict["plan_steps"]
-
-    ## LLM
-    llm_with_tool = LLM.bind_tools([ValidatePlan])
-
-    # Parser
-    parser_tool = PydanticToolsParser(tools=[ValidatePlan])
-
-    ## Prompt
-    template = """As python software development processes specialist, your role is to review and validate a software 
+VALIDATE_TEMPLATE = """As python software development processes specialist, your role is to review and validate a software 
     development plan. You will be provided with a description of the software project, along with a series of steps 
     proposed for its development. Your task involves evaluating the plan to ensure that it meets the project's 
     requirements, is structured to facilitate a smooth, iterative development process. Do not mention testing and 
@@ -56,45 +33,46 @@ Based on the above information, proceed with the validation of the development p
 Don't be to strict, only reject a plan if something is wrong.
     """
 
-    print("---VALIDATE PLAN---")
 
-    # Prompt
+def build_chain():
+    """
+    Builds the chain validating a plan against the software description.
+
+    Returns:
+        Runnable: The chain
+    """
     prompt = PromptTemplate(
-        template=template,
+        template=VALIDATE_TEMPLATE,
         input_variables=["software_description", "plan_steps"],
     )
-
-    # Chain
-    chain = (
+    return (
             {
                 "software_description": itemgetter("software_description"),
                 "plan_steps": itemgetter("plan_steps"),
             }
             | prompt
-            | llm_with_tool
-            | parser_tool
+            | LLM.bind_tools([ValidatePlan])
+            | PydanticToolsParser(tools=[ValidatePlan])
     )
 
-    max_attempts = 3
-    attempts = 0
-
-    while attempts < max_attempts:
-        try:
-            plan_validation = chain.invoke({
-                "software_description": software_description,
-                "plan_steps": '\n'.join(plan_steps)
-            })
-            break
-        except Exception as e:
-            attempts += 1
-            print(f"Attempt {attempts} failed with error: {e}")
-            if attempts >= max_attempts:
-                raise e
-            else:
-                print(f"Retrying... Attempt {attempts + 1}/{max_attempts}")
-
-    iterations = iterations + 1
-    state_dict["iterations"] = iterations
+
+def validation_inputs(software_description, plan_steps):
+    """
+    Returns:
+        dict: The inputs of the validation chain for a plan
+    """
+    return {
+        "software_description": software_description,
+        "plan_steps": '\n'.join(plan_steps)
+    }
+
+
+def _validation_inputs(state_dict):
+    return validation_inputs(state_dict["software_description"], state_dict["plan_steps"])
+
+
+def _apply_validation(state_dict, plan_validation):
+    state_dict["iterations"] = state_dict["iterations"] + 1
     state_dict["plan_feedback"] = plan_validation[0].feedback
     state_dict["plan_ok"] = plan_validation[0].is_ok
     return {
@@ -102,6 +80,47 @@ Don't be to strict, only reject a plan if something is wrong.
     }
 
 
+def _skip_validation(state_dict):
+    """
+    The plan was already validated along with its generation (speculative planning), only its result is reported.
+    """
+    print("---PLAN ALREADY VALIDATED---")
+    state_dict["iterations"] = state_dict["iterations"] + 1
+    return {
+        "keys": state_dict
+    }
+
+
+def validate_plan(state):
+    """
+    validate a plan to develop a software step by step
+
+    Args:
+        state (dict): The state dict
+
+    Returns:
+        state (dict): New key added to state
+    """
+    print("---VALIDATE PLAN---")
+    state_dict = state["keys"]
+    if state_dict.pop("plan_validated", False):
+        return _skip_validation(state_dict)
+    chain = get_or_build("validate_plan.chain", build_chain)
+    plan_validation = invoke_with_policy(chain, _validation_inputs(state_dict), "validate_plan")
+    return _apply_validation(state_dict, plan_validation)
+
+
+async def avalidate_plan(state):
+    """Async version of validate_plan."""
+    print("---VALIDATE PLAN---")
+    state_dict = state["keys"]
+    if state_dict.pop("plan_validated", False):
+        return _skip_validation(state_dict)
+    chain = get_or_build("validate_plan.chain", build_chain)
+    plan_validation = await ainvoke_with_policy(chain, _validation_inputs(state_dict), "validate_plan")
+    return _apply_validation(state_dict, plan_validation)
+
+
 def decide_to_recreate_plan(state):
     """
     Determines whether to test code execution, or re-try answer generation.
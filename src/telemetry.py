@@ -0,0 +1,302 @@
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from config import (LLM_COMPLETION_PRICE_PER_1K, LLM_PROMPT_PRICE_PER_1K, TELEMETRY_ENABLED, TELEMETRY_JSONL_PATH,
+                    TELEMETRY_METRICS_HOST, TELEMETRY_METRICS_PORT)
+from scheduler import SCHEDULER, current_session
+
+# The numeric fields of the records that are summed into a counter, e.g. llm_coder_llm_prompt_tokens_total
+COUNTED_FIELDS = ("prompt_tokens", "completion_tokens", "prompt_bytes", "retries", "cost_usd", "wait_seconds",
+                  "prompt_chars", "prefix_chars")
+
+_current_node = contextvars.ContextVar("telemetry_node", default=None)
+_current_run = contextvars.ContextVar("telemetry_run", default=None)
+
+
+class Metrics:
+    """
+    The counters exported in the Prometheus text format. Every record of a kind and name increments the number of
+    records, the total duration, the errors and the counted fields, labelled by name and by the node that was
+    running.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        # Callables returning a dict of gauges, read at every scrape, e.g. the statistics of the scheduler
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def observe(self, record):
+        labels = (("name", record["name"]), ("node", record.get("node") or ""))
+        prefix = f"llm_coder_{record['kind']}"
+        with self._lock:
+            self._add(f"{prefix}_total", labels, 1)
+            if "duration" in record:
+                self._add(f"{prefix}_seconds_total", labels, record["duration"])
+            if record.get("error"):
+                self._add(f"{prefix}_errors_total", labels, 1)
+            for field in COUNTED_FIELDS:
+                if record.get(field):
+                    self._add(f"{prefix}_{field}_total", labels, record[field])
+
+    def _add(self, metric, labels, value):
+        key = (metric, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def register_collector(self, name, collect):
+        self._collectors[name] = collect
+
+    def render(self):
+        """
+        Returns:
+            str: The counters and the gauges of the collectors in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+        declared = set()
+        for (metric, labels), value in counters:
+            if metric not in declared:
+                lines.append(f"# TYPE {metric} counter")
+                declared.add(metric)
+            lines.append(f"{metric}{_labels(labels)} {value:g}")
+        for name, collect in sorted(self._collectors.items()):
+            for key, value in _flatten(collect()):
+                metric = f"llm_coder_{name}_{key[-1]}"
+                labels = tuple(("group", group) for group in key[:-1])
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} gauge")
+                    declared.add(metric)
+                lines.append(f"{metric}{_labels(labels)} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _flatten(stats, path=()):
+    """Yields (path, value) for the numeric values of nested dicts, e.g. (("llm",), "in_use") -> 2."""
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, path + (key,))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path + (key,), value
+
+
+class JsonlSink:
+    """Appends every record to a JSONL file, one JSON object per line."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+
+METRICS = Metrics()
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def _get_sink():
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = JsonlSink(TELEMETRY_JSONL_PATH)
+    return _sink
+
+
+def record(kind, name, duration=None, **fields):
+    """
+    Records an event: appends it to the JSONL sink and adds it to the Prometheus counters. Does nothing when the
+    telemetry is disabled.
+
+    Args:
+        kind (str): node, llm, tool or subprocess
+        name (str): The node, model, tool or program
+        duration (float): The wall time in seconds
+        **fields: The other values, e.g. prompt_tokens, retries or error
+    """
+    if not TELEMETRY_ENABLED:
+        return
+    event = {
+        "ts": time.time(),
+        "kind": kind,
+        "name": name,
+        "run_id": _current_run.get(),
+        "node": _current_node.get(),
+        "session": current_session.get(),
+    }
+    if duration is not None:
+        event["duration"] = round(duration, 6)
+    event.update(fields)
+    METRICS.observe(event)
+    _get_sink().write(event)
+
+
+@contextlib.contextmanager
+def span(kind, name, **fields):
+    """
+    Records the wall time of the block, and its error if it raises. The yielded dict can receive more fields.
+    When the telemetry is disabled the block runs untimed.
+
+    Args:
+        kind (str): node, llm, tool or subprocess
+        name (str): The node, model, tool or program
+        **fields: Fields of the record
+    """
+    if not TELEMETRY_ENABLED:
+        yield {}
+        return
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        record(kind, name, time.perf_counter() - start, **fields)
+
+
+def llm_cost(prompt_tokens, completion_tokens):
+    """
+    Returns:
+        float: The price of a call in USD, with the prices per 1000 tokens of the configuration
+    """
+    return (prompt_tokens * LLM_PROMPT_PRICE_PER_1K + completion_tokens * LLM_COMPLETION_PRICE_PER_1K) / 1000
+
+
+def _node_context(name, state):
+    keys = state.get("keys") if isinstance(state, dict) else None
+    run_id = keys.get("run_id") if isinstance(keys, dict) else None
+    return _current_node.set(name), _current_run.set(run_id)
+
+
+def _reset_node_context(tokens):
+    node_token, run_token = tokens
+    _current_node.reset(node_token)
+    _current_run.reset(run_token)
+
+
+def instrument_node(name, func):
+    """
+    Wraps a graph node so that its wall time is recorded, and the LLM, tool and subprocess records made while it
+    runs carry its name and run id. Returns the node unchanged when the telemetry is disabled.
+
+    Args:
+        name (str): The name of the node in the graph
+        func: The node, a function or a coroutine function taking the state
+
+    Returns:
+        The instrumented node
+    """
+    if not TELEMETRY_ENABLED or func is None:
+        return func
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_node(state):
+            tokens = _node_context(name, state)
+            try:
+                with span("node", name):
+                    return await func(state)
+            finally:
+                _reset_node_context(tokens)
+        return async_node
+
+    @functools.wraps(func)
+    def node(state):
+        tokens = _node_context(name, state)
+        try:
+            with span("node", name):
+                return func(state)
+        finally:
+            _reset_node_context(tokens)
+    return node
+
+
+class ToolTelemetryHandler(BaseCallbackHandler):
+    """Records the wall time and the errors of the tool calls of the agents."""
+
+    run_inline = True
+
+    def __init__(self):
+        self._started = {}
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._started[run_id] = (serialized.get("name", "tool"), time.perf_counter(), len(input_str or ""))
+
+    def _finish(self, run_id, **fields):
+        started = self._started.pop(run_id, None)
+        if started is None:
+            return
+        name, start, input_bytes = started
+        record("tool", name, time.perf_counter() - start, input_bytes=input_bytes, **fields)
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish(run_id, output_bytes=len(str(output)))
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=type(error).__name__)
+
+
+def callbacks():
+    """
+    Returns:
+        list: The callback handlers to pass to the agents so that their tool calls are recorded, empty when the
+        telemetry is disabled
+    """
+    return [ToolTelemetryHandler()] if TELEMETRY_ENABLED else []
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=TELEMETRY_METRICS_PORT, host=TELEMETRY_METRICS_HOST):
+    """
+    Serves the metrics at http://<host>:<port>/metrics in a daemon thread, only on the loopback interface by
+    default. Does nothing when the telemetry is disabled or the port is 0.
+
+    Returns:
+        ThreadingHTTPServer: The server, or None
+    """
+    if not TELEMETRY_ENABLED or not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"---METRICS SERVED AT http://{host}:{server.server_address[1]}/metrics---")
+    return server
+
+
+METRICS.register_collector("scheduler", SCHEDULER.stats)
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import shutil
 from typing import Optional
@@ -17,6 +18,16 @@ class DirectoryPathInput(BaseModel):
     path: str = Field(description="The path of the directory to create.")
 
 
+def describe_content(content: str) -> str:
+    """
+    A compact acknowledgement of written content, the content itself is not echoed back to the agent since every
+    tool result is replayed on the following turns.
+    """
+    data = content.encode()
+    lines = content.count('\n') + (1 if content and not content.endswith('\n') else 0)
+    return f"{len(data)} bytes, {lines} lines, sha256 {hashlib.sha256(data).hexdigest()[:12]}"
+
+
 def create_directory(path: str) -> str:
     """
     Creates a directory at the specified path. Cannot create files
@@ -45,7 +56,7 @@ def create_file_with_content(path: str, content: str = "") -> str:
     try:
         with open(path, 'w') as file:
             file.write(content)
-        return f"File created with content {content} at: {path}"
+        return f"File created at: {path} ({describe_content(content)})"
     except Exception as e:
         raise ToolException(f"Failed to create file with content: {str(e)}")
 
@@ -84,7 +95,7 @@ def update_file_content(path: str, content: str) -> str:
     try:
         with open(path, 'w') as file:
             file.write(content)
-        return f"File content with: {path} updated to {content}"
+        return f"File content with: {path} updated ({describe_content(content)})"
     except Exception as e:
         raise ToolException(f"Failed to update file content: {str(e)}")
 
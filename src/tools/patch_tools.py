@@ -0,0 +1,270 @@
+import difflib
+import os
+import re
+import tempfile
+from typing import NamedTuple, Optional
+
+from langchain_core.tools import StructuredTool, ToolException
+from pydantic.v1 import BaseModel, Field
+
+HUNK_HEADER = re.compile(r"^@@ -(?P<start>\d+)(?:,(?P<count>\d+))? \+\d+(?:,(?P<new_count>\d+))? @@")
+FILE_HEADERS = ("--- ", "+++ ", "diff ", "index ")
+SEARCH_MARKER = re.compile(r"^<{5,9} ?SEARCH\s*$")
+DIVIDER_MARKER = re.compile(r"^={5,9}\s*$")
+REPLACE_MARKER = re.compile(r"^>{5,9} ?REPLACE\s*$")
+# Number of context lines that can be dropped at each end of a hunk that doesn't match, like the fuzz of patch(1)
+MAX_FUZZ = 2
+
+
+class PatchError(Exception):
+    pass
+
+
+class Hunk(NamedTuple):
+    old: list
+    new: list
+    # 0-based line where the hunk is expected, None for the search/replace blocks
+    hint: Optional[int]
+    # Number of leading/trailing lines of old that are context, i.e. can be dropped when matching with fuzz
+    leading_context: int = 0
+    trailing_context: int = 0
+
+
+class ApplyPatchInput(BaseModel):
+    path: str = Field(description="The path of the file to patch, it is created if the patch only adds lines.")
+    patch: str = Field(description="The changes: either the hunks of a unified diff (lines starting with '@@', "
+                                   "' ', '-' and '+'), or search/replace blocks: '<<<<<<< SEARCH', the exact lines "
+                                   "to replace, '=======', the new lines, '>>>>>>> REPLACE'.")
+
+
+def _parse_unified(lines):
+    hunks = []
+    current = None
+    for line in lines:
+        header = HUNK_HEADER.match(line)
+        if header:
+            start = int(header.group("start"))
+            # An empty old range (-2,0) means "after line 2", otherwise the range starts at line 2
+            hint = start if header.group("count") == "0" else max(start - 1, 0)
+            current = {"old": [], "new": [], "hint": hint, "kinds": [],
+                       "old_count": int(header.group("count") or 1),
+                       "new_count": int(header.group("new_count") or 1)}
+            hunks.append(current)
+            continue
+        if current is None or line.startswith("\\ No newline"):
+            continue
+        # "--- x" is the removed line "-- x" while the hunk still expects lines, a file header after it
+        complete = len(current["old"]) >= current["old_count"] and len(current["new"]) >= current["new_count"]
+        if complete and line.startswith(FILE_HEADERS):
+            continue
+        kind, text = (line[0], line[1:]) if line else (" ", "")
+        if kind == " ":
+            current["old"].append(text)
+            current["new"].append(text)
+        elif kind == "-":
+            current["old"].append(text)
+        elif kind == "+":
+            current["new"].append(text)
+        else:
+            # A context line whose leading space was lost
+            kind = " "
+            current["old"].append(line)
+            current["new"].append(line)
+        current["kinds"].append(kind)
+
+    parsed = []
+    for hunk in hunks:
+        old_kinds = [kind for kind in hunk["kinds"] if kind != "+"]
+        leading = next((index for index, kind in enumerate(old_kinds) if kind != " "), len(old_kinds))
+        trailing = next((index for index, kind in enumerate(reversed(old_kinds)) if kind != " "), 0)
+        parsed.append(Hunk(hunk["old"], hunk["new"], hunk["hint"], leading, trailing))
+    return parsed
+
+
+def _parse_search_replace(lines):
+    hunks = []
+    state = None
+    old, new = [], []
+    for line in lines:
+        if SEARCH_MARKER.match(line):
+            state, old, new = "search", [], []
+        elif state == "search" and DIVIDER_MARKER.match(line):
+            state = "replace"
+        elif state == "replace" and REPLACE_MARKER.match(line):
+            hunks.append(Hunk(old, new, None))
+            state = None
+        elif state == "search":
+            old.append(line)
+        elif state == "replace":
+            new.append(line)
+    if state is not None:
+        raise PatchError("Unterminated search/replace block, expected '=======' and '>>>>>>> REPLACE'")
+    return hunks
+
+
+def parse_patch(patch):
+    """
+    Parses the hunks of a unified diff or the blocks of a search/replace patch.
+
+    Args:
+        patch (str): The patch
+
+    Returns:
+        list[Hunk]: The hunks, in order
+    """
+    lines = patch.splitlines()
+    if any(SEARCH_MARKER.match(line) for line in lines):
+        hunks = _parse_search_replace(lines)
+    else:
+        hunks = _parse_unified(lines)
+    if not hunks:
+        raise PatchError("No hunk found: expected unified diff hunks ('@@ -a,b +c,d @@') or search/replace blocks")
+    return hunks
+
+
+def _positions(lines, block, normalise):
+    target = [normalise(line) for line in block]
+    size = len(target)
+    return [start for start in range(len(lines) - size + 1)
+            if [normalise(line) for line in lines[start:start + size]] == target]
+
+
+def _locate(lines, hunk):
+    """
+    Finds where the old lines of a hunk are: exactly, then ignoring the whitespace, then dropping up to MAX_FUZZ
+    context lines at each end. The match closest to the hinted line wins.
+
+    Returns:
+        tuple[int, int, int]: The first line of the match, and the number of leading and trailing lines of the hunk
+        that were dropped
+    """
+    for fuzz in range(MAX_FUZZ + 1):
+        head = min(fuzz, hunk.leading_context)
+        tail = min(fuzz, hunk.trailing_context)
+        if fuzz and not head and not tail:
+            break
+        block = hunk.old[head:len(hunk.old) - tail]
+        for normalise in (lambda line: line.rstrip(), lambda line: ' '.join(line.split())):
+            matches = _positions(lines, block, normalise)
+            if not matches:
+                continue
+            if hunk.hint is None:
+                if len(matches) > 1:
+                    lines_found = ', '.join(str(match + 1) for match in matches[:5])
+                    raise PatchError(f"the search lines match {len(matches)} places (lines {lines_found}), add "
+                                     f"surrounding lines to make them unique")
+                return matches[0], head, tail
+            return min(matches, key=lambda match: abs(match - head - hunk.hint)), head, tail
+    raise PatchError("the lines to replace were not found")
+
+
+def _closest(lines, block):
+    """
+    Returns:
+        str: The region of the file that looks the most like the block, to explain a failed hunk
+    """
+    if not block or not lines:
+        return ""
+    size = len(block)
+    expected = '\n'.join(block)
+    best, best_ratio = 0, 0.0
+    for start in range(max(len(lines) - size + 1, 1)):
+        ratio = difflib.SequenceMatcher(None, expected, '\n'.join(lines[start:start + size])).quick_ratio()
+        if ratio > best_ratio:
+            best, best_ratio = start, ratio
+    region = '\n'.join(lines[best:best + size])
+    return f"\nClosest lines in the file ({best + 1}-{best + size}):\n{region}"
+
+
+def apply_hunks(content, hunks):
+    """
+    Applies all the hunks to the content, or none of them.
+
+    Args:
+        content (str): The content of the file
+        hunks (list[Hunk]): The hunks
+
+    Returns:
+        str: The new content
+    """
+    lines = content.splitlines()
+    replacements = []
+    for index, hunk in enumerate(hunks):
+        if not hunk.old:
+            # Pure addition, e.g. a new file
+            start = len(lines) if hunk.hint is None else min(hunk.hint, len(lines))
+            replacements.append((start, start, hunk.new, index))
+            continue
+        try:
+            start, head, tail = _locate(lines, hunk)
+        except PatchError as e:
+            raise PatchError(f"Hunk {index + 1} of {len(hunks)}: {e}. Expected:\n" + '\n'.join(hunk.old)
+                             + _closest(lines, hunk.old))
+        end = start + len(hunk.old) - head - tail
+        new = hunk.new[head:len(hunk.new) - tail]
+        replacements.append((start, end, new, index))
+
+    replacements.sort()
+    for (start, end, _, index), (next_start, _, _, next_index) in zip(replacements, replacements[1:]):
+        if next_start < end:
+            raise PatchError(f"Hunks {index + 1} and {next_index + 1} change the same lines")
+    for start, end, new, _ in reversed(replacements):
+        lines[start:end] = new
+
+    trailing_newline = content.endswith('\n') or not content
+    return '\n'.join(lines) + ('\n' if trailing_newline and lines else '')
+
+
+def _write_atomically(path, content):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=".patch-")
+    try:
+        with os.fdopen(descriptor, 'w') as file:
+            file.write(content)
+        if os.path.exists(path):
+            os.chmod(temporary, os.stat(path).st_mode)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def apply_patch(path: str, patch: str) -> str:
+    """
+    Applies a unified diff or search/replace blocks to a file. Either every hunk is applied or the file is left
+    unchanged.
+    """
+    try:
+        content = ""
+        if os.path.exists(path):
+            with open(path) as file:
+                content = file.read()
+        hunks = parse_patch(patch)
+        if not os.path.exists(path) and any(hunk.old for hunk in hunks):
+            raise PatchError(f"{path} doesn't exist, a patch creating it can only add lines")
+        new_content = apply_hunks(content, hunks)
+        _write_atomically(path, new_content)
+    except (PatchError, OSError, UnicodeDecodeError) as e:
+        raise ToolException(f"Patch not applied to {path}, the file is unchanged. {e}")
+
+    diff = difflib.unified_diff(content.splitlines(), new_content.splitlines(), lineterm="", n=0)
+    added = removed = 0
+    for line in diff:
+        if line.startswith('+') and not line.startswith('+++'):
+            added += 1
+        elif line.startswith('-') and not line.startswith('---'):
+            removed += 1
+    return f"Applied {len(hunks)} hunk(s) to {path}: {added} line(s) added, {removed} line(s) removed"
+
+
+apply_patch_tool = StructuredTool.from_function(
+    func=apply_patch,
+    name="ApplyPatch",
+    description="Changes part of a file with a unified diff or search/replace blocks, without rewriting the whole "
+                "file. Small differences in the context lines and in whitespace are tolerated. Either every hunk is "
+                "applied or the file is left unchanged.",
+    args_schema=ApplyPatchInput,
+    handle_tool_error=True
+)
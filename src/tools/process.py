@@ -0,0 +1,73 @@
+import asyncio
+import os
+import subprocess
+import time
+
+import telemetry
+from scheduler import SCHEDULER
+
+
+def program_name(command):
+    """
+    Returns:
+        str: The program a command runs, e.g. "pytest" for "python -m pytest ...", to label its telemetry
+    """
+    if "-m" in command[:-1]:
+        return command[command.index("-m") + 1]
+    return os.path.basename(str(command[0]))
+
+
+def run_command(command, **kwargs):
+    """
+    subprocess.run, with the duration of the command recorded by the telemetry.
+
+    Args:
+        command (list[str]): The command
+        **kwargs: Passed to subprocess.run
+
+    Returns:
+        subprocess.CompletedProcess: The finished process
+    """
+    with telemetry.span("subprocess", program_name(command)) as fields:
+        result = subprocess.run(command, **kwargs)
+        fields["returncode"] = result.returncode
+    return result
+
+
+async def arun_command(command, check=False, capture_output=True):
+    """
+    Runs a command without blocking the event loop, the async counterpart of subprocess.run(..., text=True). The
+    command waits for a slot of the scheduler's subprocess limiter, its duration is recorded by the telemetry.
+
+    Args:
+        command (list[str]): The command
+        check (bool): Raise CalledProcessError if the command fails
+        capture_output (bool): Capture stdout and stderr instead of inheriting them
+
+    Returns:
+        subprocess.CompletedProcess: The finished process, with its output decoded
+    """
+    pipe = asyncio.subprocess.PIPE if capture_output else None
+    queued = time.perf_counter()
+    async with SCHEDULER.subprocesses.slot():
+        with telemetry.span("subprocess", program_name(command),
+                            wait_seconds=time.perf_counter() - queued) as fields:
+            process = await asyncio.create_subprocess_exec(*command, stdout=pipe, stderr=pipe)
+            try:
+                stdout, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+            fields["returncode"] = process.returncode
+
+    result = subprocess.CompletedProcess(
+        command,
+        process.returncode,
+        stdout.decode(errors="replace") if stdout is not None else None,
+        stderr.decode(errors="replace") if stderr is not None else None,
+    )
+    if check:
+        result.check_returncode()
+    return result
@@ -0,0 +1,199 @@
+import hashlib
+import re
+import xml.etree.ElementTree as ET
+from typing import NamedTuple, Optional
+
+from config import DIGEST_TOKEN_BUDGET
+
+# "src/mod.py:12: in func" for the intermediate frames, "src/mod.py:15: ValueError" for the last one
+FRAME_PATTERN = re.compile(
+    r"^(?P<path>\S+\.py):(?P<line>\d+):(?: in (?P<function>\S+)| (?P<exc_type>[A-Za-z_][\w.]*))?\s*$"
+)
+# Rough number of characters per token, to turn the token budget into a character budget
+CHARS_PER_TOKEN = 4
+
+
+class TestOutcome(NamedTuple):
+    nodeid: str
+    file: str
+    outcome: str
+    duration: float
+    exc_type: Optional[str] = None
+    message: Optional[str] = None
+    frames: tuple = ()
+    error_lines: tuple = ()
+
+
+def _is_project_frame(path):
+    return "site-packages" not in path and "/lib/python" not in path
+
+
+def _parse_failure(element):
+    """
+    Extracts the exception type, message, project frames and "E" lines of a junit failure/error element.
+    """
+    message = element.get("message") or ""
+    text = element.text or ""
+    frames = []
+    error_lines = []
+    exc_type = None
+    for line in text.splitlines():
+        match = FRAME_PATTERN.match(line)
+        if match:
+            if match.group("exc_type"):
+                exc_type = match.group("exc_type")
+            if _is_project_frame(match.group("path")):
+                location = f"{match.group('path')}:{match.group('line')}"
+                if match.group("function"):
+                    location += f" in {match.group('function')}"
+                frames.append(location)
+        elif line.startswith("E   "):
+            error_lines.append(line[1:].strip())
+
+    if exc_type is None and message.startswith("assert"):
+        exc_type = "AssertionError"
+    return exc_type, message, tuple(frames), tuple(error_lines)
+
+
+def junit_args(junit_xml):
+    """
+    Returns:
+        list[str]: The pytest arguments writing the report parsed by parse_junit
+    """
+    return ["-o", "junit_family=xunit1", f"--junitxml={junit_xml}"]
+
+
+def parse_junit(junit_xml):
+    """
+    Reads the per-test results of a junit report written by pytest (junit_family=xunit1).
+
+    Args:
+        junit_xml (str): The path to the report
+
+    Returns:
+        list[TestOutcome]: The outcome of every test case, empty if the report can't be read
+    """
+    try:
+        root = ET.parse(junit_xml).getroot()
+    except (OSError, ET.ParseError):
+        return []
+
+    outcomes = []
+    for case in root.iter("testcase"):
+        file = case.get("file") or ""
+        name = case.get("name") or ""
+        nodeid = f"{file}::{name}" if file else f"{case.get('classname')}::{name}"
+        duration = float(case.get("time") or 0)
+        outcome = "passed"
+        details = (None, None, (), ())
+        for child in case:
+            if child.tag in ("failure", "error"):
+                outcome = "failed" if child.tag == "failure" else "error"
+                details = _parse_failure(child)
+                break
+            if child.tag == "skipped":
+                outcome = "skipped"
+        outcomes.append(TestOutcome(nodeid, file, outcome, duration, *details))
+    return outcomes
+
+
+def count_outcomes(outcomes):
+    """
+    Returns:
+        dict: The number of tests per outcome (passed, failed, error, skipped)
+    """
+    counts = {"passed": 0, "failed": 0, "error": 0, "skipped": 0}
+    for outcome in outcomes:
+        counts[outcome.outcome] += 1
+    return counts
+
+
+def _normalise(message):
+    """Removes the details that differ between occurrences of the same failure (numbers, addresses)."""
+    message = re.sub(r"0x[0-9a-fA-F]+", "0x?", message)
+    message = re.sub(r"\d+(\.\d+)?", "N", message)
+    return message.strip()[:200]
+
+
+def failure_signature(outcome):
+    """
+    Identifies a failure by its exception type, normalised message and the file and function of the deepest project
+    frame, so that the same error hit by several tests is only reported once. The line number is left out, an edit
+    above the failing line doesn't make it another failure.
+    """
+    location = re.sub(r":\d+(?= in |$)", "", outcome.frames[-1]) if outcome.frames else ""
+    return outcome.exc_type or "", _normalise(outcome.message or ""), location
+
+
+def failure_fingerprint(outcomes, raw_output=""):
+    """
+    Identifies the failures of a run by the set of their signatures, or by the normalised last line of the output
+    when the run has no structured result (e.g. pip or pytest crashed). Two runs failing the same way have the same
+    fingerprint, whatever the order of the tests, the numbers in the messages or the lines where the failures moved
+    to.
+
+    Args:
+        outcomes (list[TestOutcome]): The results of the run
+        raw_output (str): The output of the run
+
+    Returns:
+        str: The fingerprint, a short hash
+    """
+    signatures = sorted({failure_signature(outcome) for outcome in outcomes if outcome.outcome in ("failed", "error")})
+    if signatures:
+        material = repr(signatures)
+    else:
+        lines = [line for line in raw_output.splitlines() if line.strip()]
+        material = _normalise(lines[-1] if lines else "")
+    return hashlib.sha256(material.encode()).hexdigest()[:16]
+
+
+def failure_digest(outcomes, raw_output="", token_budget=DIGEST_TOKEN_BUDGET):
+    """
+    Builds a compact, deduplicated description of the failures that fits in a token budget.
+
+    Args:
+        outcomes (list[TestOutcome]): The results of the run
+        raw_output (str): The output of the run, its end is used when no structured failure is available
+        token_budget (int): The maximum size of the digest in tokens (approximately)
+
+    Returns:
+        str: The digest
+    """
+    budget = token_budget * CHARS_PER_TOKEN
+    failures = [outcome for outcome in outcomes if outcome.outcome in ("failed", "error")]
+    if not failures:
+        # e.g. the run crashed before writing its report
+        tail = raw_output[-budget:]
+        return f"No structured test results available, end of the test output:\n{tail}"
+
+    groups = {}
+    for failure in failures:
+        groups.setdefault(failure_signature(failure), []).append(failure)
+
+    counts = count_outcomes(outcomes)
+    header = (f"{counts['failed'] + counts['error']} of {len(outcomes)} tests failed "
+              f"({len(groups)} distinct failures):\n")
+    parts = [header]
+    used = len(header)
+    for index, (signature, group) in enumerate(groups.items()):
+        first = group[0]
+        tests = ", ".join(failure.nodeid for failure in group[:5])
+        if len(group) > 5:
+            tests += f" (+{len(group) - 5} more)"
+        message = (first.message or '').splitlines()[0] if first.message else ''
+        kind = first.exc_type or first.outcome
+        title = message if message.startswith(kind) else f"{kind}: {message}"
+        lines = [f"\n[{index + 1}] {title}".rstrip(),
+                 f"    tests: {tests}"]
+        lines.extend(f"    at {frame}" for frame in first.frames[-6:])
+        lines.extend(f"    {line}" for line in first.error_lines[:8])
+        block = '\n'.join(lines) + '\n'
+        if index == 0:
+            block = block[:budget - used]
+        elif used + len(block) > budget:
+            parts.append(f"\n[{len(groups) - index} more distinct failures omitted]\n")
+            break
+        parts.append(block)
+        used += len(block)
+    return ''.join(parts)
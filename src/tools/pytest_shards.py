@@ -0,0 +1,165 @@
+import asyncio
+import heapq
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.process import arun_command, run_command
+from tools.pytest_report import count_outcomes, junit_args, parse_junit
+from tools.test_selection import is_test_file, python_files
+
+DURATIONS_FILE = os.path.join(".llm_coder", "test_durations.json")
+
+# pytest exit code when no test was collected
+NO_TESTS_COLLECTED = 5
+
+
+def durations_path(test_dir):
+    """The recorded durations live in the project folder, the parent of the test folder."""
+    return os.path.join(os.path.dirname(os.path.abspath(test_dir)), DURATIONS_FILE)
+
+
+def load_durations(test_dir):
+    try:
+        with open(durations_path(test_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_durations(test_dir, durations):
+    path = durations_path(test_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(durations, f)
+
+
+def collect_test_files(test_dir):
+    return [path for path in python_files(test_dir) if is_test_file(os.path.basename(path))]
+
+
+def split_into_shards(test_files, durations, shard_count):
+    """
+    Splits the test files into balanced shards: the longest files first, each one to the least loaded shard. Files
+    without a recorded duration count as the average duration.
+
+    Args:
+        test_files (list[str]): The test files
+        durations (dict): test file -> duration of its last run in seconds
+        shard_count (int): The maximum number of shards
+
+    Returns:
+        list[list[str]]: The non empty shards
+    """
+    known = [durations[path] for path in test_files if path in durations]
+    default = sum(known) / len(known) if known else 1.0
+    weighted = sorted(((durations.get(path, default), path) for path in test_files), reverse=True)
+
+    heap = [(0.0, index) for index in range(min(shard_count, len(test_files)))]
+    shards = [[] for _ in heap]
+    for duration, path in weighted:
+        load, index = heapq.heappop(heap)
+        shards[index].append(path)
+        heapq.heappush(heap, (load + duration, index))
+    return [sorted(shard) for shard in shards if shard]
+
+
+def _file_durations(outcomes, shard):
+    """
+    Sums the durations of the test cases per test file of the shard.
+    """
+    durations = {}
+    for outcome in outcomes:
+        for path in shard:
+            if outcome.file and path.endswith(outcome.file):
+                durations[path] = durations.get(path, 0.0) + outcome.duration
+                break
+    return durations
+
+
+def _merge_returncodes(returncodes):
+    """Same semantics as a single run: 0 if everything passed, 1 if tests failed, 5 only if no test at all."""
+    relevant = [code for code in returncodes if code != NO_TESTS_COLLECTED]
+    if not relevant:
+        return NO_TESTS_COLLECTED
+    if all(code == 0 for code in relevant):
+        return 0
+    return 1 if 1 in relevant else max(relevant)
+
+
+def run_sharded(test_dir, venv_python_path, test_files, workers):
+    """
+    Runs the test files in parallel pytest processes of the venv, balanced with the durations recorded by the
+    previous runs, and merges the results.
+
+    Args:
+        test_dir (str): The test folder
+        venv_python_path (str): The path to the Python executable inside the venv
+        test_files (list[str]): The test files to run, None for all the files of the test folder
+        workers (int): The maximum number of parallel pytest processes
+
+    Returns:
+        tuple[list[str], int, str, list[TestOutcome]]: The commands, the merged exit code, the merged output and
+        the outcomes of all the tests
+    """
+    if test_files is None:
+        test_files = collect_test_files(test_dir)
+    durations = load_durations(test_dir)
+    shards = split_into_shards(test_files, durations, workers)
+
+    with tempfile.TemporaryDirectory() as report_dir:
+        def run_shard(index):
+            junit_xml = os.path.join(report_dir, f"shard-{index}.xml")
+            command = [venv_python_path, "-m", "pytest", *junit_args(junit_xml), *shards[index]]
+            result = run_command(command, capture_output=True, text=True)
+            return command, result, parse_junit(junit_xml)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(shards) or 1) as executor:
+            results = list(executor.map(run_shard, range(len(shards))))
+        elapsed = time.monotonic() - start
+
+    return _merge_results(test_dir, durations, shards, results, elapsed)
+
+
+async def arun_sharded(test_dir, venv_python_path, test_files, workers):
+    """Async version of run_sharded, the shards run as concurrent subprocesses of the event loop."""
+    if test_files is None:
+        test_files = collect_test_files(test_dir)
+    durations = load_durations(test_dir)
+    shards = split_into_shards(test_files, durations, workers)
+
+    with tempfile.TemporaryDirectory() as report_dir:
+        async def run_shard(index):
+            junit_xml = os.path.join(report_dir, f"shard-{index}.xml")
+            command = [venv_python_path, "-m", "pytest", *junit_args(junit_xml), *shards[index]]
+            result = await arun_command(command)
+            return command, result, parse_junit(junit_xml)
+
+        start = time.monotonic()
+        results = await asyncio.gather(*(run_shard(index) for index in range(len(shards))))
+        elapsed = time.monotonic() - start
+
+    return _merge_results(test_dir, durations, shards, results, elapsed)
+
+
+def _merge_results(test_dir, durations, shards, results, elapsed):
+    """
+    Merges the outputs, exit codes and outcomes of the shards and records the new durations.
+    """
+    outputs = []
+    outcomes = []
+    for index, (command, result, shard_outcomes) in enumerate(results):
+        durations.update(_file_durations(shard_outcomes, shards[index]))
+        outcomes.extend(shard_outcomes)
+        outputs.append(f"---SHARD {index + 1}/{len(shards)} ({len(shards[index])} files)---\n"
+                       f"{result.stdout}\n{result.stderr}")
+    save_durations(test_dir, durations)
+
+    returncode = _merge_returncodes([result.returncode for _, result, _ in results])
+    counts = count_outcomes(outcomes)
+    outputs.append(f"===== {counts['failed'] + counts['error']} failed, {counts['passed']} passed, "
+                   f"{counts['skipped']} skipped in {elapsed:.2f}s ({len(shards)} shards) =====")
+    return [command for command, _, _ in results], returncode, '\n'.join(outputs), outcomes
@@ -1,34 +1,102 @@
+import os
+import tempfile
+
 from langchain_core.pydantic_v1 import BaseModel, Field
-import subprocess
+from typing import NamedTuple, Optional
 
 from langchain_core.tools import ToolException, StructuredTool
 
+from config import PYTEST_SHARD_MIN_FILES, PYTEST_WORKERS
+from tools.pytest_report import TestOutcome, junit_args, parse_junit
+from tools.process import arun_command, run_command
+from tools.pytest_shards import arun_sharded, collect_test_files, run_sharded
+
 
 class TestDirectoryInput(BaseModel):
     test_dir: str = Field(description="The directory containing tests to run with pytest")
     venv_python_path: str = Field(description="The path to the Python executable inside the venv")
 
 
+class PytestRun(NamedTuple):
+    command: list[str]
+    returncode: int
+    output: str
+    outcomes: list[TestOutcome] = []
+
+
+def execute_pytest(test_dir: str, venv_python_path: str, test_files: Optional[list[str]] = None,
+                   workers: int = PYTEST_WORKERS) -> PytestRun:
+    """
+    Runs pytest on all tests in the specified directory within a specified venv, or only on the given test files.
+    When several workers are allowed and there are enough test files, the files are sharded across parallel pytest
+    processes.
+
+    Returns:
+        PytestRun: The command, its exit code, its output (stdout + stderr) and the per-test outcomes
+    """
+    if workers > 1:
+        files = test_files if test_files is not None else collect_test_files(test_dir)
+        if len(files) >= PYTEST_SHARD_MIN_FILES:
+            commands, returncode, output, outcomes = run_sharded(test_dir, venv_python_path, files, workers)
+            return PytestRun(commands[0], returncode, output, outcomes)
+
+    targets = test_files if test_files is not None else [test_dir]
+    with tempfile.TemporaryDirectory() as report_dir:
+        junit_xml = os.path.join(report_dir, "report.xml")
+        result = run_command([venv_python_path, "-m", "pytest", *junit_args(junit_xml), *targets],
+                                capture_output=True, text=True)
+        outcomes = parse_junit(junit_xml)
+    return PytestRun([venv_python_path, "-m", "pytest", *targets], result.returncode,
+                     result.stdout + "\n" + result.stderr, outcomes)
+
+
+async def aexecute_pytest(test_dir: str, venv_python_path: str, test_files: Optional[list[str]] = None,
+                          workers: int = PYTEST_WORKERS) -> PytestRun:
+    """Async version of execute_pytest."""
+    if workers > 1:
+        files = test_files if test_files is not None else collect_test_files(test_dir)
+        if len(files) >= PYTEST_SHARD_MIN_FILES:
+            commands, returncode, output, outcomes = await arun_sharded(test_dir, venv_python_path, files, workers)
+            return PytestRun(commands[0], returncode, output, outcomes)
+
+    targets = test_files if test_files is not None else [test_dir]
+    with tempfile.TemporaryDirectory() as report_dir:
+        junit_xml = os.path.join(report_dir, "report.xml")
+        result = await arun_command([venv_python_path, "-m", "pytest", *junit_args(junit_xml), *targets])
+        outcomes = parse_junit(junit_xml)
+    return PytestRun([venv_python_path, "-m", "pytest", *targets], result.returncode,
+                     result.stdout + "\n" + result.stderr, outcomes)
+
+
 def run_pytest_in_directory(test_dir: str, venv_python_path: str) -> str:
     """Runs pytest on all tests in the specified directory within a specified venv, returning detailed output."""
-    python_executable = venv_python_path
-    pytest_command = [python_executable, "-m", "pytest", test_dir]
-
     try:
-        result = subprocess.run(pytest_command, capture_output=True, text=True, check=True)
-        output = result.stdout + "\n" + result.stderr
-        return f"Tests executed successfully:\n{output}"
-    except subprocess.CalledProcessError as e:
-        # This captures errors from the subprocess itself and includes full output (stdout + stderr)
-        full_output = e.stdout + "\n" + e.stderr
-        raise ToolException(f"Failed to run tests with detailed output:\n{pytest_command}\n{full_output}\n")
+        run = execute_pytest(test_dir, venv_python_path)
     except Exception as e:
         # This captures any other exceptions, e.g., if the subprocess call fails to execute
-        raise ToolException(f"Failed to run tests: \n{pytest_command}\n{str(e)}")
+        raise ToolException(f"Failed to run tests: \n{[venv_python_path, '-m', 'pytest', test_dir]}\n{str(e)}")
+
+    if run.returncode != 0:
+        # This captures errors from the subprocess itself and includes full output (stdout + stderr)
+        raise ToolException(f"Failed to run tests with detailed output:\n{run.command}\n{run.output}\n")
+    return f"Tests executed successfully:\n{run.output}"
+
+
+async def arun_pytest_in_directory(test_dir: str, venv_python_path: str) -> str:
+    """Async version of run_pytest_in_directory."""
+    try:
+        run = await aexecute_pytest(test_dir, venv_python_path)
+    except Exception as e:
+        raise ToolException(f"Failed to run tests: \n{[venv_python_path, '-m', 'pytest', test_dir]}\n{str(e)}")
+
+    if run.returncode != 0:
+        raise ToolException(f"Failed to run tests with detailed output:\n{run.command}\n{run.output}\n")
+    return f"Tests executed successfully:\n{run.output}"
 
 
 run_pytest_tool = StructuredTool.from_function(
     func=run_pytest_in_directory,
+    coroutine=arun_pytest_in_directory,
     name="RunPytest",
     description="Runs pytest on all tests in the specified directory within a specified venv.",
     args_schema=TestDirectoryInput,
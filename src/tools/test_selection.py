@@ -0,0 +1,213 @@
+import ast
+import hashlib
+import json
+import os
+
+from config import TEST_FULL_RUN_EVERY
+
+STATE_FILE = os.path.join(".llm_coder", "test_selection.json")
+
+
+def is_test_file(name):
+    """test_*.py or *_test.py, as collected by pytest"""
+    return name.endswith(".py") and (name.startswith("test_") or name.endswith("_test.py"))
+
+
+def python_files(directory):
+    """The python files of a directory and its sub-directories, hidden and cache folders excluded"""
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and d != "__pycache__"]
+        files.extend(os.path.join(root, name) for name in names if name.endswith(".py"))
+    return sorted(files)
+
+
+def _module_name(path, source_dir):
+    """src/pkg/mod.py -> pkg.mod, src/pkg/__init__.py -> pkg"""
+    parts = os.path.relpath(path, source_dir)[:-3].split(os.sep)
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    return ".".join(parts)
+
+
+def _project_module_name(path, project_dir):
+    """The module name relative to the project folder, e.g. src.pkg.mod, None if the file is outside the project"""
+    relative = os.path.relpath(path, project_dir)
+    if relative.startswith(os.pardir + os.sep):
+        return None
+    return _module_name(path, project_dir)
+
+
+def _imported_names(path, module):
+    """
+    Returns the names of the modules imported by a file, found by static analysis. For "from a import b" both "a" and
+    "a.b" are returned since b can be a module or an attribute. Relative imports are resolved against the module name.
+    """
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = set()
+    package = module.split(".")[:-1] if not path.endswith("__init__.py") else module.split(".")
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                base = package[:len(package) - node.level + 1]
+                prefix = ".".join(base + ([node.module] if node.module else []))
+            else:
+                prefix = node.module or ""
+            if prefix:
+                names.add(prefix)
+            names.update(f"{prefix}.{alias.name}" if prefix else alias.name for alias in node.names)
+    return names
+
+
+class TestSelector:
+    """
+    Selects the tests affected by the files changed since the last green run.
+
+    A map from every python file to the modules it imports is built by static import analysis and stored in the
+    project, the imports of a file are only parsed again when its mtime or size changed. A test is affected if it
+    changed itself or if one of the source modules it (transitively) imports changed. The source modules are known
+    both by their name in the source folder (pkg.mod) and in the project folder (src.pkg.mod), and a test importing
+    a project module that can't be resolved depends on all of them. A full run is forced when there is no green run
+    yet, when a non-test file of the test folder (conftest, helpers) changed, when source files changed but no test
+    was selected, and every TEST_FULL_RUN_EVERY selective runs as a safety net.
+    """
+
+    def __init__(self, project_folder, source_folder, test_folder, full_run_every=TEST_FULL_RUN_EVERY):
+        self.project_folder = os.path.abspath(project_folder)
+        self.source_folder = os.path.abspath(source_folder)
+        self.test_folder = os.path.abspath(test_folder)
+        self.full_run_every = full_run_every
+        self.state_path = os.path.join(project_folder, STATE_FILE)
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"files": {}, "green": None, "selective_runs": 0}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, 'w') as f:
+            json.dump(self.state, f)
+
+    def _refresh(self):
+        """
+        Refreshes the entries of the files that changed.
+
+        Returns:
+            dict: path -> entry with the stat key, the content hash and the imported module names
+        """
+        previous = self.state["files"]
+        files = {}
+        for root in (self.source_folder, self.test_folder):
+            for path in python_files(root):
+                stat = os.stat(path)
+                key = [stat.st_mtime_ns, stat.st_size]
+                entry = previous.get(path)
+                if entry is None or entry["key"] != key:
+                    with open(path, 'rb') as f:
+                        digest = hashlib.sha256(f.read()).hexdigest()
+                    module = _module_name(path, root)
+                    try:
+                        imports = sorted(_imported_names(path, module))
+                    except SyntaxError:
+                        imports = []
+                    entry = {"key": key, "hash": digest, "imports": imports}
+                files[path] = entry
+        self.state["files"] = files
+        return files
+
+    def _source_dependencies(self, files):
+        """
+        Returns:
+            dict: test path -> the set of source paths it imports directly or transitively
+        """
+        sources = [path for path in files if path.startswith(self.source_folder + os.sep)]
+        modules = {}
+        for path in sources:
+            modules[_module_name(path, self.source_folder)] = path
+            project_name = _project_module_name(path, self.project_folder)
+            if project_name:
+                modules.setdefault(project_name, path)
+        # The first part of the module names, an import starting with one of them is an import of the project
+        local_roots = {name.split(".")[0] for name in modules}
+        everything = set(sources)
+
+        def resolve(names):
+            paths = set()
+            for name in names:
+                if name in modules:
+                    paths.add(modules[name])
+                    continue
+                parts = name.split(".")
+                # "from pkg.mod import attr" also gives pkg.mod.attr, resolved by its module
+                resolved = any(".".join(parts[:end]) in modules for end in range(1, len(parts)))
+                if not resolved and parts[0] in local_roots:
+                    # A project module the analysis can't find, e.g. a namespace package: depends on everything
+                    return everything
+            return paths
+
+        dependencies = {}
+        for path, entry in files.items():
+            if not is_test_file(os.path.basename(path)) or path.startswith(self.source_folder + os.sep):
+                continue
+            seen = set()
+            pending = list(resolve(entry["imports"]))
+            while pending:
+                current = pending.pop()
+                if current in seen:
+                    continue
+                seen.add(current)
+                pending.extend(resolve(files[current]["imports"]) - seen)
+            dependencies[path] = seen
+        return dependencies
+
+    def select(self):
+        """
+        Returns:
+            list[str]: The test files to run, or None if the full suite must run
+        """
+        files = self._refresh()
+        self._save()
+        green = self.state["green"]
+        if green is None or self.state["selective_runs"] >= self.full_run_every:
+            return None
+
+        changed = {path for path, entry in files.items() if green.get(path) != entry["hash"]}
+        for path in changed:
+            in_tests = path.startswith(self.test_folder + os.sep)
+            if in_tests and not is_test_file(os.path.basename(path)):
+                return None
+        # A deleted module can't be found in the import map anymore
+        if any(path not in files for path in green):
+            return None
+
+        selected = []
+        for test, dependencies in self._source_dependencies(files).items():
+            if test in changed or dependencies & changed:
+                selected.append(test)
+        if changed and not selected:
+            # Source files changed but no test seems to import them, the import map may be missing a link
+            return None
+        return sorted(selected)
+
+    def record_run(self, selected, passed):
+        """
+        Records a test run. A passing run becomes the new reference for the change detection.
+
+        Args:
+            selected (list[str]): The test files that ran, None for a full run
+            passed (bool): True if the tests passed
+        """
+        if selected is None:
+            self.state["selective_runs"] = 0
+        else:
+            self.state["selective_runs"] += 1
+        if passed:
+            self.state["green"] = {path: entry["hash"] for path, entry in self.state["files"].items()}
+        self._save()
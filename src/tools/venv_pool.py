@@ -0,0 +1,184 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+from config import VENV_POOL_DIR, VENV_POOL_PACKAGES, VENV_POOL_SIZE, VENV_PYTHON
+from tools.process import run_command
+
+_lock = threading.Lock()
+_refill_lock = threading.Lock()
+# The templates that could not be built (e.g. pip can't reach the index), they are not tried again by the process
+_failed_templates = set()
+
+
+def _template_path():
+    """
+    The template depends on the interpreter and the packages, so changing one of them builds a new template.
+    """
+    python = shutil.which(VENV_PYTHON) or VENV_PYTHON
+    key = hashlib.sha256(f"{os.path.realpath(python)}|{' '.join(VENV_POOL_PACKAGES)}".encode()).hexdigest()[:12]
+    return os.path.join(VENV_POOL_DIR, f"template-{key}")
+
+
+def _ready_dir():
+    """
+    The ready clones refer to the prefix of their template, so each template has its own folder of clones.
+    """
+    return _template_path() + "-ready"
+
+
+def build_template():
+    """
+    Builds the template venv with the pool packages installed, if it doesn't exist yet.
+
+    Returns:
+        str: The path of the template venv
+
+    Raises:
+        RuntimeError: If the template can't be built, or could not be built earlier
+    """
+    template = _template_path()
+    marker = os.path.join(template, ".ready")
+    with _lock:
+        if template in _failed_templates:
+            raise RuntimeError("The venv template could not be built")
+        if not os.path.exists(marker):
+            print("---BUILDING VENV TEMPLATE---")
+            shutil.rmtree(template, ignore_errors=True)
+            try:
+                run_command([VENV_PYTHON, "-m", "venv", template], check=True)
+                if VENV_POOL_PACKAGES:
+                    run_command([os.path.join(template, "bin", "python"), "-m", "pip", "install", "--quiet",
+                                 "--upgrade", *VENV_POOL_PACKAGES], check=True)
+            except Exception as e:
+                _failed_templates.add(template)
+                shutil.rmtree(template, ignore_errors=True)
+                raise RuntimeError(f"The venv template could not be built: {e}") from e
+            open(marker, 'w').close()
+    return template
+
+
+def _copy(src, dst):
+    """
+    Hard links a file when possible, copies it otherwise (e.g. across filesystems).
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def clone_template(path):
+    """
+    Clones the template venv at the given path. The site-packages are hard linked, the scripts of "bin" are copied
+    because their content is rewritten when the venv is relocated.
+
+    Args:
+        path (str): The path of the new venv, it must not exist
+    """
+    template = build_template()
+    os.makedirs(path)
+    for name in os.listdir(template):
+        if name == ".ready":
+            continue
+        src = os.path.join(template, name)
+        dst = os.path.join(path, name)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+        elif name == "bin":
+            shutil.copytree(src, dst, symlinks=True)
+        elif os.path.isdir(src):
+            shutil.copytree(src, dst, symlinks=True, copy_function=_copy)
+        else:
+            shutil.copy2(src, dst)
+
+
+def relocate(path, old_prefix):
+    """
+    Rewrites the scripts (shebangs, activate scripts) and pyvenv.cfg that refer to the old prefix of a moved venv,
+    e.g. the template it was cloned from.
+    """
+    old = old_prefix.encode()
+    new = os.path.abspath(path).encode()
+    bin_dir = os.path.join(path, "bin")
+    candidates = [os.path.join(bin_dir, name) for name in os.listdir(bin_dir)] + [os.path.join(path, "pyvenv.cfg")]
+    for candidate in candidates:
+        if os.path.islink(candidate) or not os.path.isfile(candidate):
+            continue
+        with open(candidate, 'rb') as file:
+            content = file.read()
+        if old in content:
+            with open(candidate, 'wb') as file:
+                file.write(content.replace(old, new))
+
+
+def refill():
+    """
+    Creates ready clones until the pool is full. Only one refill runs at a time.
+    """
+    if not _refill_lock.acquire(blocking=False):
+        return
+    try:
+        os.makedirs(_ready_dir(), exist_ok=True)
+        while len(os.listdir(_ready_dir())) < VENV_POOL_SIZE:
+            staging = os.path.join(VENV_POOL_DIR, f"staging-{uuid.uuid4().hex}")
+            clone_template(staging)
+            os.rename(staging, os.path.join(_ready_dir(), uuid.uuid4().hex))
+    except Exception as e:
+        print(f"Failed to refill the venv pool: {e}")
+    finally:
+        _refill_lock.release()
+
+
+def refill_in_background():
+    """
+    Refills the pool in a daemon thread.
+    """
+    threading.Thread(target=refill, name="venv-pool-refill", daemon=True).start()
+
+
+def warm():
+    """
+    Builds the template and fills the pool in the background, to be called when the process starts.
+    """
+    if VENV_POOL_SIZE > 0:
+        refill_in_background()
+
+
+def acquire(path):
+    """
+    Provides a ready venv at the given path: a pre-built clone is moved there if one is available, otherwise the
+    template is cloned directly. The pool is refilled in the background.
+
+    Args:
+        path (str): The path of the new venv, it must not exist
+
+    Returns:
+        str: The path to the python executable of the venv
+    """
+    template = build_template()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    ready = None
+    try:
+        for name in os.listdir(_ready_dir()):
+            candidate = os.path.join(_ready_dir(), name)
+            try:
+                # rename is atomic, so two sessions never get the same clone
+                os.rename(candidate, path)
+                ready = path
+                break
+            except FileNotFoundError:
+                continue
+            except OSError:
+                # The pool is on another filesystem
+                break
+    except FileNotFoundError:
+        pass
+
+    if ready is None:
+        clone_template(path)
+    relocate(path, template)
+    refill_in_background()
+    return os.path.join(path, "bin", "python")
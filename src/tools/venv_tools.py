@@ -1,20 +1,87 @@
+import asyncio
+import contextlib
+import hashlib
+import json
 import os
+import re
+import shutil
+import threading
 
 from langchain_core.pydantic_v1 import BaseModel, Field
-import subprocess
 
 from langchain_core.tools import ToolException, StructuredTool
 
+from config import VENV_POOL_SIZE, VENV_PYTHON, WHEELHOUSE_DIR
+from tools import venv_pool
+from tools.process import arun_command, run_command
+
 
 class VirtualEnvInput(BaseModel):
     path: str = Field(description="The path where the virtual environment should be created.")
 
 
+def _pool_failed(path, error):
+    """Removes what the pool left at the path of the venv, before it is created from scratch."""
+    print(f"---VENV POOL UNAVAILABLE ({error}), CREATING A PLAIN VENV---")
+    shutil.rmtree(path, ignore_errors=True)
+
+
+async def _aacquire_from_pool(path):
+    """
+    Runs venv_pool.acquire in a worker thread. A thread can't be cancelled, so a cancelled caller waits for it to
+    finish before cleaning up, instead of removing a venv that is still being cloned.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(venv_pool.acquire, path))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        with contextlib.suppress(Exception):
+            await future
+        raise
+
+
+def provision_virtual_env(path: str) -> str:
+    """
+    Creates a virtual environment at the specified path. A pre-built venv of the pool is used when the pool is
+    enabled and the path is free, otherwise, or if the pool can't provide one (e.g. its template can't be built
+    offline), the venv is created from scratch.
+
+    Returns:
+        str: The path to the python executable
+    """
+    if VENV_POOL_SIZE > 0 and not os.path.exists(path):
+        try:
+            return venv_pool.acquire(path)
+        except Exception as e:
+            _pool_failed(path, e)
+    run_command([VENV_PYTHON, "-m", "venv", path], check=True)
+    return os.path.join(path, "bin", "python")
+
+
+async def aprovision_virtual_env(path: str) -> str:
+    """Async version of provision_virtual_env."""
+    if VENV_POOL_SIZE > 0 and not os.path.exists(path):
+        try:
+            return await _aacquire_from_pool(path)
+        except Exception as e:
+            _pool_failed(path, e)
+    await arun_command([VENV_PYTHON, "-m", "venv", path], check=True, capture_output=False)
+    return os.path.join(path, "bin", "python")
+
+
 def create_virtual_env(path: str) -> str:
     """Creates a virtual environment at the specified path and returns the path to the python executable"""
     try:
-        subprocess.run([f"python", "-m", "venv", path], check=True)
-        python_path = os.path.join(path, "bin", "python")
+        python_path = provision_virtual_env(path)
+        return f"Created virtual environment with python executable path at {python_path}"
+    except Exception as e:
+        raise ToolException(f"Failed to create virtual environment: {str(e)}")
+
+
+async def acreate_virtual_env(path: str) -> str:
+    """Async version of create_virtual_env."""
+    try:
+        python_path = await aprovision_virtual_env(path)
         return f"Created virtual environment with python executable path at {python_path}"
     except Exception as e:
         raise ToolException(f"Failed to create virtual environment: {str(e)}")
@@ -22,6 +89,7 @@ def create_virtual_env(path: str) -> str:
 
 create_virtual_env_tool = StructuredTool.from_function(
     func=create_virtual_env,
+    coroutine=acreate_virtual_env,
     name="CreateVirtualEnv",
     description="Creates a virtual environment at the specified path and returns the path to the python executable",
     args_schema=VirtualEnvInput,
@@ -34,11 +102,149 @@ class InstallRequirementsInput(BaseModel):
     requirements_file: str = Field(description="path to the requirements.txt file to install requirements")
 
 
+INSTALLED_RECORD = ".llm_coder_requirements.json"
+
+
+def normalise_requirements(lines: list[str]) -> list[str]:
+    """
+    Normalises requirement lines: comments and blank lines are dropped, whitespace is removed and the project names
+    are normalised (PEP 503), so that equivalent requirement sets give the same sorted list.
+    """
+    requirements = set()
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        line = re.sub(r"\s+", "", line)
+        match = re.match(r"^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$", line)
+        if match:
+            line = re.sub(r"[-_.]+", "-", match.group(1)).lower() + match.group(2)
+        requirements.add(line)
+    return sorted(requirements)
+
+
+def _installed_record_path(python_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.dirname(python_path)), INSTALLED_RECORD)
+
+
+def read_installed_record(python_path: str) -> dict:
+    """Returns what was already installed in the venv: the hash of the last requirement set and the requirements."""
+    try:
+        with open(_installed_record_path(python_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"hash": None, "installed": []}
+
+
+def _write_installed_record(python_path: str, requirements_hash: str, installed: list[str]):
+    with open(_installed_record_path(python_path), 'w') as f:
+        json.dump({"hash": requirements_hash, "installed": sorted(installed)}, f)
+
+
+def _pip_commands(python_path: str, requirements: list[str]):
+    """
+    The pip commands installing requirements: offline from the wheelhouse, building the missing wheels into the
+    wheelhouse, and from the index as a last resort.
+    """
+    pip = [python_path, "-m", "pip"]
+    offline = pip + ["install", "--no-index", "--find-links", WHEELHOUSE_DIR, *requirements]
+    build_wheels = pip + ["wheel", "--wheel-dir", WHEELHOUSE_DIR, *requirements]
+    online = pip + ["install", "--find-links", WHEELHOUSE_DIR, *requirements]
+    return offline, build_wheels, online
+
+
+def _pip_install(python_path: str, requirements: list[str]):
+    """
+    Installs requirements offline from the wheelhouse. Missing wheels are built into the wheelhouse first, and as a
+    last resort the requirements are installed from the index.
+    """
+    os.makedirs(WHEELHOUSE_DIR, exist_ok=True)
+    offline, build_wheels, online = _pip_commands(python_path, requirements)
+    if run_command(offline, capture_output=True).returncode == 0:
+        return
+    if run_command(build_wheels).returncode == 0:
+        if run_command(offline).returncode == 0:
+            return
+    run_command(online, check=True)
+
+
+async def _apip_install(python_path: str, requirements: list[str]):
+    """Async version of _pip_install."""
+    os.makedirs(WHEELHOUSE_DIR, exist_ok=True)
+    offline, build_wheels, online = _pip_commands(python_path, requirements)
+    if (await arun_command(offline)).returncode == 0:
+        return
+    if (await arun_command(build_wheels, capture_output=False)).returncode == 0:
+        if (await arun_command(offline, capture_output=False)).returncode == 0:
+            return
+    await arun_command(online, check=True, capture_output=False)
+
+
+def _missing_requirements(python_path: str, requirements_file: str):
+    """
+    Compares the requirements file with the record of the venv.
+
+    Returns:
+        tuple[str, set[str], list[str]]: The hash of the requirement set, the installed requirements and the missing
+        ones, or None if the requirement set didn't change
+    """
+    with open(requirements_file) as f:
+        requirements = normalise_requirements(f.readlines())
+    requirements_hash = hashlib.sha256('\n'.join(requirements).encode()).hexdigest()
+
+    record = read_installed_record(python_path)
+    if record["hash"] == requirements_hash:
+        return None
+    installed = set(record["installed"])
+    return requirements_hash, installed, [requirement for requirement in requirements if requirement not in installed]
+
+
+# The installs into the same venv (e.g. from parallel plan steps sharing the project venv) run one at a time
+_install_locks = {}
+_async_install_locks = {}
+
+
+def _install_lock(locks, python_path, factory):
+    return locks.setdefault(os.path.abspath(python_path), factory())
+
+
 def install_requirements_in_env(python_path: str, requirements_file: str) -> str:
     """Installs requirements in the specified virtual environment from a requirements file."""
+    with _install_lock(_install_locks, python_path, threading.Lock):
+        return _install_requirements_in_env(python_path, requirements_file)
+
+
+async def ainstall_requirements_in_env(python_path: str, requirements_file: str) -> str:
+    """Async version of install_requirements_in_env."""
+    async with _install_lock(_async_install_locks, python_path, asyncio.Lock):
+        return await _ainstall_requirements_in_env(python_path, requirements_file)
+
+
+def _install_requirements_in_env(python_path: str, requirements_file: str) -> str:
     try:
-        # Execute the pip install command
-        subprocess.run([python_path, "-m", "pip", "install", "-r", requirements_file], check=True)
+        delta = _missing_requirements(python_path, requirements_file)
+        if delta is None:
+            return f"Requirements already installed in virtual environment with: {python_path}, nothing changed"
+
+        requirements_hash, installed, missing = delta
+        if missing:
+            _pip_install(python_path, missing)
+        _write_installed_record(python_path, requirements_hash, list(installed.union(missing)))
+        return f"Requirements installed in virtual environment with: {python_path} from {requirements_file}"
+    except Exception as e:
+        raise ToolException(f"Failed to install requirements: {str(e)}")
+
+
+async def _ainstall_requirements_in_env(python_path: str, requirements_file: str) -> str:
+    try:
+        delta = _missing_requirements(python_path, requirements_file)
+        if delta is None:
+            return f"Requirements already installed in virtual environment with: {python_path}, nothing changed"
+
+        requirements_hash, installed, missing = delta
+        if missing:
+            await _apip_install(python_path, missing)
+        _write_installed_record(python_path, requirements_hash, list(installed.union(missing)))
         return f"Requirements installed in virtual environment with: {python_path} from {requirements_file}"
     except Exception as e:
         raise ToolException(f"Failed to install requirements: {str(e)}")
@@ -46,6 +252,7 @@ def install_requirements_in_env(python_path: str, requirements_file: str) -> str
 
 install_requirements_tool = StructuredTool.from_function(
     func=install_requirements_in_env,
+    coroutine=ainstall_requirements_in_env,
     name="InstallRequirementsInEnv",
     description="Installs requirements in the specified virtual environment from a requirements file.",
     args_schema=InstallRequirementsInput,
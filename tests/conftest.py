@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The modules of src import each other as top-level modules, like when main.py runs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+# The LLM is built at import, the tests never reach the provider nor write to the caches of the user
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("LLM_CODER_LLM_CACHE", "0")
+os.environ.setdefault("LLM_CODER_CHECKPOINTS", "0")
@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import pytest
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_openai import ChatOpenAI
+
+import cassette
+import llm
+from cassette import Cassette
+from states.test_step import build_agent_executor
+
+RESULT = {"result": False, "feedback": "1 failed"}
+
+
+def _provider(self, messages, stop=None, run_manager=None, **kwargs):
+    call = {"name": "Result", "arguments": json.dumps(RESULT)}
+    yield ChatGenerationChunk(message=AIMessageChunk(content="", additional_kwargs={"function_call": call}))
+
+
+def _offline(self, messages, stop=None, run_manager=None, **kwargs):
+    raise AssertionError("the provider was called while replaying")
+
+
+async def _aoffline(self, messages, stop=None, run_manager=None, **kwargs):
+    raise AssertionError("the provider was called while replaying")
+    yield
+
+
+def _use_cassette(monkeypatch, path, mode):
+    tape = Cassette(str(path))
+    monkeypatch.setattr(cassette, "get_cassette", lambda: tape)
+    monkeypatch.setattr(cassette, "replaying", lambda: mode == "replay")
+    monkeypatch.setattr(llm, "replaying", lambda: mode == "replay")
+    return tape
+
+
+@pytest.fixture
+def recorded(tmp_path, monkeypatch):
+    """A cassette recording a run of the test_step agent executor."""
+    path = tmp_path / "cassette.jsonl"
+    with monkeypatch.context() as patch:
+        tape = _use_cassette(patch, path, "record")
+        patch.setattr(ChatOpenAI, "_stream", _provider)
+        patch.setattr(llm.RATE_LIMITER, "acquire", lambda tokens: 0.0)
+        result = llm.invoke_with_policy(build_agent_executor(), {"input": "run the tests"}, "test_step",
+                                        return_only_outputs=True)
+    assert result == RESULT
+    assert tape.stats()["recorded"] == 1
+    return path
+
+
+def test_agent_executor_replays_without_the_provider(recorded, monkeypatch):
+    tape = _use_cassette(monkeypatch, recorded, "replay")
+    monkeypatch.setattr(ChatOpenAI, "_stream", _offline)
+    result = llm.invoke_with_policy(build_agent_executor(), {"input": "run the tests"}, "test_step",
+                                    return_only_outputs=True)
+    assert result == RESULT
+    assert tape.stats()["replayed"] == 1
+
+
+def test_async_agent_executor_replays_without_the_provider(recorded, monkeypatch):
+    tape = _use_cassette(monkeypatch, recorded, "replay")
+    monkeypatch.setattr(ChatOpenAI, "_astream", _aoffline)
+    result = asyncio.run(llm.ainvoke_with_policy(build_agent_executor(), {"input": "run the tests"}, "test_step",
+                                                 return_only_outputs=True))
+    assert result == RESULT
+    assert tape.stats()["replayed"] == 1
+
+
+def test_unknown_request_is_a_miss(recorded, monkeypatch):
+    _use_cassette(monkeypatch, recorded, "replay")
+    monkeypatch.setattr(ChatOpenAI, "_stream", _offline)
+    with pytest.raises(cassette.CassetteMissError):
+        llm.invoke_with_policy(build_agent_executor(), {"input": "something else"}, "test_step",
+                               return_only_outputs=True)
@@ -0,0 +1,29 @@
+from config import REWORK_ESCALATION, REWORK_REPEAT_LIMIT
+from tools import pytest_report
+from tools.pytest_report import failure_fingerprint
+from states.failure_policy import track_test_result
+
+
+def _run(line):
+    failure = pytest_report.TestOutcome("tests/test_calc.py::test_add", "tests/test_calc.py", "failed", 0.0,
+                                        "AssertionError", "assert 3 == 4", (f"src/calc.py:{line} in add",))
+    return [failure]
+
+
+def test_same_failure_on_moving_lines_escalates():
+    state_dict = {"current_step": "add numbers"}
+    actions = []
+    for line in range(4, 4 + 3 * REWORK_REPEAT_LIMIT, 3):
+        track_test_result(state_dict, False, failure_fingerprint(_run(line)))
+        actions.append(state_dict["failure_action"])
+    assert actions[:-1] == ["rework"] * (REWORK_REPEAT_LIMIT - 1)
+    assert actions[-1] == REWORK_ESCALATION[0]
+
+
+def test_different_failures_keep_reworking():
+    state_dict = {"current_step": "add numbers"}
+    for message in ("assert 3 == 4", "NameError: name 'x' is not defined"):
+        failure = pytest_report.TestOutcome("tests/test_calc.py::test_add", "tests/test_calc.py", "failed", 0.0,
+                                            None, message, ("src/calc.py:4 in add",))
+        track_test_result(state_dict, False, failure_fingerprint([failure]))
+    assert state_dict["failure_action"] == "rework"
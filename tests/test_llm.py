@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import httpx
+import openai
+import pytest
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_openai import ChatOpenAI
+
+import llm
+from states.test_step import build_agent_executor
+
+RESULT = {"result": True, "feedback": "1 passed"}
+
+
+def _result_chunk():
+    call = {"name": "Result", "arguments": json.dumps(RESULT)}
+    return ChatGenerationChunk(message=AIMessageChunk(content="", additional_kwargs={"function_call": call}))
+
+
+def _connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    """Replaces the streamed API calls: the first one fails with a transient error, the next ones return Result."""
+    calls = {"stream": 0, "acquired": 0}
+
+    def stream(self, messages, stop=None, run_manager=None, **kwargs):
+        calls["stream"] += 1
+        if calls["stream"] == 1:
+            raise _connection_error()
+        yield _result_chunk()
+
+    async def astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in stream(self, messages, stop, run_manager, **kwargs):
+            yield chunk
+
+    def acquire(tokens):
+        calls["acquired"] += 1
+        return 0.0
+
+    async def aacquire(tokens):
+        return acquire(tokens)
+
+    monkeypatch.setattr(ChatOpenAI, "_stream", stream)
+    monkeypatch.setattr(ChatOpenAI, "_astream", astream)
+    monkeypatch.setattr(llm.RATE_LIMITER, "acquire", acquire)
+    monkeypatch.setattr(llm.RATE_LIMITER, "aacquire", aacquire)
+    monkeypatch.setattr(llm, "backoff_delay", lambda policy, attempt, error=None: 0.0)
+    return calls
+
+
+def test_agent_executor_calls_are_rate_limited_and_retried(provider):
+    result = llm.invoke_with_policy(build_agent_executor(), {"input": "run the tests"}, "test_step",
+                                    return_only_outputs=True)
+    assert result == RESULT
+    assert provider == {"stream": 2, "acquired": 2}
+
+
+def test_async_agent_executor_calls_are_rate_limited_and_retried(provider):
+    result = asyncio.run(llm.ainvoke_with_policy(build_agent_executor(), {"input": "run the tests"}, "test_step",
+                                                 return_only_outputs=True))
+    assert result == RESULT
+    assert provider == {"stream": 2, "acquired": 2}
+
+
+def test_streamed_call_is_not_retried_after_its_first_chunk(monkeypatch):
+    def stream(self, messages, stop=None, run_manager=None, **kwargs):
+        yield _result_chunk()
+        raise _connection_error()
+
+    monkeypatch.setattr(ChatOpenAI, "_stream", stream)
+    monkeypatch.setattr(llm.RATE_LIMITER, "acquire", lambda tokens: 0.0)
+    with pytest.raises(openai.APIConnectionError):
+        list(llm.LLM.stream("hello"))
+
+
+def test_async_agent_executor_calls_hold_an_llm_slot(monkeypatch):
+    held = []
+
+    async def astream(self, messages, stop=None, run_manager=None, **kwargs):
+        held.append(llm.SCHEDULER.llm.in_use)
+        yield _result_chunk()
+
+    async def aacquire(tokens):
+        return 0.0
+
+    monkeypatch.setattr(ChatOpenAI, "_astream", astream)
+    monkeypatch.setattr(llm.RATE_LIMITER, "aacquire", aacquire)
+    asyncio.run(llm.ainvoke_with_policy(build_agent_executor(), {"input": "run the tests"}, "test_step",
+                                        return_only_outputs=True))
+    assert held == [1]
+    assert llm.SCHEDULER.llm.in_use == 0
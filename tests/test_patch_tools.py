@@ -0,0 +1,30 @@
+from tools.patch_tools import apply_hunks, parse_patch
+
+
+def test_zero_context_insertion_goes_after_the_line_of_the_old_range():
+    content = "a\nb\nc\n"
+    patch = "@@ -2,0 +3,1 @@\n+INS\n"
+    assert apply_hunks(content, parse_patch(patch)) == "a\nb\nINS\nc\n"
+
+
+def test_zero_context_insertion_at_the_top_of_the_file():
+    patch = "@@ -0,0 +1,1 @@\n+INS\n"
+    assert apply_hunks("a\nb\n", parse_patch(patch)) == "INS\na\nb\n"
+
+
+def test_hunk_with_context_keeps_its_position():
+    patch = "@@ -2,1 +2,1 @@\n-b\n+B\n"
+    assert apply_hunks("a\nb\nc\n", parse_patch(patch)) == "a\nB\nc\n"
+
+
+def test_removed_and_added_lines_looking_like_file_headers_are_kept():
+    content = "a\n-- x\nb\n"
+    patch = ("--- a/notes.txt\n+++ b/notes.txt\n"
+             "@@ -1,3 +1,3 @@\n a\n--- x\n+++ y\n b\n")
+    assert apply_hunks(content, parse_patch(patch)) == "a\n++ y\nb\n"
+
+
+def test_file_headers_between_hunks_are_skipped():
+    patch = ("--- a/f.py\n+++ b/f.py\n@@ -1,1 +1,1 @@\n-a\n+A\n"
+             "diff --git a/f.py b/f.py\nindex 123..456 100644\n--- a/f.py\n+++ b/f.py\n@@ -3,1 +3,1 @@\n-c\n+C\n")
+    assert apply_hunks("a\nb\nc\n", parse_patch(patch)) == "A\nb\nC\n"
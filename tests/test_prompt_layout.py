@@ -0,0 +1,49 @@
+import os
+import time
+
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_openai import ChatOpenAI
+
+import llm
+from prompt_layout import ITERATION, RUN, STATIC, PrefixReuseTracker, Section, render_sections
+from states.handle_step import _user_input, build_agent_executor
+
+
+def test_sections_go_from_the_most_to_the_least_stable():
+    prompt = render_sections([Section("files", "a.py", ITERATION), Section("", "instructions", STATIC),
+                              Section("goal", "a calculator", RUN)])
+    assert prompt == "instructions\n\n## goal\na calculator\n\n## files\na.py\n"
+
+
+def test_prefix_reuse_is_recorded_for_the_agent_executor_prompts(tmp_path, monkeypatch):
+    source, test = tmp_path / "src", tmp_path / "tests"
+    source.mkdir()
+    test.mkdir()
+    for index in range(3):
+        (source / f"module_{index}.py").write_text(f"def function_{index}():\n    return {index}\n" * 50)
+    (test / "test_module.py").write_text("def test_module():\n    pass\n")
+    state_dict = {"source_folder": str(source), "test_folder": str(test), "software_description": "A calculator",
+                  "steps_done": ["Create the project"], "steps_todo": ["Add the functions"]}
+
+    def stream(self, messages, stop=None, run_manager=None, **kwargs):
+        yield ChatGenerationChunk(message=AIMessageChunk(content="done"))
+
+    tracker = PrefixReuseTracker(history=8, min_tokens=256)
+    monkeypatch.setattr(llm, "PREFIX_TRACKER", tracker)
+    monkeypatch.setattr(llm, "PROMPT_PREFIX_DEBUG", True)
+    monkeypatch.setattr(ChatOpenAI, "_stream", stream)
+    monkeypatch.setattr(llm.RATE_LIMITER, "acquire", lambda tokens: 0.0)
+
+    executor = build_agent_executor()
+    llm.invoke_with_policy(executor, {"input": _user_input(state_dict)}, "handle_step")
+    # The agent edits a file, it moves to the end of the snapshot
+    time.sleep(0.01)
+    (source / "module_0.py").write_text("def function_0():\n    return -1\n")
+    os.utime(source / "module_0.py")
+    llm.invoke_with_policy(executor, {"input": _user_input(state_dict)}, "handle_step")
+
+    stats = tracker.stats()
+    assert stats["calls"] == 2
+    assert stats["cacheable_calls"] == 1
+    assert stats["reused_chars"] > 0
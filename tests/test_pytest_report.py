@@ -0,0 +1,24 @@
+from tools import pytest_report
+from tools.pytest_report import failure_digest, failure_signature
+
+
+def _failure(nodeid, frames, message="assert 3 == 4"):
+    return pytest_report.TestOutcome(nodeid, "tests/test_calc.py", "failed", 0.0, "AssertionError", message, frames)
+
+
+def test_signature_ignores_the_line_number():
+    before = _failure("tests/test_calc.py::test_add", ("tests/test_calc.py:10 in test_add", "src/calc.py:4 in add"))
+    after = _failure("tests/test_calc.py::test_add", ("tests/test_calc.py:12 in test_add", "src/calc.py:7 in add"))
+    assert failure_signature(before) == failure_signature(after)
+
+
+def test_signature_keeps_the_file_and_function():
+    first = _failure("tests/test_calc.py::test_add", ("src/calc.py:4 in add",))
+    second = _failure("tests/test_calc.py::test_sub", ("src/calc.py:4 in sub",))
+    assert failure_signature(first) != failure_signature(second)
+
+
+def test_same_error_in_several_tests_is_reported_once():
+    failures = [_failure("tests/test_calc.py::test_add", ("src/calc.py:4 in add",)),
+                _failure("tests/test_calc.py::test_add_more", ("src/calc.py:4 in add",))]
+    assert "(1 distinct failures)" in failure_digest(failures)
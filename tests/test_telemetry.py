@@ -0,0 +1,29 @@
+import json
+
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_openai import ChatOpenAI
+
+import llm
+import telemetry
+from states.test_step import build_agent_executor
+
+
+def test_agent_executor_calls_are_recorded(tmp_path, monkeypatch):
+    def stream(self, messages, stop=None, run_manager=None, **kwargs):
+        call = {"name": "Result", "arguments": json.dumps({"result": True, "feedback": "1 passed"})}
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", additional_kwargs={"function_call": call}))
+
+    records = []
+    monkeypatch.setattr(llm, "TELEMETRY_ENABLED", True)
+    monkeypatch.setattr(telemetry, "TELEMETRY_ENABLED", True)
+    monkeypatch.setattr(telemetry, "record", lambda kind, name, duration, **fields: records.append((kind, fields)))
+    monkeypatch.setattr(ChatOpenAI, "_stream", stream)
+    monkeypatch.setattr(llm.RATE_LIMITER, "acquire", lambda tokens: 0.0)
+    llm.invoke_with_policy(build_agent_executor(), {"input": "run the tests"}, "test_step", return_only_outputs=True)
+
+    calls = [fields for kind, fields in records if kind == "llm"]
+    assert len(calls) == 1
+    assert calls[0]["retries"] == 0
+    assert calls[0]["prompt_tokens"] > 0 and calls[0]["completion_tokens"] > 0
+    assert calls[0]["cost_usd"] > 0
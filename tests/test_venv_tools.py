@@ -0,0 +1,68 @@
+import asyncio
+import os
+import subprocess
+import time
+
+import pytest
+
+from tools import venv_pool, venv_tools
+
+
+@pytest.fixture
+def offline_pool(monkeypatch):
+    """An enabled pool whose template can't be built, like when pip can't reach the index."""
+    def build_template():
+        raise RuntimeError("The venv template could not be built: pip install failed")
+
+    monkeypatch.setattr(venv_tools, "VENV_POOL_SIZE", 1)
+    monkeypatch.setattr(venv_pool, "build_template", build_template)
+
+
+def test_plain_venv_when_the_pool_template_fails(offline_pool, tmp_path):
+    python = venv_tools.provision_virtual_env(str(tmp_path / "venv"))
+    assert os.path.isfile(python)
+    assert subprocess.run([python, "-c", "pass"]).returncode == 0
+
+
+def test_async_plain_venv_when_the_pool_template_fails(offline_pool, tmp_path):
+    python = asyncio.run(venv_tools.aprovision_virtual_env(str(tmp_path / "venv")))
+    assert os.path.isfile(python)
+
+
+def test_failed_template_is_not_built_again(monkeypatch, tmp_path):
+    calls = []
+
+    def run_command(args, **kwargs):
+        calls.append(args)
+        raise subprocess.CalledProcessError(1, args)
+
+    monkeypatch.setattr(venv_pool, "VENV_POOL_DIR", str(tmp_path))
+    monkeypatch.setattr(venv_pool, "run_command", run_command)
+    monkeypatch.setattr(venv_pool, "_failed_templates", set())
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            venv_pool.build_template()
+    assert len(calls) == 1
+
+
+def test_cancelled_scaffold_waits_for_the_venv_clone_before_removing_the_project(monkeypatch, tmp_path):
+    from states import create_project
+
+    def acquire(path):
+        # A clone still running in its worker thread when the run is cancelled
+        time.sleep(0.3)
+        os.makedirs(os.path.join(path, "bin"))
+        return os.path.join(path, "bin", "python")
+
+    async def scaffold_then_cancel():
+        task = asyncio.ensure_future(create_project.ascaffold_project("demo", str(tmp_path)))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    monkeypatch.setattr(venv_tools, "VENV_POOL_SIZE", 1)
+    monkeypatch.setattr(venv_pool, "acquire", acquire)
+    asyncio.run(scaffold_then_cancel())
+    time.sleep(0.5)
+    assert os.listdir(tmp_path) == []